@@ -4,11 +4,17 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 
+from app import database
+
 app = Flask(__name__)
 app.config.from_object(Config)
-db = SQLAlchemy(app)
+database.configure(app)
+db = SQLAlchemy(app, session_options={'class_': database.RoutingSession})
+database.configure_engines(app, db)
 migrate = Migrate(app, db)
 login = LoginManager(app)
 login.login_view = 'login'
 
-from app import routes, models
\ No newline at end of file
+from app import metrics, routes, models, cli, write_behind
+
+write_behind.init_app(app)
@@ -0,0 +1,205 @@
+import os
+import click
+from sqlalchemy import delete, func, select, update
+from app import app, db, feed, search, poi, trending, seed as synthetic
+from app.write_behind import replay_logs
+from app.overpass_cache import get_cache
+from app.images import process_post_image, variant_files, remove_files, collect_garbage
+from app.storage import get_storage, HASHED_NAME
+from app.geo import parse_bbox
+from app.models import User, Post, Shop, Comment, Poi, PoiCategory, PoiImport, likes, followers, bookmarks
+
+
+def _count(table, column, owner_id):
+    return select(func.count()).select_from(table).where(column == owner_id).scalar_subquery()
+
+
+# (カウンタカラム, 実際の件数を数える相関サブクエリ)
+COUNTERS = [
+    (Post.likes_count, lambda: _count(likes, likes.c.post_id, Post.id)),
+    (Post.comments_count, lambda: _count(Comment.__table__, Comment.post_id, Post.id)),
+    (User.followers_count, lambda: _count(followers, followers.c.followed_id, User.id)),
+    (User.following_count, lambda: _count(followers, followers.c.follower_id, User.id)),
+    (User.posts_count, lambda: _count(Post.__table__, Post.user_id, User.id)),
+    (Shop.posts_count, lambda: _count(Post.__table__, Post.shop_id, Shop.id)),
+    (Shop.bookmarks_count, lambda: _count(bookmarks, bookmarks.c.shop_id, Shop.id)),
+]
+
+
+@app.cli.command('reconcile-counters')
+@click.option('--dry-run', is_flag=True, help='Only report drifted rows.')
+def reconcile_counters(dry_run):
+    """Recompute denormalized counters and fix rows that have drifted."""
+    for column, actual in COUNTERS:
+        model = column.class_
+        drifted = model.query.filter(column != actual())
+        if dry_run:
+            fixed = drifted.count()
+        else:
+            fixed = db.session.execute(
+                update(model).where(column != actual()).values({column.key: actual()})
+            ).rowcount
+        click.echo(f'{model.__tablename__}.{column.key}: {fixed} drifted')
+    if not dry_run:
+        db.session.commit()
+
+
+@app.cli.command('feed-rebuild')
+def feed_rebuild():
+    """Rebuild the following-feed table from posts and follows."""
+    total = feed.rebuild_feeds()
+    db.session.commit()
+    click.echo(f'feed_item: {total} rows')
+
+
+@app.cli.command('trending-decay')
+def trending_decay():
+    """Decay post and shop hot scores by the time since the last run (run it from cron)."""
+    factor, updated = trending.decay_scores()
+    click.echo(f'trending: x{factor:.4f}, {updated} rows')
+
+
+@app.cli.command('trending-rebuild')
+def trending_rebuild():
+    """Recompute post and shop hot scores from posts, likes and comments."""
+    posts, shops = trending.rebuild_scores()
+    click.echo(f'trending: {posts} posts, {shops} shops')
+
+
+@app.cli.command('search-reindex')
+def search_reindex():
+    """Rebuild the full-text search index for posts, comments and shops."""
+    total = search.rebuild_index()
+    db.session.commit()
+    click.echo(f'search_index: {total} documents')
+
+
+@app.cli.command('overpass-cache')
+@click.argument('action', type=click.Choice(['stats', 'clear']))
+def overpass_cache(action):
+    """Show statistics for, or clear, the Overpass result cache."""
+    cache = get_cache()
+    if action == 'clear':
+        cache.clear()
+    for name, value in cache.stats().items():
+        click.echo(f'{name}: {value}')
+
+
+@app.cli.command('images-process')
+@click.option('--all', 'process_all', is_flag=True, help='Regenerate variants for every post.')
+def images_process(process_all):
+    """Create image variants for posts that do not have them yet."""
+    query = db.session.query(Post.id, Post.image_filename).order_by(Post.id)
+    if not process_all:
+        query = query.filter(Post.variants.is_(None))
+    done = failed = 0
+    for post_id, filename in query.all():
+        try:
+            process_post_image(post_id, filename, reuse=not process_all)
+            done += 1
+        except (OSError, ValueError) as e:
+            failed += 1
+            click.echo(f'post {post_id} ({filename}): {e}', err=True)
+    click.echo(f'variants: {done} posts processed, {failed} failed')
+
+
+@app.cli.command('uploads-dedupe')
+def uploads_dedupe():
+    """Rename uploaded images to their content hash and drop duplicate copies."""
+    storage = get_storage()
+    names = [name for (name,) in db.session.query(Post.image_filename).distinct()
+             if not HASHED_NAME.match(name)]
+    obsolete = []
+    renamed = 0
+    for old_name in names:
+        try:
+            with storage.open(old_name) as file:
+                new_name = storage.save_upload(file, os.path.splitext(old_name)[1].lower())
+        except FileNotFoundError:
+            click.echo(f'{old_name}: file not found', err=True)
+            continue
+        if new_name == old_name:
+            continue
+        # 縮小版は新しい名前で作り直す (`flask images-process`)
+        for (variants,) in db.session.query(Post.variants).filter(Post.image_filename == old_name):
+            obsolete.extend(variant_files(variants))
+        db.session.execute(update(Post).where(Post.image_filename == old_name)
+                           .values(image_filename=new_name, variants=None))
+        obsolete.append(old_name)
+        renamed += 1
+    db.session.commit()
+    # 参照を書き換えてから、古いファイルを消す
+    remove_files(obsolete)
+    click.echo(f'uploads: {renamed} files renamed, {len(obsolete)} old files removed')
+
+
+@app.cli.command('uploads-gc')
+@click.option('--dry-run', is_flag=True, help='Only list the files that would be deleted.')
+def uploads_gc(dry_run):
+    """Delete uploaded images and variants that no post uses any more (run it from cron)."""
+    removed = collect_garbage(app.config['UPLOAD_GC_GRACE_SECONDS'], dry_run=dry_run)
+    for name in removed:
+        click.echo(name)
+    click.echo(f'uploads: {len(removed)} unused files {"found" if dry_run else "removed"}')
+
+
+@app.cli.command('poi-import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--bbox', help='Area covered by the extract as south,west,north,east '
+                             '(default: the bounding box declared in the file).')
+@click.option('--replace', is_flag=True, help='Delete all previously imported POIs first.')
+@click.option('--batch-size', type=int, default=None, help='Rows per transaction.')
+def poi_import(path, bbox, replace, batch_size):
+    """Import shops from an OSM extract (.osm.pbf, .geojson or GeoJSON Lines)."""
+    coverage = None
+    if bbox:
+        try:
+            coverage = parse_bbox(bbox)
+        except ValueError:
+            raise click.BadParameter(bbox, param_hint='--bbox')
+    if path.endswith('.pbf'):
+        if poi.osmium is None:
+            raise click.UsageError('Reading .pbf files requires the osmium package (pip install osmium)')
+        records = poi.read_pbf(path)
+    else:
+        records = poi.read_geojson(path)
+    if coverage is None:
+        coverage = poi.extract_bounds(path)
+        if coverage is None:
+            click.echo('poi: the file declares no bounding box; pass --bbox to answer map searches '
+                       'from these POIs (until then they go to Overpass)', err=True)
+    if replace:
+        for model in (PoiCategory, Poi, PoiImport):
+            db.session.execute(delete(model))
+        db.session.commit()
+    total = poi.import_pois(records, os.path.basename(path),
+                            batch_size or app.config['POI_IMPORT_BATCH_SIZE'], coverage)
+    click.echo(f'poi: {total} imported')
+
+
+@app.cli.command('write-behind-replay')
+def write_behind_replay():
+    """Apply likes/bookmarks left in the write-behind logs of stopped processes."""
+    files, operations = replay_logs(app.config['WRITE_BEHIND_LOG_DIR'])
+    click.echo(f'write-behind: {operations} operations from {files} logs')
+
+
+@app.cli.command('seed')
+@click.option('--users', type=int, default=1000, show_default=True)
+@click.option('--shops', type=int, default=5000, show_default=True)
+@click.option('--posts', type=int, default=50000, show_default=True)
+@click.option('--comments', type=int, default=100000, show_default=True)
+@click.option('--likes', 'like_count', type=int, default=300000, show_default=True)
+@click.option('--follows', type=int, default=20000, show_default=True)
+@click.option('--bookmarks', 'bookmark_count', type=int, default=20000, show_default=True)
+@click.option('--skew', type=float, default=1.1, show_default=True, help='Zipf exponent of popularity.')
+@click.option('--seed', 'random_seed', type=int, default=42, show_default=True)
+def seed(users, shops, posts, comments, like_count, follows, bookmark_count, skew, random_seed):
+    """Fill an empty database with synthetic users, shops, posts and activity."""
+    if db.session.query(User.id).first() is not None or db.session.query(Shop.id).first() is not None:
+        raise click.UsageError('The database is not empty; seed a fresh DATABASE_URL.')
+    if min(users, shops, posts) < 1:
+        raise click.BadParameter('users, shops and posts must be at least 1')
+    counts = synthetic.seed(users, shops, posts, comments, like_count, follows, bookmark_count,
+                            skew=skew, random_seed=random_seed, log=click.echo)
+    click.echo(', '.join(f'{name}: {count}' for name, count in counts.items()))
@@ -0,0 +1,116 @@
+"""
+データベースの接続設定
+
+  SQLite    : 接続のたびに PRAGMA を設定する (WAL・synchronous=NORMAL・busy_timeout・
+              cache_size・mmap_size)。WAL では読み込みが書き込みを待たないので、
+              複数のワーカーから同じファイルを読める。
+  PostgreSQL: 接続プールの大きさと pre-ping (切れた接続を使う前に捨てる)。
+              DATABASE_REPLICA_URL があれば、@use_replica を付けた読み込み専用の
+              画面 (GET) はレプリカから読む。
+
+レプリカは少し遅れて追いつくので、書き込み (GET 以外) をしたブラウザは
+REPLICA_STICKY_SECONDS 秒だけプライマリから読む (自分の投稿が見えなくならないように)。
+"""
+import atexit
+import sqlite3
+import time
+from flask import current_app, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+REPLICA = 'replica'
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def _is_sqlite(url):
+    return make_url(url).get_backend_name() == 'sqlite'
+
+
+def engine_options(url, config):
+    """SQLALCHEMY_ENGINE_OPTIONS (SQLiteは既定のプールのままで、PRAGMA は configure_engines で設定する)"""
+    if _is_sqlite(url):
+        return {}
+    return {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
+
+def configure(app):
+    """SQLAlchemy(app) の前に、エンジンの設定とレプリカの bind を入れる"""
+    config = app.config
+    config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(config['SQLALCHEMY_DATABASE_URI'], config))
+    replica_url = config['DATABASE_REPLICA_URL']
+    if replica_url:
+        config.setdefault('SQLALCHEMY_BINDS', {})[REPLICA] = {'url': replica_url,
+                                                              **engine_options(replica_url, config)}
+
+
+def sqlite_pragmas(config):
+    return [
+        # 最初にロック待ちの時間を設定する (WAL への切り替えにもロックが要る)
+        f'PRAGMA busy_timeout={int(config["SQLITE_BUSY_TIMEOUT"])}',
+        f'PRAGMA journal_mode={config["SQLITE_JOURNAL_MODE"]}',
+        f'PRAGMA synchronous={config["SQLITE_SYNCHRONOUS"]}',
+        # 負の値は KiB 単位
+        f'PRAGMA cache_size={-int(config["SQLITE_CACHE_SIZE_KB"])}',
+        f'PRAGMA mmap_size={int(config["SQLITE_MMAP_SIZE"])}',
+    ]
+
+
+def configure_engines(app, db):
+    """SQLite のエンジンに、接続のたびに PRAGMA を設定するリスナーを付ける"""
+    pragmas = sqlite_pragmas(app.config)
+
+    def set_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', set_pragmas)
+                # 終了時に接続を閉じて、WAL の内容をデータベースのファイルに書き戻す
+                # (閉じないと flask db upgrade などの結果が app.db-wal に残る)
+                atexit.register(engine.dispose)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method not in READ_METHODS and REPLICA in db.engines:
+            session['primary_until'] = time.time() + current_app.config['REPLICA_STICKY_SECONDS']
+        return response
+
+
+def use_replica(view):
+    """この画面の GET はレプリカから読んでよい (書き込みをしない画面にだけ付ける)"""
+    view.use_replica = True
+    return view
+
+
+def _replica_requested():
+    if not has_request_context() or request.method not in READ_METHODS:
+        return False
+    view = current_app.view_functions.get(request.endpoint)
+    if not getattr(view, 'use_replica', False):
+        return False
+    return session.get('primary_until', 0) < time.time()
+
+
+class RoutingSession(Session):
+    """@use_replica の画面では、flush 以外の読み込みをレプリカに送る"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and _replica_requested():
+            replica = self._db.engines.get(REPLICA)
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
@@ -0,0 +1,118 @@
+from flask import current_app
+from sqlalchemy import exists, insert, literal, select, true
+from app import db
+from app.models import User, Post, FeedItem, followers
+from app.hydration import load_posts
+from app.pagination import after_cursor, encode_cursor
+
+
+def fanout_enabled():
+    return current_app.config['FEED_FANOUT_ENABLED']
+
+
+def _is_fanned_out(user):
+    """フォロワーが多すぎるユーザーの投稿は配信せず、読み込み時に取得する"""
+    return user.followers_count < current_app.config['FEED_FANOUT_MAX_FOLLOWERS']
+
+
+def fanout_post(post):
+    """Deliver a new post to the author's own feed and, unless the author is
+    above the fan-out threshold, to every follower's feed in one INSERT ... SELECT."""
+    author = post.author
+    db.session.add(FeedItem(user_id=author.id, post_id=post.id, timestamp=post.timestamp))
+    if not _is_fanned_out(author):
+        return
+    db.session.execute(insert(FeedItem).from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select(followers.c.follower_id, literal(post.id), literal(post.timestamp))
+        .where(followers.c.followed_id == author.id)))
+
+
+def backfill_follow(follower, followed):
+    """フォローした相手の最近の投稿をタイムラインに追加する"""
+    # followers_count の加算を反映させてから判定する
+    db.session.flush()
+    if not _is_fanned_out(followed):
+        return
+    recent = select(literal(follower.id), Post.id, Post.timestamp) \
+        .where(Post.user_id == followed.id) \
+        .order_by(Post.timestamp.desc()) \
+        .limit(current_app.config['FEED_BACKFILL_POSTS'])
+    db.session.execute(insert(FeedItem).from_select(['user_id', 'post_id', 'timestamp'], recent))
+
+
+def trim_unfollow(follower, unfollowed):
+    """フォローを外した相手の投稿をタイムラインから取り除く"""
+    unfollowed_posts = select(Post.id).where(Post.user_id == unfollowed.id)
+    FeedItem.query.filter(FeedItem.user_id == follower.id,
+                          FeedItem.post_id.in_(unfollowed_posts)).delete(synchronize_session=False)
+    # followers_count の減算を反映させてから判定する
+    db.session.flush()
+    if unfollowed.followers_count == current_app.config['FEED_FANOUT_MAX_FOLLOWERS'] - 1:
+        fanout_recent_posts(unfollowed)
+
+
+def fanout_recent_posts(author):
+    """
+    Deliver the author's most recent posts to every follower's feed.
+
+    Called when the author drops back below the fan-out threshold: posts
+    made while they were above it were only pulled at read time, and
+    feed_page stops pulling them now. Rows a follower already has (posts
+    from before the author crossed the threshold) are left alone.
+    """
+    recent = select(Post.id, Post.timestamp) \
+        .where(Post.user_id == author.id) \
+        .order_by(Post.timestamp.desc()) \
+        .limit(current_app.config['FEED_BACKFILL_POSTS']) \
+        .subquery()
+    delivered = exists().where(FeedItem.user_id == followers.c.follower_id, FeedItem.post_id == recent.c.id)
+    rows = select(followers.c.follower_id, recent.c.id, recent.c.timestamp) \
+        .select_from(followers).join(recent, true()) \
+        .where(followers.c.followed_id == author.id, ~delivered)
+    db.session.execute(insert(FeedItem).from_select(['user_id', 'post_id', 'timestamp'], rows))
+
+
+def remove_post(post):
+    FeedItem.query.filter_by(post_id=post.id).delete(synchronize_session=False)
+
+
+def feed_page(user, cursor, per_page):
+    """
+    Return one page of the following feed and the next cursor.
+
+    Posts from fanned-out authors are read from the user's feed_item rows
+    in (timestamp, post_id) index order. Posts from authors above the
+    fan-out threshold are pulled at read time and merged in.
+    """
+    inbox = db.session.query(FeedItem.timestamp, FeedItem.post_id).filter(FeedItem.user_id == user.id)
+    pulled_authors = db.session.query(followers.c.followed_id) \
+        .join(User, User.id == followers.c.followed_id) \
+        .filter(followers.c.follower_id == user.id,
+                User.followers_count >= current_app.config['FEED_FANOUT_MAX_FOLLOWERS'])
+    pulled = db.session.query(Post.timestamp, Post.id).filter(Post.user_id.in_(pulled_authors))
+    if cursor:
+        inbox = after_cursor(inbox, cursor, FeedItem.timestamp, FeedItem.post_id)
+        pulled = after_cursor(pulled, cursor)
+
+    rows = inbox.order_by(FeedItem.timestamp.desc(), FeedItem.post_id.desc()).limit(per_page + 1).all()
+    rows += pulled.order_by(Post.timestamp.desc(), Post.id.desc()).limit(per_page + 1).all()
+    post_ids = [post_id for _, post_id in sorted(set(rows), reverse=True)[:per_page + 1]]
+
+    posts = load_posts(post_ids)
+    next_cursor = encode_cursor(posts[per_page - 1]) if len(posts) > per_page else None
+    return posts[:per_page], next_cursor
+
+
+def rebuild_feeds():
+    """feed_item を作り直す (既存の投稿を全て配信し直す)"""
+    FeedItem.query.delete()
+    threshold = current_app.config['FEED_FANOUT_MAX_FOLLOWERS']
+    own_posts = select(Post.user_id, Post.id, Post.timestamp)
+    followed_posts = select(followers.c.follower_id, Post.id, Post.timestamp) \
+        .join(Post, Post.user_id == followers.c.followed_id) \
+        .join(User, User.id == followers.c.followed_id) \
+        .where(User.followers_count < threshold)
+    for rows in (own_posts, followed_posts):
+        db.session.execute(insert(FeedItem).from_select(['user_id', 'post_id', 'timestamp'], rows))
+    return FeedItem.query.count()
@@ -0,0 +1,86 @@
+"""
+投稿カード (_post_card.html) のHTMLキャッシュ
+
+カードのうち、見ている人によって変わらない部分だけをプロセス内のLRUに保存する。
+キーは投稿ID、値は (バージョン, HTML)。バージョンはカードに表示される値
+(いいね数・コメント数・縮小版の有無) なので、古いHTMLが返ることはない。
+「いいね済み」の表示だけは、返すときに見ている人ごとに差し込む。
+"""
+import threading
+from collections import OrderedDict
+from flask import current_app, render_template
+from markupsafe import Markup
+
+# キャッシュしたHTMLの中で、いいね済みのクラスを差し込む場所
+# (利用者の入力はエスケープされるので、'<' を含むこの文字列とは衝突しない)
+LIKED_SLOT = '<!--liked-->'
+
+
+class FragmentCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, version, html):
+        with self._lock:
+            self._entries[key] = (version, html)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def get_fragment_cache():
+    cache = current_app.extensions.get('fragment_cache')
+    if cache is None:
+        cache = FragmentCache(current_app.config['FRAGMENT_CACHE_MAX_ENTRIES'])
+        current_app.extensions['fragment_cache'] = cache
+    return cache
+
+
+def _card_version(post):
+    return post.likes_count, post.comments_count, post.variants is not None
+
+
+def render_post_card(post):
+    """hydrate_posts 済みの投稿のカードを返す (テンプレートから {{ post_card(post) }} で使う)"""
+    cache = get_fragment_cache()
+    version = _card_version(post)
+    html = cache.get(post.id, version)
+    if html is None:
+        html = render_template('_post_card.html', post=post, liked_slot=Markup(LIKED_SLOT))
+        cache.set(post.id, version, html)
+    return Markup(html.replace(LIKED_SLOT, ' liked' if post.is_liked else '', 1))
+
+
+def invalidate_post_card(post_id):
+    get_fragment_cache().invalidate(post_id)
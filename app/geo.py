@@ -0,0 +1,141 @@
+from math import radians, cos, sin, asin, sqrt, isfinite
+from sqlalchemy import and_, or_, case, func
+
+EARTH_RADIUS_KM = 6371
+# 緯度1度あたりの距離 (km)
+KM_PER_DEGREE = 111.32
+
+# 緯度経度を格子状のセルに分けて、セル番号 (整数) のB-tree索引で範囲検索する
+# 0.05度 ≒ 南北 5.5km なので、地図の表示範囲は数十セル程度になる
+CELL_DEGREES = 0.05
+CELL_COLUMNS = round(360 / CELL_DEGREES)
+CELL_ROWS = round(180 / CELL_DEGREES)
+# これより多くの行にまたがる広い範囲は、セルを使わず緯度経度だけで絞り込む
+MAX_CELL_ROWS = 100
+
+
+def _row(latitude):
+    return min(int((latitude + 90) // CELL_DEGREES), CELL_ROWS - 1)
+
+
+def _column(longitude):
+    return int((longitude + 180) // CELL_DEGREES) % CELL_COLUMNS
+
+
+def grid_cell(latitude, longitude):
+    """緯度経度が含まれるセルの番号 (行 * 列数 + 列)"""
+    return _row(latitude) * CELL_COLUMNS + _column(longitude)
+
+
+def _wrap_longitude(longitude):
+    """経度を [-180, 180) に戻す"""
+    return (longitude + 180) % 360 - 180
+
+
+def valid_point(latitude, longitude):
+    """緯度経度が (nan や inf でなく) 地球上の点を指しているか"""
+    return (latitude is not None and longitude is not None and isfinite(latitude) and isfinite(longitude)
+            and -90 <= latitude <= 90 and -180 <= longitude <= 180)
+
+
+def parse_bbox(bbox):
+    """
+    Parse a 'south,west,north,east' string (the Overpass order used by
+    map.html) into floats. Raises ValueError for malformed boxes.
+
+    Leaflet keeps counting longitudes past ±180 after the map is panned
+    across the antimeridian, so they are wrapped back into [-180, 180];
+    the box then has west > east, which bbox_filter handles. Latitudes
+    are clamped to ±90.
+    """
+    south, west, north, east = (float(value) for value in bbox.split(','))
+    if not all(isfinite(value) for value in (south, west, north, east)) or south > north:
+        raise ValueError(f'invalid bbox: {bbox!r}')
+    south, north = max(south, -90.0), min(north, 90.0)
+    if west <= east and east - west >= 360:
+        return south, -180.0, north, 180.0
+    if not (-180 <= west <= 180 and -180 <= east <= 180):
+        west, east = _wrap_longitude(west), _wrap_longitude(east)
+        if east == -180.0:
+            east = 180.0
+    return south, west, north, east
+
+
+def cell_ranges(south, west, north, east):
+    """
+    Return the cells covering the box as contiguous (first, last) ranges,
+    one or two per grid row, or None if the box spans too many rows.
+    """
+    first_row, last_row = _row(south), _row(north)
+    if last_row - first_row >= MAX_CELL_ROWS:
+        return None
+    west_column, east_column = _column(west), _column(east)
+    if west <= east:
+        column_spans = [(west_column, east_column)]
+    else:
+        # 日付変更線をまたぐ範囲
+        column_spans = [(west_column, CELL_COLUMNS - 1), (0, east_column)]
+    return [(row * CELL_COLUMNS + first, row * CELL_COLUMNS + last)
+            for row in range(first_row, last_row + 1)
+            for first, last in column_spans]
+
+
+def bbox_filter(latitude, longitude, cell, south, west, north, east):
+    """
+    Build a WHERE clause selecting rows inside the box.
+
+    The cell ranges let the database seek on the cell index; the exact
+    latitude/longitude comparison then trims rows at the edge cells.
+    """
+    if west <= east:
+        in_longitude = longitude.between(west, east)
+    else:
+        in_longitude = or_(longitude >= west, longitude <= east)
+    condition = and_(latitude.between(south, north), in_longitude)
+    ranges = cell_ranges(south, west, north, east)
+    if ranges is None:
+        return condition
+    return and_(or_(*[cell.between(first, last) for first, last in ranges]), condition)
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Calculate the great circle distance in kilometers between two points 
+    on the earth (specified in decimal degrees)
+    """
+    # 緯度経度をラジアンに変換
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+
+    # ハーベサインの公式
+    dlon = lon2 - lon1 
+    dlat = lat2 - lat1 
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a)) 
+    return c * EARTH_RADIUS_KM
+
+
+def radius_bbox(latitude, longitude, radius_km):
+    """中心から radius_km の円を囲む (south, west, north, east)"""
+    dlat = radius_km / KM_PER_DEGREE
+    dlon = radius_km / (KM_PER_DEGREE * max(cos(radians(latitude)), 0.01))
+    if dlon >= 180:
+        west, east = -180.0, 180.0
+    else:
+        west = (longitude - dlon + 180) % 360 - 180
+        east = (longitude + dlon + 180) % 360 - 180
+    return max(latitude - dlat, -90.0), west, min(latitude + dlat, 90.0), east
+
+
+def squared_distance_km(latitude, longitude, center_latitude, center_longitude):
+    """
+    SQL expression for the squared distance in km² from the point to
+    the latitude/longitude columns. It uses the equirectangular
+    approximation, which is within 1% of haversine for a few tens of km,
+    and measures longitudes the short way round across the antimeridian.
+    Compare it with radius_km ** 2 after narrowing with radius_bbox.
+    """
+    dlon = func.abs(longitude - center_longitude)
+    dlon = case((dlon > 180, 360 - dlon), else_=dlon)
+    dlat = latitude - center_latitude
+    x_scale = KM_PER_DEGREE * cos(radians(center_latitude))
+    return dlat * dlat * KM_PER_DEGREE ** 2 + dlon * dlon * x_scale ** 2
@@ -0,0 +1,70 @@
+"""
+GeoJSON FeatureCollection のストリーミング出力
+
+Feature を1件ずつJSONに変換して、ある程度たまったらチャンクとして送る。
+全件のリストも、レスポンス全体の文字列も作らないので、件数が多くても
+メモリ使用量は一定で、最初のバイトもすぐに返せる。
+orjson がインストールされていればそれを使う。
+"""
+import json
+from flask import Response, stream_with_context
+
+try:
+    import orjson
+except ImportError:  # orjson が無い環境では標準の json を使う
+    orjson = None
+
+# これくらいたまったら送る (バイト)
+CHUNK_SIZE = 64 * 1024
+
+# 結果をまとめて読み込まず、この件数ずつDBから取り出す
+YIELD_PER = 1000
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def point_feature(longitude, latitude, properties):
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [longitude, latitude]
+        },
+        "properties": properties
+    }
+
+
+def iter_feature_collection(features, extra=None):
+    """
+    Yield a FeatureCollection as UTF-8 chunks.
+
+    `features` may be any iterable, including a generator reading rows
+    from the database. `extra` is a callable returning more top-level
+    members; it is called after the last feature, so it can report
+    things learned while streaming (e.g. whether the result was cut off).
+    """
+    buffer = bytearray(b'{"type":"FeatureCollection","features":[')
+    first = True
+    for feature in features:
+        if not first:
+            buffer += b','
+        buffer += dumps(feature)
+        first = False
+        if len(buffer) >= CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    buffer += b']'
+    for key, value in (extra() if extra else {}).items():
+        buffer += b',' + dumps(key) + b':' + dumps(value)
+    buffer += b'}'
+    yield bytes(buffer)
+
+
+def geojson_response(features, extra=None):
+    """FeatureCollection をチャンク形式で返すレスポンス (DBの読み込みもストリーミング中に行う)"""
+    return Response(stream_with_context(iter_feature_collection(features, extra)),
+                    mimetype='application/json')
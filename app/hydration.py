@@ -0,0 +1,65 @@
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import set_committed_value
+from app.models import Post
+from app.images import variant_url
+from app.write_behind import write_behind_enabled, get_write_behind
+
+
+def with_post_relations(query):
+    """投稿の author と shop を同じSELECTでJOINして読み込む"""
+    return query.options(joinedload(Post.author), joinedload(Post.shop))
+
+
+def load_posts(post_ids):
+    """IDのリストから投稿を読み込み、同じ順番で返す (削除済みのIDは飛ばす)"""
+    if not post_ids:
+        return []
+    posts_by_id = {post.id: post for post in with_post_relations(Post.query).filter(Post.id.in_(post_ids))}
+    return [posts_by_id[post_id] for post_id in post_ids if post_id in posts_by_id]
+
+
+def hydrate_posts(posts, viewer=None):
+    """
+    Attach the viewer's is_liked flag to every post in the page.
+
+    likes_count / comments_count are counter columns on Post, and the
+    viewer's likes are fetched with one query for the whole page, so the
+    number of queries does not depend on the number of posts.
+    With write-behind enabled, likes not yet written to the database are
+    applied on top of both.
+    """
+    posts = list(posts)
+    post_ids = [post.id for post in posts]
+    if not post_ids:
+        return posts
+
+    liked_ids = viewer.liked_post_ids(post_ids) if viewer is not None else set()
+    if write_behind_enabled():
+        write_behind = get_write_behind()
+        if viewer is not None and viewer.is_authenticated:
+            liked_ids = write_behind.overlay_ids('like', viewer.id, liked_ids, post_ids)
+        for post in posts:
+            delta = write_behind.count_delta('like', post.id)
+            if delta:
+                # 表示用の値なので、変更として扱わない (flushでUPDATEされない)
+                set_committed_value(post, 'likes_count', post.likes_count + delta)
+
+    for post in posts:
+        post.is_liked = post.id in liked_ids
+    return posts
+
+
+def serialize_post(post):
+    """hydrate_posts 済みの投稿をJSON APIのレスポンス形式に変換する"""
+    return {
+        'id': post.id,
+        'body': post.body,
+        'image_filename': post.image_filename,
+        'thumb_url': variant_url(post, 'thumb'),
+        'image_url': variant_url(post, 'detail'),
+        'author_username': post.author.username,
+        'shop_name': post.shop.name,
+        'likes_count': post.likes_count,
+        'is_liked_by_user': post.is_liked,
+        'comments_count': post.comments_count
+    }
@@ -0,0 +1,165 @@
+"""
+投稿画像の縮小版 (サムネイル・詳細表示用) の作成
+
+アップロードされた元画像から IMAGE_VARIANTS の大きさの縮小版を
+IMAGE_FORMATS の形式 (AVIF / WebP) で作り、Post.variants に記録する。
+処理はリクエストを待たせないように、スレッドプールで行う。
+縮小版ができるまでは、テンプレートとAPIは元画像を返す。
+ファイルの読み書きは app/storage.py の保存先を通して行う。
+"""
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from PIL import Image, ImageOps, features
+from sqlalchemy import update
+from app import db
+from app.models import Post
+from app.storage import get_storage, HASHED_NAME
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='images')
+
+MIME_TYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+
+
+def _formats():
+    # AVIF は Pillow が libavif 付きでビルドされている場合だけ作る
+    return [fmt for fmt in current_app.config['IMAGE_FORMATS'] if features.check(fmt)]
+
+
+def _encode(image, fmt, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, **options)
+    return buffer.getvalue()
+
+
+# 縮小版に残す情報 (撮影場所・日時・機種などの EXIF / XMP / コメントは残さない)
+KEPT_INFO = ('transparency', 'icc_profile')
+
+
+def _without_metadata(image):
+    image.info = {key: value for key, value in image.info.items() if key in KEPT_INFO}
+    return image
+
+
+def generate_variants(filename):
+    """
+    Write the resized copies of the stored image and return the dict
+    stored in Post.variants:
+
+        {'thumb': {'width': 480, 'height': 360,
+                   'files': {'avif': '<stem>_thumb.avif', 'webp': '<stem>_thumb.webp'}},
+         'detail': {...}}
+
+    Images are rotated according to their EXIF orientation first; the
+    variants are written without any metadata. The stored original is
+    only read (it is named by its content hash), so running this again
+    gives the same variants.
+    """
+    config = current_app.config
+    storage = get_storage()
+    stem = os.path.splitext(filename)[0]
+    variants = {}
+    with storage.open(filename) as file, Image.open(file) as original:
+        original.load()
+        image = _without_metadata(ImageOps.exif_transpose(original))
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+        for size, max_edge in config['IMAGE_VARIANTS'].items():
+            resized = image.copy()
+            resized.thumbnail((max_edge, max_edge), Image.LANCZOS)  # 小さい画像は拡大しない
+            files = {}
+            for fmt in _formats():
+                variant_name = f'{stem}_{size}.{fmt}'
+                storage.put(variant_name, _encode(resized, fmt.upper(), quality=config['IMAGE_QUALITY']))
+                files[fmt] = variant_name
+            variants[size] = {'width': resized.width, 'height': resized.height, 'files': files}
+    return variants
+
+
+def variant_files(variants):
+    return [name for variant in (variants or {}).values() for name in variant['files'].values()]
+
+
+def remove_files(filenames):
+    storage = get_storage()
+    for name in filenames:
+        storage.delete(name)
+
+
+def collect_garbage(grace_seconds, dry_run=False):
+    """
+    Delete the stored images and variants that no post refers to and
+    that were not stored or uploaded again in the last `grace_seconds`,
+    and return their names.
+
+    Files are matched by the content hash in their name, so the variants
+    of an image that is still used are kept even if a post's variants
+    have not been recorded yet. Files without a hashed name (uploads
+    that `flask uploads-dedupe` has not renamed) are left alone.
+    """
+    storage = get_storage()
+    # 参照を先に読み、その後にアップロードされた画像は更新時刻の猶予で守る
+    cutoff = time.time() - grace_seconds
+    used = {name[:64] for (name,) in db.session.query(Post.image_filename).distinct()}
+    removed = []
+    for name in storage.names():
+        if not HASHED_NAME.match(name) or name[:64] in used:
+            continue
+        if dry_run or storage.delete_stale(name, cutoff):
+            removed.append(name)
+    return removed
+
+
+def process_post_image(post_id, filename, reuse=True):
+    """
+    縮小版を作って Post.variants に保存する
+    同じ画像の投稿が既にあれば、その縮小版を使い回す (reuse=False で作り直す)
+    投稿が削除済みなら、作ったファイルは `flask uploads-gc` で消える
+    """
+    variants = None
+    if reuse:
+        variants = db.session.query(Post.variants) \
+            .filter(Post.image_filename == filename, Post.variants.isnot(None)).limit(1).scalar()
+    if variants is None:
+        variants = generate_variants(filename)
+    db.session.execute(update(Post).where(Post.id == post_id).values(variants=variants))
+    db.session.commit()
+    return variants
+
+
+def _process_in_background(app, post_id, filename):
+    with app.app_context():
+        try:
+            process_post_image(post_id, filename)
+        except (OSError, ValueError) as e:
+            # Pillowで開けない画像 (UnidentifiedImageError も OSError) は元画像のまま表示する
+            app.logger.warning('Could not create variants for post %s (%s): %s', post_id, filename, e)
+
+
+def process_post_image_async(post_id, filename):
+    app = current_app._get_current_object()
+    return _executor.submit(_process_in_background, app, post_id, filename)
+
+
+def upload_url(filename):
+    return get_storage().url(filename)
+
+
+def variant_sources(post, size):
+    """<picture> の <source> 用に (MIMEタイプ, URL) を圧縮率の高い形式から順に返す"""
+    variant = (post.variants or {}).get(size)
+    if variant is None:
+        return []
+    storage = get_storage()
+    return [(MIME_TYPES[fmt], storage.url(variant['files'][fmt])) for fmt in MIME_TYPES if fmt in variant['files']]
+
+
+def variant_url(post, size):
+    """JSON API 用に、どのブラウザでも表示できる WebP の縮小版 (無ければ元画像) のURLを返す"""
+    storage = get_storage()
+    variant = (post.variants or {}).get(size)
+    if variant is not None and 'webp' in variant['files']:
+        return storage.url(variant['files']['webp'])
+    return storage.url(post.image_filename)
@@ -0,0 +1,239 @@
+"""
+リクエストごとの計測と /metrics (Prometheus のテキスト形式)
+
+  - エンドポイントごとの処理時間のヒストグラムと件数 (before/teardown_request)
+  - リクエストごとのSQLの回数と時間 (SQLAlchemy の cursor_execute イベント)
+  - Overpass / Nominatim への問い合わせ時間 (app/upstream.py から observe_upstream)
+  - 各キャッシュのヒット数と、write-behind の未反映件数
+
+SLOW_REQUEST_SECONDS より遅いリクエストは、時間のかかったSQLの上位と一緒にログに出す。
+記録はリクエストの終わりに1回ロックを取るだけなので、本番でも有効のままにできる。
+"""
+import threading
+import time
+from collections import defaultdict
+from flask import current_app, g, has_request_context, request, Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+
+# 秒
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 遅いリクエストのログに出すSQLの数と、SQLの文字数
+SLOW_LOG_QUERIES = 3
+SLOW_LOG_STATEMENT_LENGTH = 200
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (endpoint, method) -> Histogram
+        self.latency = defaultdict(Histogram)
+        # (endpoint, method, status) -> 件数
+        self.requests = defaultdict(int)
+        # endpoint -> [SQLの回数, SQLの秒数]
+        self.queries = defaultdict(lambda: [0, 0.0])
+        # service -> Histogram / 失敗数
+        self.upstream = defaultdict(Histogram)
+        self.upstream_failures = defaultdict(int)
+
+    def record_request(self, endpoint, method, status, seconds, queries, query_seconds):
+        with self._lock:
+            self.latency[endpoint, method].observe(seconds)
+            self.requests[endpoint, method, status] += 1
+            totals = self.queries[endpoint]
+            totals[0] += queries
+            totals[1] += query_seconds
+
+    def record_upstream(self, service, seconds, failed):
+        with self._lock:
+            self.upstream[service].observe(seconds)
+            if failed:
+                self.upstream_failures[service] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'latency': {key: (list(h.counts), h.sum, h.count) for key, h in self.latency.items()},
+                'requests': dict(self.requests),
+                'queries': {key: tuple(value) for key, value in self.queries.items()},
+                'upstream': {key: (list(h.counts), h.sum, h.count) for key, h in self.upstream.items()},
+                'upstream_failures': dict(self.upstream_failures),
+            }
+
+
+def get_metrics():
+    metrics = current_app.extensions.get('metrics')
+    if metrics is None:
+        metrics = current_app.extensions.setdefault('metrics', Metrics())
+    return metrics
+
+
+class RequestMetrics:
+    """1リクエスト分の計測値 (g.request_metrics)"""
+    __slots__ = ('started', 'status', 'queries', 'query_seconds', 'upstream_seconds', 'statements', 'query_started')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.status = 500
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.upstream_seconds = 0.0
+        # SQL -> [回数, 秒数] (遅いリクエストのログ用)
+        self.statements = {}
+        self.query_started = []
+
+
+def _request_metrics():
+    return g.get('request_metrics') if has_request_context() else None
+
+
+def observe_upstream(service, seconds, failed):
+    """外部APIへの問い合わせ1回分を記録する (リクエスト中ならそのリクエストの時間にも足す)"""
+    get_metrics().record_upstream(service, seconds, failed)
+    state = _request_metrics()
+    if state is not None:
+        state.upstream_seconds += seconds
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = _request_metrics()
+    if state is not None:
+        state.query_started.append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = _request_metrics()
+    if state is None or not state.query_started:
+        return
+    elapsed = time.perf_counter() - state.query_started.pop()
+    state.queries += 1
+    state.query_seconds += elapsed
+    totals = state.statements.get(statement)
+    if totals is None:
+        state.statements[statement] = [1, elapsed]
+    else:
+        totals[0] += 1
+        totals[1] += elapsed
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # 失敗したSQLでは after_cursor_execute が呼ばれないので、開始時刻を捨てる
+    state = _request_metrics()
+    if state is not None and state.query_started:
+        state.query_started.pop()
+
+
+@app.before_request
+def _start_request_metrics():
+    g.request_metrics = RequestMetrics()
+
+
+@app.after_request
+def _record_status(response):
+    state = _request_metrics()
+    if state is not None:
+        state.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def _finish_request_metrics(exc):
+    # ストリーミングのレスポンスでは、送り終わってから呼ばれる
+    state = g.pop('request_metrics', None)
+    if state is None:
+        return
+    seconds = time.perf_counter() - state.started
+    if exc is not None:
+        state.status = 500
+    get_metrics().record_request(request.endpoint or 'unmatched', request.method, state.status, seconds,
+                                 state.queries, state.query_seconds)
+    if seconds >= current_app.config['SLOW_REQUEST_SECONDS']:
+        top = sorted(state.statements.items(), key=lambda item: item[1][1], reverse=True)[:SLOW_LOG_QUERIES]
+        current_app.logger.warning(
+            'slow request: %s %s -> %s %.0fms (sql %d queries %.0fms, upstream %.0fms)%s',
+            request.method, request.full_path.rstrip('?'), state.status, seconds * 1000,
+            state.queries, state.query_seconds * 1000, state.upstream_seconds * 1000,
+            ''.join(f'\n  {count}x {total * 1000:.1f}ms {" ".join(statement.split())[:SLOW_LOG_STATEMENT_LENGTH]}'
+                    for statement, (count, total) in top))
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _histogram_lines(name, series, buckets=LATENCY_BUCKETS):
+    for labels, (counts, total, count) in series:
+        cumulative = 0
+        for bound, bucket_count in zip((*buckets, '+Inf'), counts):
+            cumulative += bucket_count
+            yield f'{name}_bucket{_labels(**labels, le=bound)} {cumulative}'
+        yield f'{name}_sum{_labels(**labels)} {total}'
+        yield f'{name}_count{_labels(**labels)} {count}'
+
+
+def render_prometheus(snapshot, caches, write_behind=None):
+    """計測値をPrometheusのテキスト形式にする。caches は {名前: stats()}"""
+    lines = ['# HELP http_request_duration_seconds Request latency by endpoint.',
+             '# TYPE http_request_duration_seconds histogram']
+    lines += _histogram_lines('http_request_duration_seconds', (
+        ({'endpoint': endpoint, 'method': method}, value)
+        for (endpoint, method), value in sorted(snapshot['latency'].items())))
+    lines += ['# HELP http_requests_total Requests by endpoint and status.',
+              '# TYPE http_requests_total counter']
+    lines += [f'http_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}'
+              for (endpoint, method, status), count in sorted(snapshot['requests'].items())]
+    lines += ['# HELP db_queries_total SQL statements executed, by endpoint.',
+              '# TYPE db_queries_total counter']
+    lines += [f'db_queries_total{_labels(endpoint=endpoint)} {count}'
+              for endpoint, (count, _) in sorted(snapshot['queries'].items())]
+    lines += ['# HELP db_query_seconds_total Time spent in SQL statements, by endpoint.',
+              '# TYPE db_query_seconds_total counter']
+    lines += [f'db_query_seconds_total{_labels(endpoint=endpoint)} {seconds}'
+              for endpoint, (_, seconds) in sorted(snapshot['queries'].items())]
+    lines += ['# HELP upstream_request_duration_seconds Overpass/Nominatim request latency.',
+              '# TYPE upstream_request_duration_seconds histogram']
+    lines += _histogram_lines('upstream_request_duration_seconds', (
+        ({'service': service}, value) for service, value in sorted(snapshot['upstream'].items())))
+    lines += ['# HELP upstream_failures_total Failed Overpass/Nominatim requests.',
+              '# TYPE upstream_failures_total counter']
+    lines += [f'upstream_failures_total{_labels(service=service)} {count}'
+              for service, count in sorted(snapshot['upstream_failures'].items())]
+    for name, kind, key in (('cache_hits_total', 'counter', 'hits'), ('cache_misses_total', 'counter', 'misses'),
+                            ('cache_entries', 'gauge', 'entries')):
+        lines += [f'# TYPE {name} {kind}']
+        lines += [f'{name}{_labels(cache=cache)} {stats[key]}' for cache, stats in caches.items()]
+    if write_behind is not None:
+        lines += ['# TYPE write_behind_pending gauge', f'write_behind_pending {write_behind["pending"]}',
+                  '# TYPE write_behind_flushed_total counter', f'write_behind_flushed_total {write_behind["flushed"]}',
+                  '# TYPE write_behind_syncs_total counter', f'write_behind_syncs_total {write_behind["syncs"]}']
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_response(caches, write_behind=None):
+    return Response(render_prometheus(get_metrics().snapshot(), caches, write_behind),
+                    mimetype='text/plain; version=0.0.4')
@@ -1,27 +1,127 @@
 from datetime import datetime, timezone
+from flask import current_app
 from app import db, login
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_login import UserMixin
+from flask_login import UserMixin, AnonymousUserMixin
+from app.geo import grid_cell
+from sqlalchemy import case, event, inspect, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import make_transient_to_detached, object_session
+from app.user_cache import get_user_cache
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
-
+    """
+    Load the logged-in user, from the user cache when possible.
+
+    A cached user is rebuilt from its column values and merged into the
+    request's session without a SELECT; relationships still load lazily.
+    """
+    cache = get_user_cache()
+    values = cache.get(int(id))
+    if values is None:
+        user = db.session.get(User, int(id))
+        if user is not None:
+            cache.set(user.id, {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs})
+        return user
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def increment_counter(obj, name, delta=1):
+    """
+    Update a denormalized counter column as `col = col + delta`.
+
+    The increment is applied by the database at flush time, so concurrent
+    requests cannot overwrite each other's updates. `obj` must already be
+    persistent (flush a newly added object first).
+    """
+    setattr(obj, name, getattr(obj.__class__, name) + delta)
+
+
+def hot_score_after(model, kind, count=1):
+    """
+    SQL expression for `model.hot_score` after `count` interactions of
+    `kind` (app/trending.py). Taking interactions back never drops the
+    score below zero, since it has been decayed since they were added.
+    """
+    weight = current_app.config['TRENDING_WEIGHTS'][kind] * count
+    score = model.hot_score + weight
+    return score if weight >= 0 else case((score > 0, score), else_=0.0)
+
+
+def add_hot_score(model, target_id, kind, count=1):
+    """ID (またはスカラーのサブクエリ) で指定した行の hot_score をすぐにUPDATEする"""
+    db.session.execute(update(model).where(model.id == target_id)
+                       .values(hot_score=hot_score_after(model, kind, count))
+                       .execution_options(synchronize_session=False))
+
+# 関連テーブルは (持ち主, 相手) の複合主キーで重複を防ぎ、逆向きの索引で相手側からも引けるようにする
 likes = db.Table('likes',
-                 db.Column('user_id', db.Integer, db.ForeignKey('user.id', name='fk_likes_user_id')),
-                 db.Column('post_id', db.Integer, db.ForeignKey('post.id', name='fk_likes_post_id')))
+                 db.Column('user_id', db.Integer, db.ForeignKey('user.id', name='fk_likes_user_id'), primary_key=True),
+                 db.Column('post_id', db.Integer, db.ForeignKey('post.id', name='fk_likes_post_id'), primary_key=True),
+                 db.Index('ix_likes_post_id_user_id', 'post_id', 'user_id'))
 
 
 followers = db.Table('followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id', name='fk_followers_follower_id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id', name='fk_followers_followed_id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id', name='fk_followers_follower_id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id', name='fk_followers_followed_id'), primary_key=True),
+    db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
 bookmarks = db.Table('bookmarks',
-                    db.Column('user_id', db.Integer, db.ForeignKey('user.id', name='fk_bookmarks_user_id')),
-                    db.Column('shop_id', db.Integer, db.ForeignKey('shop.id', name='fk_bookmarks_shop_id')) 
+                    db.Column('user_id', db.Integer, db.ForeignKey('user.id', name='fk_bookmarks_user_id'), primary_key=True),
+                    db.Column('shop_id', db.Integer, db.ForeignKey('shop.id', name='fk_bookmarks_shop_id'), primary_key=True),
+                    db.Index('ix_bookmarks_shop_id_user_id', 'shop_id', 'user_id')
 )
 
+
+def insert_ignore(table, **values):
+    """
+    Insert a row unless one with the same primary key exists, as a single
+    statement (no check-then-write race). Returns True if a row was added.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table).values(**values).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = sqlite.insert(table).values(**values).on_conflict_do_nothing()
+    else:
+        statement = table.insert().values(**values).prefix_with('IGNORE')
+    return db.session.execute(statement).rowcount == 1
+
+
+def delete_row(table, **values):
+    """行を削除して、削除した場合は True を返す"""
+    condition = db.and_(*[table.c[name] == value for name, value in values.items()])
+    return db.session.execute(table.delete().where(condition)).rowcount == 1
+
+
+def _id_set(id_column, owner_condition, candidate_ids=None):
+    query = db.session.query(id_column).filter(owner_condition)
+    if candidate_ids is not None:
+        if not candidate_ids:
+            return set()
+        query = query.filter(id_column.in_(candidate_ids))
+    return {id for (id,) in query}
+
+
+class AnonymousUser(AnonymousUserMixin):
+    # ログインしていない場合は、いいね・フォロー・ブックマークは常に空
+    def bookmarked_shop_ids(self, shop_ids=None):
+        return set()
+
+    def followed_user_ids(self, user_ids=None):
+        return set()
+
+    def liked_post_ids(self, post_ids=None):
+        return set()
+
+
+login.anonymous_user = AnonymousUser
+
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key = True, nullable=False)
     username = db.Column(db.String(64), index=True, unique=True, nullable=False)
@@ -29,21 +129,38 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(128), nullable=False)
     posts = db.relationship('Post', back_populates='author', lazy='dynamic')
 
+    # 件数はCOUNT(*)せずにこのカラムから読む (app/cli.py の reconcile-counters で再計算できる)
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    posts_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     # bookmarked_shop
     bookmarked_shops = db.relationship('Shop', secondary=bookmarks, back_populates='bookmarked_by', lazy='dynamic')
 
+    # 追加・削除は1文で行い、実際に行が変わったときだけカウンタを更新する
+    # (同時にクリックされても行もカウンタも二重にならない)
     def bookmark_shop(self, shop):
-        if not self.has_bookmarked_shop(shop):
-            self.bookmarked_shops.append(shop)
+        if insert_ignore(bookmarks, user_id=self.id, shop_id=shop.id):
+            increment_counter(shop, 'bookmarks_count')
+            shop.hot_score = hot_score_after(Shop, 'bookmark')
+            return True
+        return False
 
     def unbookmark_shop(self, shop):
-        if self.has_bookmarked_shop(shop):
-            self.bookmarked_shops.remove(shop)
+        if delete_row(bookmarks, user_id=self.id, shop_id=shop.id):
+            increment_counter(shop, 'bookmarks_count', -1)
+            shop.hot_score = hot_score_after(Shop, 'bookmark', -1)
+            return True
+        return False
 
     def has_bookmarked_shop(self, shop):
         return self.bookmarked_shops.filter(
             bookmarks.c.shop_id == shop.id).count() > 0
 
+    # ▼▼▼ 一覧表示用: 1回のクエリでIDの集合を取得する (shop_ids を省略すると全件) ▼▼▼
+    def bookmarked_shop_ids(self, shop_ids=None):
+        return _id_set(bookmarks.c.shop_id, bookmarks.c.user_id == self.id, shop_ids)
+
     # liked_post
     liked_posts = db.relationship('Post', secondary=likes, back_populates='likers', lazy='dynamic')
     comments = db.relationship('Comment', back_populates='author', lazy='dynamic')
@@ -55,39 +172,58 @@ class User(UserMixin, db.Model):
         backref=db.backref('followers', lazy='dynamic'), lazy='dynamic')
     
     def follow(self, user):
-        if not self.is_following(user):
-            self.followed.append(user)
+        if insert_ignore(followers, follower_id=self.id, followed_id=user.id):
+            increment_counter(self, 'following_count')
+            increment_counter(user, 'followers_count')
+            return True
+        return False
 
     def unfollow(self, user):
-        if self.is_following(user):
-            self.followed.remove(user)
+        if delete_row(followers, follower_id=self.id, followed_id=user.id):
+            increment_counter(self, 'following_count', -1)
+            increment_counter(user, 'followers_count', -1)
+            return True
+        return False
 
     def is_following(self, user):
         return self.followed.filter(
             followers.c.followed_id == user.id).count() > 0
+
+    def followed_user_ids(self, user_ids=None):
+        return _id_set(followers.c.followed_id, followers.c.follower_id == self.id, user_ids)
     
     def followed_posts(self):
-        # フォローしているユーザーの投稿を取得
-        followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.user_id)).filter(
-                followers.c.follower_id == self.id)
-        # 自分の投稿も取得
-        own = Post.query.filter_by(user_id=self.id)
-        # 2つのクエリを結合して返す
-        return followed.union(own)
+        # フォローしているユーザーのID
+        followed_ids = db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id)
+        # フォロー中のユーザーと自分の投稿を1つのクエリで取得
+        # (UNIONにしないので、timestampの索引を使ったキーセットページングができる)
+        return Post.query.filter(db.or_(
+            Post.user_id.in_(followed_ids), Post.user_id == self.id))
 
 
     # helper methods for making "like function"
     def like_post(self, post):
-        if not self.has_liked_post(post):
-            self.liked_posts.append(post)
+        if insert_ignore(likes, user_id=self.id, post_id=post.id):
+            increment_counter(post, 'likes_count')
+            post.hot_score = hot_score_after(Post, 'like')
+            add_hot_score(Shop, post.shop_id, 'like')
+            return True
+        return False
 
     def unlike_post(self, post):
-        if self.has_liked_post(post):
-            self.liked_posts.remove(post)
+        if delete_row(likes, user_id=self.id, post_id=post.id):
+            increment_counter(post, 'likes_count', -1)
+            post.hot_score = hot_score_after(Post, 'like', -1)
+            add_hot_score(Shop, post.shop_id, 'like', -1)
+            return True
+        return False
 
     def has_liked_post(self, post):
         return self.liked_posts.filter(likes.c.post_id == post.id).count() > 0
+
+    def liked_post_ids(self, post_ids=None):
+        return _id_set(likes.c.post_id, likes.c.user_id == self.id, post_ids)
     
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -97,13 +233,36 @@ class User(UserMixin, db.Model):
     
     def __repr__(self):
         return f'<User {self.username}>'
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _mark_changed_user(mapper, connection, target):
+    # プロフィールやカウンタが変わったら、次のリクエストでDBから読み直す
+    # (flush の時点で消すと、commit までの間に読まれた古い行がキャッシュに入り直すので、commit の後で消す)
+    object_session(target).info.setdefault('changed_user_ids', set()).add(target.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_cached_users(session):
+    cache = get_user_cache()
+    for user_id in session.info.pop('changed_user_ids', ()):
+        cache.invalidate(user_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changed_users(session):
+    session.info.pop('changed_user_ids', None)
     
 
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True, nullable=False)
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=lambda: datetime.now(timezone.utc), nullable=False)
-    image_filename = db.Column(db.String(128), nullable = False) # 画像ファイル名を保存するカラム
+    # 画像ファイル名を保存するカラム (内容のハッシュ。同じ画像の投稿は同じファイルを参照する)
+    image_filename = db.Column(db.String(128), nullable = False, index=True)
+    # 縮小版のファイル名と大きさ (app/images.py が作成するまでは None)
+    variants = db.Column(db.JSON)
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', name='fk_post_user_id'), nullable=False)
     shop_id = db.Column(db.Integer, db.ForeignKey('shop.id', name='fk_post_shop_id'), nullable=False)
@@ -112,13 +271,30 @@ class Post(db.Model):
     shop = db.relationship('Shop', back_populates='posts')
 
     # likers
-    likers = db.relationship('User', secondary=likes, back_populates='liked_posts', lazy='dynamic', cascade="all, delete")
+    # (secondaryの関係なので、投稿を削除すると likes の行だけが削除される)
+    likers = db.relationship('User', secondary=likes, back_populates='liked_posts', lazy='dynamic')
     comments = db.relationship('Comment', back_populates='post', lazy='dynamic', cascade='all, delete-orphan')
 
+    likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comments_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 時間で減衰する人気のスコア (app/trending.py)
+    hot_score = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+
+    # ユーザー・お店ごとの新しい順の一覧 (キーセットページング) と、人気順の一覧用
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_post_shop_id_timestamp', 'shop_id', 'timestamp', 'id'),
+        db.Index('ix_post_hot_score', 'hot_score', 'id'),
+    )
 
     def __repr__(self):
         return f'<Post {self.body}>'
 
+def _shop_grid_cell(context):
+    params = context.get_current_parameters()
+    return grid_cell(params['latitude'], params['longitude'])
+
+
 class Shop(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     # save OSM_ID to prevent from dual registration
@@ -126,6 +302,8 @@ class Shop(db.Model):
     name = db.Column(db.String(128), nullable=False)
     latitude = db.Column(db.Float, nullable=False)
     longitude = db.Column(db.Float, nullable=False)
+    # 表示範囲での検索用 (app/geo.py のセル番号)。索引は下の ix_shop_geocell_hot_score
+    geocell = db.Column(db.Integer, nullable=False, default=_shop_grid_cell)
 
 
     # make relation with posts
@@ -134,10 +312,44 @@ class Shop(db.Model):
     # with bookmarks
     bookmarked_by = db.relationship('User', secondary = bookmarks, back_populates='bookmarked_shops', lazy='dynamic')
 
+    posts_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    bookmarks_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # 時間で減衰する人気のスコア (app/trending.py)。近くの人気店はセルの範囲をこの順に読む
+    hot_score = db.Column(db.Float, nullable=False, default=0.0, server_default='0')
+
+    __table_args__ = (
+        db.Index('ix_shop_hot_score', 'hot_score', 'id'),
+        db.Index('ix_shop_geocell_hot_score', 'geocell', 'hot_score'),
+    )
+
     def __repr__(self):
         return f'<Shop {self.name}>'
+
+
+class TrendingDecay(db.Model):
+    # hot_score を最後に減衰させた時刻 (1行だけ)
+    id = db.Column(db.Integer, primary_key=True)
+    decayed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<TrendingDecay {self.decayed_at}>'
     
 
+class FeedItem(db.Model):
+    # フォロー中タイムラインの配信先 (user_id のタイムラインに post_id を表示する)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', name='fk_feed_item_user_id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', name='fk_feed_item_post_id'), primary_key=True)
+    # 並び替え用に投稿の timestamp をコピーしておく
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_feed_item_user_id_timestamp', 'user_id', 'timestamp', 'post_id'),
+    )
+
+    def __repr__(self):
+        return f'<FeedItem {self.user_id} {self.post_id}>'
+
+
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140), nullable=False)
@@ -149,5 +361,51 @@ class Comment(db.Model):
     author = db.relationship('User', back_populates='comments')
     post = db.relationship('Post', back_populates='comments')
 
+    __table_args__ = (
+        db.Index('ix_comment_post_id_timestamp', 'post_id', 'timestamp', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<Comment {self.body}>'
+
+
+class Poi(db.Model):
+    # OSMの抽出ファイルから取り込んだお店 (`flask poi-import`、検索は app/poi.py)
+    # node と way のIDは重なることがあるので、主キーは osm_id * 4 + 種類
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    osm_id = db.Column(db.BigInteger, index=True, nullable=False)
+    name = db.Column(db.String(256))
+    # 名称検索用 (NFKC + 小文字)
+    name_normalized = db.Column(db.String(256))
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    geocell = db.Column(db.Integer, index=True, nullable=False)
+
     def __repr__(self):
-        return f'<Comment {self.body}>'
\ No newline at end of file
+        return f'<Poi {self.name}>'
+
+
+class PoiCategory(db.Model):
+    # お店のカテゴリ ('amenity=cafe', 'cuisine=ramen' など)
+    # 主キーの順で、カテゴリとセル範囲の検索が索引だけで絞り込める
+    __tablename__ = 'poi_category'
+    category = db.Column(db.String(64), primary_key=True)
+    geocell = db.Column(db.Integer, primary_key=True)
+    poi_id = db.Column(db.BigInteger, db.ForeignKey('poi.id', name='fk_poi_category_poi_id'), primary_key=True)
+
+    __table_args__ = (
+        db.Index('ix_poi_category_poi_id', 'poi_id'),
+    )
+
+
+class PoiImport(db.Model):
+    # 取り込んだ範囲。この中の検索は Overpass に問い合わせずに poi テーブルで答える
+    __tablename__ = 'poi_import'
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(256), nullable=False)
+    south = db.Column(db.Float, nullable=False)
+    west = db.Column(db.Float, nullable=False)
+    north = db.Column(db.Float, nullable=False)
+    east = db.Column(db.Float, nullable=False)
+    poi_count = db.Column(db.Integer, nullable=False, default=0)
+    imported_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+from math import exp2, log1p
+from flask import current_app
+from app.geo import EARTH_RADIUS_KM, bbox_filter, haversine, radius_bbox
+from app.models import Post, Shop
+from app.pagination import encode_score_cursor, decode_score_cursor
+
+try:
+    import numpy as np
+except ImportError:  # numpy が無い環境では1件ずつ計算する
+    np = None
+
+
+def haversine_many(lat, lon, lats, lons):
+    """1地点から複数地点までの距離 (km) を numpy でまとめて計算する"""
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def _candidates(query, lat, lon, now):
+    config = current_app.config
+    since = now - timedelta(days=config['GEO_FEED_DAYS'])
+    south, west, north, east = radius_bbox(lat, lon, config['GEO_FEED_RADIUS_KM'])
+    # now より後の投稿は、次のページまで含めないでおく (カーソルの並びがずれないように)
+    return query.join(Post.shop) \
+        .filter(Post.timestamp >= since, Post.timestamp <= now,
+                bbox_filter(Shop.latitude, Shop.longitude, Shop.geocell, south, west, north, east)) \
+        .order_by(Post.timestamp.desc(), Post.id.desc()) \
+        .limit(config['GEO_FEED_MAX_CANDIDATES']) \
+        .with_entities(Post.id, Post.timestamp, Post.likes_count, Shop.latitude, Shop.longitude) \
+        .all()
+
+
+def score_nearby_posts(query, lat, lon, now):
+    """
+    Score recent posts around (lat, lon) as of `now` and return
+    (score, id) pairs, best first (ties go to the higher id).
+
+    Candidates are narrowed in SQL to the recent window and a bounding box
+    around the point. Each one is then scored as
+
+        recency * proximity * (1 + log(1 + likes))
+
+    where recency halves every GEO_FEED_HALF_LIFE_HOURS and proximity halves
+    at GEO_FEED_DISTANCE_SCALE_KM. The scores are computed for all
+    candidates at once with numpy.
+    """
+    rows = _candidates(query, lat, lon, now)
+    if not rows:
+        return []
+    config = current_app.config
+    half_life = config['GEO_FEED_HALF_LIFE_HOURS']
+    distance_scale = config['GEO_FEED_DISTANCE_SCALE_KM']
+    ids, timestamps, likes, lats, lons = zip(*rows)
+
+    if np is None:
+        scores = [
+            exp2(-(now - timestamp).total_seconds() / 3600 / half_life)
+            / (1 + haversine(lon, lat, shop_lon, shop_lat) / distance_scale)
+            * (1 + log1p(like_count))
+            for timestamp, like_count, shop_lat, shop_lon in zip(timestamps, likes, lats, lons)
+        ]
+        return sorted(zip(scores, ids), reverse=True)
+
+    distances = haversine_many(lat, lon, np.array(lats), np.array(lons))
+    age_hours = (np.datetime64(now, 'us') - np.array(timestamps, dtype='datetime64[us]')) / np.timedelta64(1, 'h')
+    scores = np.exp2(-age_hours / half_life) / (1 + distances / distance_scale) * (1 + np.log1p(np.array(likes)))
+    # lexsort は最後のキーが優先 (スコアの高い順、同点は id の大きい順)
+    order = np.lexsort((-np.array(ids), -scores))
+    return [(float(scores[i]), ids[i]) for i in order]
+
+
+def rank_nearby_posts(query, lat, lon, now=None):
+    """Ids of the posts around (lat, lon), best first (see score_nearby_posts)."""
+    return [post_id for _, post_id in score_nearby_posts(query, lat, lon, now or datetime.utcnow())]
+
+
+def nearby_page(query, lat, lon, cursor, per_page):
+    """
+    Return the ids for one page of the nearby ranking and the cursor for
+    the next page (None on the last page).
+
+    The cursor keeps the time the first page was ranked at and the
+    (score, id) of the last post shown. Later pages are scored as of that
+    same time, and continue strictly after that key, so new posts and the
+    candidate window moving on cannot shift the later pages. Only a post
+    whose like count changes while the pages are read can cross the key.
+    """
+    if cursor:
+        now, last_score, last_id = decode_score_cursor(cursor)
+    else:
+        now, last_score, last_id = datetime.utcnow(), None, None
+    ranked = score_nearby_posts(query, lat, lon, now)
+    if last_id is not None:
+        ranked = [key for key in ranked if key < (last_score, last_id)]
+    page = ranked[:per_page]
+    next_cursor = encode_score_cursor(now, *page[-1]) if len(ranked) > per_page else None
+    return [post_id for _, post_id in page], next_cursor
@@ -0,0 +1,245 @@
+"""
+Overpass APIの検索結果キャッシュ
+
+検索範囲 (bbox) を OVERPASS_TILE_DEGREES 間隔の格子 (タイル) に揃え、
+(キーワード, タイル) ごとに GeoJSON の Feature を保存する。保存先はローカルの
+SQLiteファイルなので、全てのワーカープロセスで共有される。
+投稿時のお店の確認用に、取得した Feature を osm_id でも引けるようにしている。
+期限切れのタイルも OVERPASS_CACHE_STALE_TTL までは残しておき、
+Overpass が落ちている間はそれを返す。
+"""
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from math import floor
+from flask import current_app
+from app.geo import parse_bbox
+from app.upstream import UpstreamError
+
+
+def normalize_keyword(keyword):
+    """全角/半角・大文字/小文字の違いでキャッシュが分かれないようにする"""
+    return unicodedata.normalize('NFKC', keyword).strip().lower()
+
+
+class OverpassCache:
+    def __init__(self, path, ttl, max_entries, stale_ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.stale_ttl = max(ttl, stale_ttl or ttl)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS tile ('
+                         'keyword TEXT NOT NULL, tile TEXT NOT NULL, features TEXT NOT NULL, '
+                         'fetched_at REAL NOT NULL, accessed_at REAL NOT NULL, '
+                         'PRIMARY KEY (keyword, tile))')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_tile_accessed_at ON tile (accessed_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS feature ('
+                         'osm_id INTEGER PRIMARY KEY, name TEXT, latitude REAL NOT NULL, '
+                         'longitude REAL NOT NULL, fetched_at REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS geocode ('
+                         'query TEXT PRIMARY KEY, result TEXT NOT NULL, fetched_at REAL NOT NULL)')
+
+    def _connection(self):
+        # sqlite3 の接続はスレッドごとに持つ
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, hits, misses, stale_hits=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.stale_hits += stale_hits
+
+    def get_tiles(self, keyword, tiles, stale=False):
+        """
+        有効期限内のタイルを {tile: features} で返す
+        stale=True の場合は、期限切れでもまだ残っているタイルを返す (上流の障害時用)
+        """
+        now = time.time()
+        max_age = self.stale_ttl if stale else self.ttl
+        conn = self._connection()
+        found = {}
+        # SQLiteの変数の上限に収まるように分けて問い合わせる
+        for start in range(0, len(tiles), 500):
+            chunk = tiles[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = conn.execute(f'SELECT tile, features FROM tile WHERE keyword = ? AND tile IN ({placeholders}) '
+                                'AND fetched_at > ?', [keyword, *chunk, now - max_age]).fetchall()
+            found.update((tile, json.loads(features)) for tile, features in rows)
+        if found:
+            with conn:
+                conn.executemany('UPDATE tile SET accessed_at = ? WHERE keyword = ? AND tile = ?',
+                                 [(now, keyword, tile) for tile in found])
+        if stale:
+            self._count(0, 0, len(found))
+        else:
+            self._count(len(found), len(tiles) - len(found))
+        return found
+
+    def put_tiles(self, keyword, features_by_tile):
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO tile (keyword, tile, features, fetched_at, accessed_at) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             [(keyword, tile, json.dumps(features, ensure_ascii=False), now, now)
+                              for tile, features in features_by_tile.items()])
+            conn.executemany('INSERT OR REPLACE INTO feature (osm_id, name, latitude, longitude, fetched_at) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             [(feature['properties']['osm_id'], feature['properties'].get('name'),
+                               feature['geometry']['coordinates'][1], feature['geometry']['coordinates'][0], now)
+                              for features in features_by_tile.values() for feature in features])
+            self._evict(conn, now)
+
+    def lookup_feature(self, osm_id):
+        """最近の検索結果に含まれていたお店を osm_id で探す (無ければ None)"""
+        row = self._connection().execute(
+            'SELECT name, latitude, longitude FROM feature WHERE osm_id = ? AND fetched_at > ?',
+            (osm_id, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        return {'osm_id': osm_id, 'name': row[0], 'latitude': row[1], 'longitude': row[2]}
+
+    def get_geocode(self, query, stale=False):
+        max_age = self.stale_ttl if stale else self.ttl
+        row = self._connection().execute(
+            'SELECT result FROM geocode WHERE query = ? AND fetched_at > ?',
+            (query, time.time() - max_age)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_geocode(self, query, result):
+        with self._connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO geocode (query, result, fetched_at) VALUES (?, ?, ?)',
+                         (query, json.dumps(result, ensure_ascii=False), time.time()))
+
+    def _evict(self, conn, now):
+        """古すぎるタイルと、上限を超えた分の最近使われていないタイルを削除する"""
+        conn.execute('DELETE FROM tile WHERE fetched_at <= ?', (now - self.stale_ttl,))
+        conn.execute('DELETE FROM feature WHERE fetched_at <= ?', (now - self.ttl,))
+        conn.execute('DELETE FROM geocode WHERE fetched_at <= ?', (now - self.stale_ttl,))
+        (count,) = conn.execute('SELECT COUNT(*) FROM tile').fetchone()
+        if count > self.max_entries:
+            conn.execute('DELETE FROM tile WHERE rowid IN '
+                         '(SELECT rowid FROM tile ORDER BY accessed_at LIMIT ?)', (count - self.max_entries,))
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute('DELETE FROM tile')
+            conn.execute('DELETE FROM feature')
+            conn.execute('DELETE FROM geocode')
+
+    def stats(self):
+        (entries, size) = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(features)), 0) FROM tile').fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def get_cache():
+    cache = current_app.extensions.get('overpass_cache')
+    if cache is None:
+        config = current_app.config
+        cache = OverpassCache(config['OVERPASS_CACHE_PATH'], config['OVERPASS_CACHE_TTL'],
+                              config['OVERPASS_CACHE_MAX_ENTRIES'], config['OVERPASS_CACHE_STALE_TTL'])
+        current_app.extensions['overpass_cache'] = cache
+    return cache
+
+
+def _tile_of(latitude, longitude, size):
+    return floor(latitude / size), floor(longitude / size)
+
+
+def _feature_lat_lon(feature):
+    longitude, latitude = feature['geometry']['coordinates']
+    return latitude, longitude
+
+
+def cached_search(keyword, bbox, fetch):
+    """
+    Return GeoJSON features for `keyword` inside `bbox`, serving whole
+    tiles from the cache when possible.
+
+    `fetch(keyword, bbox)` is called at most once, for the smallest
+    tile-aligned rectangle that covers the missing tiles. Its features
+    are split per tile and stored, including tiles that came back empty.
+    Boxes covering more than OVERPASS_CACHE_MAX_TILES_PER_QUERY tiles go
+    straight to `fetch`.
+
+    If `fetch` raises UpstreamError, expired tiles still in the cache are
+    served instead; the error propagates only when none are available.
+    Results marked `incomplete` (Overpass stopped with a runtime error)
+    are returned but not stored.
+    """
+    keyword = normalize_keyword(keyword)
+    south, west, north, east = parse_bbox(bbox)
+    size = current_app.config['OVERPASS_TILE_DEGREES']
+    first_row, first_col = _tile_of(south, west, size)
+    last_row, last_col = _tile_of(north, east, size)
+    tile_count = (last_row - first_row + 1) * (last_col - first_col + 1)
+    if west > east or tile_count > current_app.config['OVERPASS_CACHE_MAX_TILES_PER_QUERY']:
+        return fetch(keyword, bbox)
+
+    cache = get_cache()
+    tiles = [f'{row}:{col}' for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1)]
+    features_by_tile = cache.get_tiles(keyword, tiles)
+    missing = [tuple(map(int, tile.split(':'))) for tile in tiles if tile not in features_by_tile]
+    if missing:
+        rows = [row for row, _ in missing]
+        cols = [col for _, col in missing]
+        fetched_bbox = ','.join(str(round(value, 6)) for value in (
+            min(rows) * size, min(cols) * size, (max(rows) + 1) * size, (max(cols) + 1) * size))
+        try:
+            fetched_features = fetch(keyword, fetched_bbox)
+        except UpstreamError:
+            stale = cache.get_tiles(keyword, [f'{row}:{col}' for row, col in missing], stale=True)
+            if not stale:
+                raise
+            current_app.logger.warning('Overpass unavailable, serving %d stale tiles for %r', len(stale), keyword)
+            features_by_tile.update(stale)
+        else:
+            fetched = {f'{row}:{col}': [] for row in range(min(rows), max(rows) + 1)
+                       for col in range(min(cols), max(cols) + 1)}
+            for feature in fetched_features:
+                latitude, longitude = _feature_lat_lon(feature)
+                if latitude is None or longitude is None:
+                    continue
+                row, col = _tile_of(latitude, longitude, size)
+                fetched.setdefault(f'{row}:{col}', []).append(feature)
+            # 上限で打ち切られた結果や、Overpassが途中で止まった結果はタイルの中身が欠けているので保存しない
+            if len(fetched_features) < current_app.config['OVERPASS_MAX_FEATURES'] \
+                    and not getattr(fetched_features, 'incomplete', False):
+                cache.put_tiles(keyword, fetched)
+            features_by_tile.update(fetched)
+
+    # 要求された範囲に入るものだけを、重複なしで返す
+    features, seen = [], set()
+    for tile in tiles:
+        for feature in features_by_tile.get(tile, []):
+            latitude, longitude = _feature_lat_lon(feature)
+            osm_id = feature['properties'].get('osm_id')
+            if latitude is None or longitude is None:
+                continue
+            if south <= latitude <= north and west <= longitude <= east and osm_id not in seen:
+                seen.add(osm_id)
+                features.append(feature)
+    return features
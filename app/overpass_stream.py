@@ -0,0 +1,145 @@
+"""
+Overpass APIの応答の逐次パース
+
+応答の本文をチャンクごとに読み、"elements" の配列の要素を1件ずつ
+json.JSONDecoder.raw_decode で取り出す。地図で使う値 (名前・osm_id・座標) だけの
+Feature に変換し、上限の件数に達したら残りは読まずに接続を閉じる。
+応答全体の文字列も、元の要素のリストも作らないので、範囲が広くても
+メモリ使用量は 上限の件数 + 1チャンク 程度で済む。
+
+Overpassはクエリが時間切れやメモリ不足で止まっても HTTP 200 を返し、配列の後の
+"remark" に "runtime error: ..." を書く (それまでの要素は途中までしかない)。
+最後まで読んだ応答では remark も読んで、呼び出し元に返す。
+"""
+import codecs
+import json
+import re
+from app.geojson import point_feature
+
+CHUNK_SIZE = 64 * 1024
+
+# 1件の要素がこれより大きい場合は、壊れた応答とみなす (文字数)
+MAX_ELEMENT_SIZE = 1024 * 1024
+
+_ELEMENTS = re.compile(r'"elements"\s*:\s*\[')
+_SEPARATOR = re.compile(r'[\s,]*')
+_REMARK = re.compile(r'"remark"\s*:\s*')
+
+
+class Features(list):
+    """読んだ Feature のリスト。応答の "remark" があれば remark に入れる"""
+    remark = None
+
+    @property
+    def incomplete(self):
+        """Overpassが実行時エラーで止まり、要素が途中までしかない"""
+        return self.remark is not None and 'runtime error' in self.remark
+
+
+def iter_elements(chunks):
+    """
+    Yield the members of the "elements" array of an Overpass JSON body
+    given as an iterable of byte chunks, decoding one element at a time.
+    The generator returns the body's "remark" (or None) once the array
+    has been read. Raises ValueError if the body is not valid Overpass JSON.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer, position, started = '', 0, False
+    chunks = iter(chunks)
+    while True:
+        chunk = next(chunks, None)
+        final = chunk is None
+        buffer = buffer[position:] + utf8.decode(chunk or b'', final=final)
+        position = 0
+        if not started:
+            match = _ELEMENTS.search(buffer)
+            if match is None:
+                if final:
+                    raise ValueError('no "elements" in the Overpass response')
+                continue
+            position, started = match.end(), True
+        while True:
+            position = _SEPARATOR.match(buffer, position).end()
+            if buffer.startswith(']', position):
+                return _read_remark(buffer[position + 1:], chunks, utf8, decoder)
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # 要素の途中でチャンクが切れている
+                if final or len(buffer) - position > MAX_ELEMENT_SIZE:
+                    raise
+                break
+            yield element
+
+
+def _read_remark(rest, chunks, utf8, decoder):
+    """配列の後ろ (remark などの短いメンバーだけ) を読み、remark の文字列を返す"""
+    for chunk in chunks:
+        rest += utf8.decode(chunk)
+        if len(rest) > MAX_ELEMENT_SIZE:
+            break
+    rest += utf8.decode(b'', final=True)
+    match = _REMARK.search(rest)
+    if match is None:
+        return None
+    try:
+        remark, _ = decoder.raw_decode(rest, match.end())
+    except json.JSONDecodeError:
+        return None
+    return remark if isinstance(remark, str) else None
+
+
+def element_feature(element):
+    """地図で使うプロパティ (name, osm_id) だけのFeatureにする (座標が無ければ None)"""
+    if element.get('type') == 'node':
+        latitude, longitude = element.get('lat'), element.get('lon')
+    else:
+        center = element.get('center') or {}
+        latitude, longitude = center.get('lat'), center.get('lon')
+    if latitude is None or longitude is None:
+        return None
+    return point_feature(longitude, latitude, {'name': (element.get('tags') or {}).get('name'),
+                                               'osm_id': element.get('id')})
+
+
+def iter_features(chunks, limit):
+    """
+    Yield up to `limit` features. The generator returns the body's
+    "remark" when the whole body was read, and None when it stopped at
+    `limit`.
+    """
+    if limit <= 0:
+        return None
+    elements = iter_elements(chunks)
+    count = 0
+    while True:
+        try:
+            element = next(elements)
+        except StopIteration as stop:
+            return stop.value
+        feature = element_feature(element)
+        if feature is not None:
+            yield feature
+            count += 1
+            if count >= limit:
+                return None
+
+
+def read_features(response, limit):
+    """
+    Read at most `limit` features from a streamed (stream=True) Overpass
+    response into a Features list and close it, leaving the rest of the
+    body unread.
+    """
+    features = Features()
+    try:
+        iterator = iter_features(response.iter_content(CHUNK_SIZE), limit)
+        while True:
+            try:
+                features.append(next(iterator))
+            except StopIteration as stop:
+                features.remark = stop.value
+                return features
+    finally:
+        response.close()
@@ -0,0 +1,67 @@
+import base64
+from datetime import datetime
+from math import isfinite
+from sqlalchemy import and_, or_
+from app.models import Post
+
+
+def encode_cursor(post):
+    """投稿の (timestamp, id) を不透明なカーソル文字列にする"""
+    raw = f'{post.timestamp.isoformat()}|{post.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """カーソル文字列を (timestamp, id) に戻す。不正な値は ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, post_id = base64.urlsafe_b64decode(padded).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(post_id)
+    except (UnicodeDecodeError, ValueError, TypeError) as e:
+        raise ValueError(f'invalid cursor: {cursor!r}') from e
+
+
+def after_cursor(query, cursor, timestamp_column=Post.timestamp, id_column=Post.id):
+    """Restrict a query to rows that sort after `cursor` in (timestamp, id) DESC order."""
+    timestamp, post_id = decode_cursor(cursor)
+    # timestamp <= ? で索引の範囲を絞り、同時刻の投稿は id で切る
+    return query.filter(timestamp_column <= timestamp, or_(
+        timestamp_column < timestamp, and_(timestamp_column == timestamp, id_column < post_id)))
+
+
+def keyset_page(query, cursor, per_page):
+    """
+    Return one page of `query` ordered by (timestamp, id) DESC and the
+    cursor for the next page (None on the last page).
+
+    The page is located with an index range seek from the cursor instead of
+    OFFSET, and one extra row is fetched instead of running COUNT, so the
+    cost per page does not grow with scroll depth.
+    """
+    if cursor:
+        query = after_cursor(query, cursor)
+    posts = query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(per_page + 1).all()
+    next_cursor = encode_cursor(posts[per_page - 1]) if len(posts) > per_page else None
+    return posts[:per_page], next_cursor
+
+
+def encode_score_cursor(reference, score, post_id):
+    """スコア順の並び (近くの投稿) のカーソル。スコアを計算した時刻と、最後の投稿の (score, id)"""
+    raw = f'~{reference.isoformat()}|{score!r}|{post_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_score_cursor(cursor):
+    """カーソル文字列を (reference, score, id) に戻す。不正な値は ValueError"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded).decode()
+        if not raw.startswith('~'):
+            raise ValueError
+        reference, score, post_id = raw[1:].split('|')
+        score = float(score)
+        if not isfinite(score):
+            raise ValueError
+        return datetime.fromisoformat(reference), score, int(post_id)
+    except (UnicodeDecodeError, ValueError, TypeError) as e:
+        raise ValueError(f'invalid cursor: {cursor!r}') from e
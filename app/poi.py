@@ -0,0 +1,297 @@
+"""
+OSMの抽出ファイルから取り込んだお店 (POI) の検索
+
+`flask poi-import` で GeoJSON / GeoJSON Lines / PBF から poi テーブルに取り込み、
+地図の検索 (/api/osm_search, /search_shops) はまずここから答える。
+取り込んだ範囲 (poi_import、抽出ファイルの境界) に検索範囲が含まれていない場合・
+その取り込みが POI_MAX_AGE_DAYS より古い場合・1件も見つからない場合は Overpass に問い合わせる。
+"""
+import json
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy import delete, insert, select
+from app import db
+from app.geo import bbox_filter, grid_cell, parse_bbox
+from app.geojson import point_feature
+from app.models import Poi, PoiCategory, PoiImport
+from app.overpass_cache import normalize_keyword
+
+try:
+    import osmium
+except ImportError:  # PBFを読むときだけ必要 (pip install osmium)
+    osmium = None
+
+# 一般的なカテゴリキーワードと、対応するOSMのタグ (key, value)
+CATEGORY_KEYWORDS = {
+    'カフェ': ('amenity', 'cafe'),
+    'レストラン': ('amenity', 'restaurant'),
+    'パン': ('shop', 'bakery'),
+    '居酒屋': ('amenity', 'izakaya'),
+    'バー': ('amenity', 'bar'),
+    'ラーメン': ('cuisine', 'ramen'),
+    '和食': ('cuisine', 'japanese'),
+    'イタリアン': ('cuisine', 'italian'),
+    'フレンチ': ('cuisine', 'french'),
+    '中華': ('cuisine', 'chinese'),
+    '寿司': ('cuisine', 'sushi'),
+    'カレー': ('cuisine', 'curry'),
+}
+
+# これらのタグを持つものをお店として取り込み、値をカテゴリとして索引に入れる
+CATEGORY_KEYS = ('amenity', 'shop', 'cuisine')
+
+OSM_TYPES = {'node': 0, 'way': 1, 'relation': 2}
+
+
+def poi_id(osm_type, osm_id):
+    """node と way のIDは重なることがあるので、種類を含めた主キーにする"""
+    return osm_id * 4 + OSM_TYPES[osm_type]
+
+
+def categories(tags):
+    """タグからカテゴリ ('amenity=cafe' など) を取り出す (cuisine=ramen;japanese は2つ)"""
+    return {f'{key}={value.strip()}' for key in CATEGORY_KEYS if key in tags
+            for value in str(tags[key]).split(';') if value.strip()}
+
+
+def _centroid(coordinates):
+    """GeoJSONの座標の入れ子から、点の平均を (経度, 緯度) で返す"""
+    points = []
+    stack = [coordinates]
+    while stack:
+        value = stack.pop()
+        if value and isinstance(value[0], (int, float)):
+            points.append(value)
+        else:
+            stack.extend(value)
+    if not points:
+        return None, None
+    return sum(p[0] for p in points) / len(points), sum(p[1] for p in points) / len(points)
+
+
+def _osm_identity(feature):
+    """osmium export ('n123'), Overpass turbo ('node/123'), '@type'/'@id' のどれかからIDを読む"""
+    properties = feature.get('properties') or {}
+    if '@type' in properties and '@id' in properties:
+        return properties['@type'], int(properties['@id'])
+    raw = str(feature.get('id') or properties.get('id') or '')
+    if '/' in raw:
+        osm_type, osm_id = raw.split('/', 1)
+        return osm_type, int(osm_id)
+    if raw[:1] in ('n', 'w', 'r') and raw[1:].isdigit():
+        return {'n': 'node', 'w': 'way', 'r': 'relation'}[raw[0]], int(raw[1:])
+    if 'osm_id' in properties:
+        return 'node', int(properties['osm_id'])
+    return None, None
+
+
+def _record(osm_type, osm_id, tags, longitude, latitude):
+    if osm_type not in OSM_TYPES or osm_id is None or latitude is None:
+        return None
+    found = categories(tags)
+    if not found:
+        return None
+    name = tags.get('name')
+    return {
+        'id': poi_id(osm_type, osm_id),
+        'osm_id': osm_id,
+        'name': name,
+        'name_normalized': normalize_keyword(name) if name else None,
+        'latitude': latitude,
+        'longitude': longitude,
+        'geocell': grid_cell(latitude, longitude),
+        'categories': found,
+    }
+
+
+def _features_from_geojson(file):
+    # FeatureCollection 全体か、1行に1つの Feature (GeoJSON Lines / RFC 8142) のどちらか
+    first = file.read(1)
+    file.seek(0)
+    if first == '{' and not file.readline().rstrip().endswith('}'):
+        file.seek(0)
+        yield from json.load(file).get('features', [])
+        return
+    file.seek(0)
+    for line in file:
+        line = line.strip().lstrip('\x1e')
+        if not line:
+            continue
+        document = json.loads(line)
+        if document.get('type') == 'FeatureCollection':
+            yield from document.get('features', [])
+        else:
+            yield document
+
+
+def read_geojson(path):
+    with open(path, encoding='utf-8') as file:
+        for feature in _features_from_geojson(file):
+            geometry = feature.get('geometry') or {}
+            longitude, latitude = _centroid(geometry.get('coordinates') or [])
+            osm_type, osm_id = _osm_identity(feature)
+            record = _record(osm_type, osm_id, feature.get('properties') or {}, longitude, latitude)
+            if record is not None:
+                yield record
+
+
+def _geojson_bounds(path):
+    with open(path, encoding='utf-8') as file:
+        first = file.read(1)
+        file.seek(0)
+        if first == '{' and not file.readline().rstrip().endswith('}'):
+            file.seek(0)
+            document = json.load(file)
+        else:
+            # GeoJSON Lines は最初の行 (FeatureCollection 1つだけのファイルもこちら)
+            file.seek(0)
+            line = next((line.strip().lstrip('\x1e') for line in file if line.strip()), '')
+            document = json.loads(line) if line else {}
+    bbox = document.get('bbox') if isinstance(document, dict) else None
+    if not bbox or len(bbox) not in (4, 6):
+        return None
+    # RFC 7946 の bbox は [西, 南, (下), 東, 北, (上)]
+    half = len(bbox) // 2
+    west, south, east, north = bbox[0], bbox[1], bbox[half], bbox[half + 1]
+    return south, west, north, east
+
+
+def _pbf_bounds(path):
+    reader = osmium.io.Reader(path, osmium.osm.osm_entity_bits.NOTHING)
+    try:
+        box = reader.header().box()
+    finally:
+        reader.close()
+    if not box.valid():
+        return None
+    return box.bottom_left.lat, box.bottom_left.lon, box.top_right.lat, box.top_right.lon
+
+
+def extract_bounds(path):
+    """
+    The area the extract covers as (south, west, north, east): the
+    bounding box in the PBF header or the top-level GeoJSON "bbox", or
+    None if the file does not declare one.
+    """
+    if path.endswith('.pbf'):
+        if osmium is None:
+            raise RuntimeError('Reading .pbf files requires the osmium package (pip install osmium)')
+        return _pbf_bounds(path)
+    return _geojson_bounds(path)
+
+
+def read_pbf(path):
+    if osmium is None:
+        raise RuntimeError('Reading .pbf files requires the osmium package (pip install osmium)')
+    processor = osmium.FileProcessor(path).with_locations() \
+        .with_filter(osmium.filter.KeyFilter(*CATEGORY_KEYS))
+    for obj in processor:
+        tags = {tag.k: tag.v for tag in obj.tags}
+        if obj.is_node():
+            record = _record('node', obj.id, tags, obj.location.lon, obj.location.lat)
+        elif obj.is_way():
+            locations = [node.location for node in obj.nodes if node.location.valid()]
+            if not locations:
+                continue
+            record = _record('way', obj.id, tags, sum(l.lon for l in locations) / len(locations),
+                             sum(l.lat for l in locations) / len(locations))
+        else:
+            continue
+        if record is not None:
+            yield record
+
+
+def _flush(batch):
+    ids = [record['id'] for record in batch]
+    # 取り込み直しの場合は、古い行を消してから入れる
+    db.session.execute(delete(PoiCategory).where(PoiCategory.poi_id.in_(ids)))
+    db.session.execute(delete(Poi).where(Poi.id.in_(ids)))
+    db.session.execute(insert(Poi), [{key: value for key, value in record.items() if key != 'categories'}
+                                     for record in batch])
+    db.session.execute(insert(PoiCategory), [
+        {'category': category, 'geocell': record['geocell'], 'poi_id': record['id']}
+        for record in batch for category in record['categories']])
+    db.session.commit()
+
+
+def import_pois(records, source, batch_size=10000, coverage=None):
+    """
+    Insert POI records in transactions of `batch_size` rows and record
+    the covered area in poi_import. `coverage` is the boundary of the
+    extract as (south, west, north, east) (see extract_bounds). Without
+    it no area is recorded: the extent of the POIs themselves would
+    claim the empty edges of the extract, so searches there keep going
+    to Overpass. Returns the number of POIs imported.
+    """
+    batch = []
+    count = 0
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            _flush(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        _flush(batch)
+        count += len(batch)
+    if coverage is not None:
+        db.session.add(PoiImport(source=source, south=coverage[0], west=coverage[1],
+                                 north=coverage[2], east=coverage[3], poi_count=count))
+        db.session.commit()
+    return count
+
+
+def _covered(south, west, north, east, since=None):
+    query = db.session.query(PoiImport.id).filter(
+        PoiImport.south <= south, PoiImport.west <= west,
+        PoiImport.north >= north, PoiImport.east >= east)
+    if since is not None:
+        query = query.filter(PoiImport.imported_at >= since)
+    return query.first() is not None
+
+
+def search_pois(keyword, bbox, limit, fresh_only=True):
+    """
+    Answer a map search from the imported POIs.
+
+    Returns a list of GeoJSON features (at most `limit`), or None when
+    the caller should ask Overpass instead: the box is not inside an
+    imported area, the import is older than POI_MAX_AGE_DAYS, or nothing
+    matched. With fresh_only=False older imports are used as well and an
+    empty list is returned as is (for when Overpass cannot be reached).
+    Category keywords match the tag; anything else is a case-insensitive
+    substring match on the name.
+    """
+    south, west, north, east = parse_bbox(bbox)
+    since = None
+    if fresh_only:
+        since = datetime.now(timezone.utc).replace(tzinfo=None) - \
+            timedelta(days=current_app.config['POI_MAX_AGE_DAYS'])
+    if west > east or not _covered(south, west, north, east, since):
+        return None
+    query = select(Poi.osm_id, Poi.name, Poi.latitude, Poi.longitude)
+    if keyword in CATEGORY_KEYWORDS:
+        key, value = CATEGORY_KEYWORDS[keyword]
+        # (category, geocell) の主キーで、カテゴリと範囲を同時に絞り込む
+        query = query.join(PoiCategory, PoiCategory.poi_id == Poi.id) \
+            .where(PoiCategory.category == f'{key}={value}',
+                   bbox_filter(Poi.latitude, Poi.longitude, PoiCategory.geocell, south, west, north, east))
+    else:
+        query = query.where(bbox_filter(Poi.latitude, Poi.longitude, Poi.geocell, south, west, north, east),
+                            Poi.name_normalized.contains(normalize_keyword(keyword), autoescape=True))
+    rows = db.session.execute(query.limit(limit))
+    features = [point_feature(longitude, latitude, {'name': name, 'osm_id': osm_id})
+                for osm_id, name, latitude, longitude in rows]
+    # 抽出ファイルに無い (取り込んだ後に開店した) お店は Overpass で探す
+    if fresh_only and not features:
+        return None
+    return features
+
+
+def lookup_poi(osm_id):
+    """取り込んだお店を osm_id で探す (find_known_shop 用、無ければ None)"""
+    row = db.session.execute(select(Poi.name, Poi.latitude, Poi.longitude)
+                             .where(Poi.osm_id == osm_id).limit(1)).first()
+    if row is None:
+        return None
+    return {'osm_id': osm_id, 'name': row.name, 'latitude': row.latitude, 'longitude': row.longitude}
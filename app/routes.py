@@ -1,24 +1,65 @@
 from app import app # appをインポート
-from flask import render_template, request, jsonify, redirect, flash, url_for
+from flask import render_template, request, jsonify, redirect, flash, url_for, abort, send_file
 import requests 
 from app.forms import LoginForm, RegistrationForm,PostForm, CommentForm
 from app import db
-from app.models import User, Shop, Post, Comment
+from app.models import User, Shop, Post, Comment, increment_counter, hot_score_after, add_hot_score
+from app.hydration import with_post_relations, hydrate_posts, serialize_post, load_posts
+from app.nearby import nearby_page, rank_nearby_posts
+from app.overpass_cache import cached_search, get_cache
+from app.shop_lookup import parse_shop_selection, find_known_shop, geocode, geocode_async
+from app.pagination import keyset_page
+from app import feed
+from app.geo import parse_bbox, bbox_filter, haversine, valid_point
+from app.upstream import UpstreamError, get_client
+from app.images import process_post_image_async, variant_sources, upload_url
+from app.storage import get_storage
+from app.geojson import geojson_response, point_feature, YIELD_PER
+from app.fragment_cache import render_post_card, invalidate_post_card, get_fragment_cache
+from app.user_cache import get_user_cache
+from app.write_behind import write_behind_enabled, get_write_behind, submit_toggle
+from app.metrics import metrics_response
+from app.database import use_replica
+from app import trending
+from app import search as search_index
+from app.poi import CATEGORY_KEYWORDS, search_pois
+from app.overpass_stream import read_features
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
 from flask_login import current_user, login_user, logout_user 
 import os
-import uuid
+import re
+import mimetypes
 from werkzeug.utils import secure_filename
-from werkzeug.exceptions import Forbidden
+from werkzeug.exceptions import Forbidden, RequestEntityTooLarge
 from flask_login import login_required
-from datetime import datetime, timedelta, timezone
-from math import radians, cos, sin, asin, sqrt
+
+def render_post_grid(query, template, **context):
+    """
+    Render one page of posts, newest first, for the grid pages.
+
+    Pages are addressed with the keyset cursor in ?cursor=..., so the cost
+    of a page does not depend on how many posts exist. With ?partial=1
+    only the cards and the "load more" link are returned, which main.js
+    appends to the grid for infinite scrolling.
+    """
+    try:
+        posts, next_cursor = keyset_page(with_post_relations(query), request.args.get('cursor'),
+                                         app.config['POSTS_PER_PAGE'])
+    except ValueError:
+        abort(400)
+    hydrate_posts(posts, current_user)
+    if request.args.get('partial'):
+        template = '_post_grid_page.html'
+    return render_template(template, posts=posts, next_cursor=next_cursor, **context)
+
 
 @app.route('/')
 @app.route('/index')
+@use_replica
 def index():
-    # from DB, all post data is obtained with time order
-    posts = Post.query.order_by(Post.timestamp.desc()).all()
-    return render_template('index.html', title='Home', posts=posts)
+    # from DB, the newest page of posts is obtained with time order
+    return render_post_grid(Post.query, 'index.html', title='Home')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -55,76 +96,74 @@ def map_page():
     return render_template('map.html', title='Map')
 
 
-def to_geojson(overpass_json):
-    """Overpass APIのJSONをGeoJSON FeatureCollection形式に変換するヘルパー関数"""
-    features = []
-    for element in overpass_json.get('elements', []):
-        properties = element.get('tags', {})
-
-        properties['osm_id'] = element.get('id')
-
-        
-        if element['type'] == 'node':
-            geometry = {
-                "type": "Point",
-                "coordinates": [element.get('lon'), element.get('lat')]
-            }
-        elif element['type'] == 'way' and 'center' in element:
-            geometry = {
-                "type": "Point",
-                "coordinates": [element['center'].get('lon'), element['center'].get('lat')]
-            }
-        else:
-            continue
-
-        feature = {
-            "type": "Feature",
-            "geometry": geometry,
-            "properties": properties
-        }
-        features.append(feature)
-
-    return {
-        "type": "FeatureCollection",
-        "features": features
-    }
-
-
-def build_query_based_on_keyword(keyword, bbox):
+def build_query_based_on_keyword(keyword, bbox, limit):
     """
     キーワードを解析し、カテゴリ検索か名称検索かを判断して
     Overpass APIのクエリを生成する
     """
-    # 一般的なカテゴリキーワードと、対応するOSMのタグ
-    CATEGORY_KEYWORDS = {
-        'カフェ': '["amenity"="cafe"]',
-        'レストラン': '["amenity"="restaurant"]',
-        'パン': '["shop"="bakery"]',
-        '居酒屋': '["amenity"="izakaya"]',
-        'バー': '["amenity"="bar"]',
-        'ラーメン': '["cuisine"="ramen"]',
-        '和食': '["cuisine"="japanese"]',
-        'イタリアン': '["cuisine"="italian"]',
-        'フレンチ': '["cuisine"="french"]',
-        '中華': '["cuisine"="chinese"]',
-        '寿司': '["cuisine"="sushi"]',
-        'カレー': '["cuisine"="curry"]',
-    }
-    
     # キーワードがカテゴリ辞書に完全一致するかチェック
     if keyword in CATEGORY_KEYWORDS:
-        tag = CATEGORY_KEYWORDS[keyword]
+        tag = '["%s"="%s"]' % CATEGORY_KEYWORDS[keyword]
         # カテゴリ検索の場合は、そのタグを持つ施設を検索
         query_part = f"node{tag}({bbox}); way{tag}({bbox});"
     else:
         # カテゴリでない場合は、名称でのあいまい検索
-        query_part = f'node["name"~"{keyword}",i]({bbox}); way["name"~"{keyword}",i]({bbox});'
+        # (正規表現の記号と " はエスケープして、入力がクエリを壊さないようにする)
+        pattern = re.sub(r'([\\.^$|?*+()\[\]{}])', r'\\\1', keyword)
+        pattern = pattern.replace('\\', '\\\\').replace('"', '\\"')
+        query_part = f'node["name"~"{pattern}",i]({bbox}); way["name"~"{pattern}",i]({bbox});'
         
+    # 件数の上限はOverpass側でも適用する (out center N)
     return f"""
         [out:json];
         ({query_part});
-        out center;
+        out center {limit};
+    """
+
+
+class OverpassError(UpstreamError):
+    pass
+
+
+def fetch_overpass_features(keyword, bbox):
+    """
+    Overpass APIに問い合わせて、GeoJSONのFeatureのリストを返す
+    (応答は逐次パースし、OVERPASS_MAX_FEATURES 件で打ち切る)
+    """
+    limit = app.config['OVERPASS_MAX_FEATURES']
+    overpass_query = build_query_based_on_keyword(keyword, bbox, limit)
+    try:
+        features = get_client('overpass').get_json(params={'data': overpass_query},
+                                                   parse=lambda response: read_features(response, limit))
+    except UpstreamError as e:
+        raise OverpassError(overpass_query) from e
+    if features.incomplete:
+        app.logger.warning('Overpass stopped early (%s) for %r', features.remark, keyword)
+        if not features:
+            # 空の結果は「お店が無い」ではないので、古いキャッシュや取り込み済みのPOIで答える
+            raise OverpassError(overpass_query)
+    return features
+
+
+def search_overpass(keyword, bbox):
+    """
+    bbox内の検索結果をGeoJSONで返す。取り込み済みのPOI (flask poi-import) で
+    答えられる範囲ならそれを使い、そうでなければキャッシュしながらOverpassに問い合わせる
+    (Overpassに失敗したときは、古い取り込みのPOIがあればそれで答える)
     """
+    limit = app.config['POI_MAX_FEATURES']
+    features = search_pois(keyword, bbox, limit)
+    if features is None:
+        try:
+            features = cached_search(keyword, bbox, fetch_overpass_features)
+        except OverpassError:
+            features = search_pois(keyword, bbox, limit, fresh_only=False)
+            if features is None:
+                raise
+    return {
+        "type": "FeatureCollection",
+        "features": features
+    }
 
 
 @app.route('/api/osm_search')
@@ -133,17 +172,15 @@ def osm_search():
     bbox = request.args.get('bbox')
     if not bbox: return jsonify({"error": "BBox is required"}), 400
 
-    overpass_query = build_query_based_on_keyword(keyword, bbox)
-    
-    api_url = app.config['OVERPASS_API_URL']
-    response = requests.get(api_url, params={'data': overpass_query})
-    
-    if response.status_code == 200:
-        data = response.json()
-        geojson = to_geojson(data) # to_geojsonヘルパー関数は必要です
-        return jsonify(geojson)
-    else:
+    try:
+        # 日付変更線をまたいだ地図の経度 (±180 を超える値) は、ここで範囲内に戻す
+        bbox = ','.join(str(value) for value in parse_bbox(bbox))
+        geojson = search_overpass(keyword, bbox)
+    except ValueError:
+        return jsonify({"error": "Invalid bbox"}), 400
+    except (OverpassError, requests.RequestException):
         return jsonify({"error": "Failed to fetch data from Overpass API"}), 500
+    return geojson_response(geojson['features'])
 
 
 @app.route('/search_shops')
@@ -154,26 +191,109 @@ def search_shops():
     if not bbox:
         return jsonify({"error": "BBox (bounding box) is required"}), 400
 
-    # Nominatimを使う新しい関数でクエリを構築
-    overpass_query = build_query_based_on_keyword(query_str, bbox)
-    
-    api_url = app.config['OVERPASS_API_URL']
-    response = requests.get(api_url, params={'data': overpass_query})
-    
-    if response.status_code == 200:
-        data = response.json()
-        geojson = to_geojson(data)
-        return jsonify(geojson)
-    else:
+    try:
+        geojson = search_overpass(query_str, bbox)
+    except ValueError:
+        return jsonify({"error": "Invalid bbox"}), 400
+    except OverpassError as e:
         return jsonify({
             "error": "Failed to fetch data from Overpass API",
-            "query": overpass_query
+            "query": str(e)
         }), 500
+    except requests.RequestException:
+        return jsonify({"error": "Failed to fetch data from Overpass API"}), 500
+    return geojson_response(geojson['features'])
+
+@app.route('/api/search')
+@use_replica
+def api_search():
+    """
+    投稿・コメント・お店の名前を全文検索する
+    ?q=検索語&type=post|comment|shop&limit=20
+    """
+    query = request.args.get('q', '').strip()
+    doc_type = request.args.get('type')
+    limit = max(1, min(request.args.get('limit', 20, type=int), 50))
+    if not query:
+        return jsonify({"error": "q is required"}), 400
+    if doc_type is not None and doc_type not in search_index.DOC_TYPES:
+        return jsonify({"error": "Invalid type"}), 400
+
+    hits = search_index.search(query, doc_type, limit)
+    # 種類ごとにまとめて1回ずつ読み込む
+    ids = {name: [doc_id for hit_type, doc_id, _ in hits if hit_type == name] for name in search_index.DOC_TYPES}
+    posts = {post.id: post for post in Post.query.filter(Post.id.in_(ids['post']))} if ids['post'] else {}
+    comments = {comment.id: comment for comment in Comment.query.filter(Comment.id.in_(ids['comment']))} \
+        if ids['comment'] else {}
+    shops = {shop.id: shop for shop in Shop.query.filter(Shop.id.in_(ids['shop']))} if ids['shop'] else {}
+
+    results = []
+    for hit_type, doc_id, score in hits:
+        if hit_type == 'post' and doc_id in posts:
+            results.append({'type': 'post', 'id': doc_id, 'text': posts[doc_id].body,
+                            'url': url_for('post_detail', post_id=doc_id), 'score': score})
+        elif hit_type == 'comment' and doc_id in comments:
+            comment = comments[doc_id]
+            results.append({'type': 'comment', 'id': doc_id, 'text': comment.body,
+                            'url': url_for('post_detail', post_id=comment.post_id), 'score': score})
+        elif hit_type == 'shop' and doc_id in shops:
+            results.append({'type': 'shop', 'id': doc_id, 'text': shops[doc_id].name,
+                            'url': url_for('shop_page', shop_id=doc_id), 'score': score})
+    return jsonify({"query": query, "results": results})
+
 
 @app.context_processor
 def inject_user():
     return dict(current_user=current_user)
 
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    """MAX_CONTENT_LENGTH を超えるアップロードは、本文を読み込む前に断る"""
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    if request.path.startswith('/api/'):
+        return jsonify({"error": f"File is too large (max {limit_mb} MB)"}), 413
+    flash(f'File is too large. Please choose an image up to {limit_mb} MB.')
+    return redirect(request.path)
+
+
+@app.route('/media/<name>')
+def media(name):
+    """STORAGE_BACKEND = 'objectstore' の画像を配信する (内容が変わらないので長くキャッシュさせる)"""
+    storage = get_storage()
+    if not storage.exists(name):
+        abort(404)
+    return send_file(storage.open(name), mimetype=mimetypes.guess_type(name)[0],
+                     max_age=365 * 24 * 60 * 60)
+
+# _post_image.html のマクロから使う
+app.add_template_global(variant_sources)
+app.add_template_global(upload_url)
+# _post_grid_page.html から使う (カードのHTMLはキャッシュされる)
+app.add_template_global(render_post_card, 'post_card')
+
+
+def cache_stats():
+    return {
+        'fragment_cache': get_fragment_cache().stats(),
+        'overpass_cache': get_cache().stats(),
+        'user_cache': get_user_cache().stats(),
+    }
+
+
+@app.route('/api/metrics')
+def metrics():
+    """キャッシュのヒット率などをJSONで返す"""
+    return jsonify({
+        **cache_stats(),
+        'write_behind': get_write_behind().stats() if write_behind_enabled() else None,
+    })
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """リクエスト・SQL・外部API・キャッシュの計測値 (Prometheus のテキスト形式)"""
+    return metrics_response(cache_stats(), get_write_behind().stats() if write_behind_enabled() else None)
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     form = RegistrationForm()
@@ -192,59 +312,54 @@ def register():
 def create_post():
     form = PostForm()
     if form.validate_on_submit():
-        # --- 1. 画像の保存処理 (変更なし) ---
-        image_file = form.image.data
-        filename = secure_filename(image_file.filename)
-        unique_filename = str(uuid.uuid4()) + "_" + filename
-        upload_path = os.path.join(app.root_path, 'static/uploads', unique_filename)
-        image_file.save(upload_path)
-
-        # --- 2. Nominatim APIでお店の情報を検索 ---
-        shop_name_query = form.shop_name.data
-        
-        # Nominatim APIのエンドポイント (config.pyから読み込むのが望ましい)
-        nominatim_url = 'https://nominatim.openstreetmap.org/search'
-        params = {
-            'q': shop_name_query,
-            'format': 'json',
-            'limit': 1, # 最も関連性の高い結果を1つだけ取得
-            'countrycodes': 'jp' # 日本国内に限定
-        }
-        headers = {'Accept-Language': 'ja',
-                   'User-Agent': 'FoodiesFanApp/1.0 (kuanshangang@gmail.com)'
-        }
-        
+        # --- 1. お店の情報をフォームの隠しフィールドから取得 ---
+        shop_name = form.shop_name.data
         try:
-            response = requests.get(nominatim_url, params=params, headers=headers)
-            # 200 OK以外のステータスコードが返ってきた場合にエラーを発生させる
-            response.raise_for_status() 
-            shop_data = response.json()
-        except (requests.RequestException, ValueError) as e:
-            # ネットワークエラーやJSONデコードエラーをキャッチ
-            flash(f'Could not retrieve shop information. Error: {e}')
-            return redirect(url_for('create_post'))
-
-        if not shop_data:
-            flash('Shop not found. Please try a more specific name.')
+            osm_id, latitude, longitude = parse_shop_selection(
+                form.shop_osm_id.data, form.shop_latitude.data, form.shop_longitude.data)
+        except ValueError:
+            flash('Invalid shop selection. Please select the shop on the map again.')
             return redirect(url_for('create_post'))
 
-       
-         # --- ▼▼▼ お店の情報をフォームの隠しフィールドから取得するように変更 ▼▼▼ ---
-        osm_id = form.shop_osm_id.data
-        shop_name = form.shop_name.data
-        latitude = form.shop_latitude.data
-        longitude = form.shop_longitude.data
-
-        # --- データベースでお店の情報を検索または作成 ---
-        shop = Shop.query.filter_by(osm_id=osm_id).first()
-        if not shop:
+        # --- 2. お店の確認 (ローカルのDBとOverpassキャッシュ) ---
+        source, known = find_known_shop(osm_id)
+        if app.config['SHOP_VALIDATION'] == 'nominatim':
+            # 従来どおり、Nominatim APIで見つかるお店だけを受け付ける
+            try:
+                shop_data = geocode(shop_name)
+            except (requests.RequestException, ValueError) as e:
+                # ネットワークエラーやJSONデコードエラーをキャッチ
+                flash(f'Could not retrieve shop information. Error: {e}')
+                return redirect(url_for('create_post'))
+            if not shop_data:
+                flash('Shop not found. Please try a more specific name.')
+                return redirect(url_for('create_post'))
+        elif source is None:
+            # ローカルで確認できないお店は、投稿を待たせずに裏でNominatimに確認する
+            geocode_async(shop_name, osm_id)
+
+        # --- 3. データベースでお店の情報を検索または作成 ---
+        if source == 'shop':
+            shop = known
+        else:
+            if source == 'feature':
+                # 検索結果の座標を使う
+                latitude, longitude = known['latitude'], known['longitude']
             shop = Shop(
                 osm_id=osm_id,
                 name=shop_name,
-                latitude=float(latitude),
-                longitude=float(longitude)
+                latitude=latitude,
+                longitude=longitude
             )
             db.session.add(shop)
+
+        # --- 4. 画像の保存処理 ---
+        # 少しずつ書き出しながらハッシュを計算し、内容のハッシュをファイル名にする
+        # (同じ画像が既に保存されていれば、そのファイルを共有する)
+        image_file = form.image.data
+        extension = os.path.splitext(secure_filename(image_file.filename))[1].lower()
+        unique_filename = get_storage().save_upload(image_file.stream, extension,
+                                                    max_size=app.config['MAX_CONTENT_LENGTH'])
         
         # --- 投稿をデータベースに保存 (変更なし) ---
         post = Post(
@@ -254,7 +369,16 @@ def create_post():
             shop=shop
         )
         db.session.add(post)
+        # 新しいお店もINSERTしてから、件数カラムを加算する
+        db.session.flush()
+        increment_counter(current_user, 'posts_count')
+        increment_counter(shop, 'posts_count')
+        shop.hot_score = hot_score_after(Shop, 'post')
+        if feed.fanout_enabled():
+            feed.fanout_post(post)
         db.session.commit()
+        # サムネイルなどの縮小版は裏で作る (できるまでは元画像を表示する)
+        process_post_image_async(post.id, unique_filename)
         
         flash('Your post is now live!')
         return redirect(url_for('index'))
@@ -262,46 +386,115 @@ def create_post():
     return render_template('create_post.html', title='New Post', form=form)
 
 
+def bookmarked_shop_ids(shop_ids=None):
+    """ブックマーク済みのお店はまとめて1回で取得する (お店ごとにCOUNTしない)"""
+    bookmarked_ids = current_user.bookmarked_shop_ids(shop_ids)
+    if write_behind_enabled() and current_user.is_authenticated:
+        bookmarked_ids = get_write_behind().overlay_ids('bookmark', current_user.id, bookmarked_ids, shop_ids)
+    return bookmarked_ids
+
+
+def shop_features(rows, origin=None):
+    """
+    (id, name, osm_id, 緯度, 経度, hot_score) の行を人気順のままFeatureCollectionにする
+    origin (緯度, 経度) があれば、そこからの距離 distance_km も付ける
+    """
+    bookmarked_ids = bookmarked_shop_ids([row[0] for row in rows])
+    features = []
+    for shop_id, name, osm_id, latitude, longitude, hot_score in rows:
+        properties = {
+            "id": shop_id,
+            "name": name,
+            "osm_id": osm_id,
+            "hot_score": hot_score,
+            "is_bookmarked": shop_id in bookmarked_ids
+        }
+        if origin is not None:
+            properties["distance_km"] = round(haversine(origin[1], origin[0], longitude, latitude), 2)
+        features.append(point_feature(longitude, latitude, properties))
+    return {"type": "FeatureCollection", "features": features}
+
+
 @app.route('/api/shops')
+@use_replica
 def get_shops():
-    """データベースに保存されている全てのお店の情報をGeoJSON形式で返す"""
-    shops = Shop.query.all()
-    features = []
-    for shop in shops:
-        features.append({
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [shop.longitude, shop.latitude]
-            },
-            "properties": {
-                "id": shop.id,
-                "name": shop.name,
-                "osm_id": shop.osm_id,
-                "is_bookmarked": current_user.has_bookmarked_shop(shop)
-            }
-        })
-    
-    return jsonify({
-        "type": "FeatureCollection",
-        "features": features
-    })
+    """
+    データベースに保存されているお店の情報をGeoJSON形式で返す
+    bbox (south,west,north,east) を指定すると、その範囲のお店だけを返す
+    """
+    bbox = request.args.get('bbox')
+    # 必要なカラムだけを取り出し、ORMのオブジェクトは作らない
+    query = select(Shop.id, Shop.name, Shop.osm_id, Shop.latitude, Shop.longitude)
+    limit = None
+    if bbox:
+        try:
+            south, west, north, east = parse_bbox(bbox)
+        except ValueError:
+            return jsonify({"error": "Invalid bbox"}), 400
+        limit = app.config['SHOPS_BBOX_LIMIT']
+        query = query.where(bbox_filter(Shop.latitude, Shop.longitude, Shop.geocell, south, west, north, east)) \
+            .order_by(Shop.posts_count.desc()).limit(limit + 1)
+    bookmarked_ids = bookmarked_shop_ids()
+    state = {'truncated': False}
+
+    def features():
+        with db.session.execute(query.execution_options(yield_per=YIELD_PER)) as rows:
+            for count, (shop_id, name, osm_id, latitude, longitude) in enumerate(rows):
+                if count == limit:
+                    state['truncated'] = True
+                    break
+                yield point_feature(longitude, latitude, {
+                    "id": shop_id,
+                    "name": name,
+                    "osm_id": osm_id,
+                    "is_bookmarked": shop_id in bookmarked_ids
+                })
+
+    return geojson_response(features(), lambda: state)
 
 @app.route('/api/shops/<int:shop_id>/posts')
+@use_replica
 def get_posts_for_shop(shop_id):
-    """指定されたお店IDに関連する投稿を返す"""
+    """指定されたお店IDに関連する投稿を、新しいものから最大 limit 件返す"""
     shop = Shop.query.get_or_404(shop_id)
-    posts_data = []
+    limit = max(1, min(request.args.get('limit', app.config['POSTS_PER_PAGE'], type=int), 100))
     # 新しい投稿が先に表示されるように並び替え
-    for post in shop.posts.order_by(Post.timestamp.desc()):
-        posts_data.append({
-            'id': post.id,
-            'body': post.body,
-            'image_filename': post.image_filename,
-            'author_username': post.author.username,
-            'comments_count' : post.comments.count()
-        })
-    return jsonify(posts_data)
+    posts = with_post_relations(shop.posts).order_by(Post.timestamp.desc(), Post.id.desc()).limit(limit).all()
+    hydrate_posts(posts, current_user)
+    return jsonify([serialize_post(post) for post in posts])
+
+
+@app.route('/api/trending')
+@use_replica
+def api_trending():
+    """
+    いま人気の投稿 (type=post) またはお店 (type=shop) を、人気の順に返す
+    ?type=post|shop&limit=20
+    """
+    doc_type = request.args.get('type', 'post')
+    limit = max(1, min(request.args.get('limit', app.config['TRENDING_LIMIT'], type=int), 50))
+    if doc_type == 'shop':
+        return jsonify(shop_features(trending.trending_shops(limit)))
+    if doc_type != 'post':
+        return jsonify({"error": "Invalid type"}), 400
+    posts = hydrate_posts(load_posts(trending.trending_post_ids(limit)), current_user)
+    return jsonify({'posts': [dict(serialize_post(post), hot_score=post.hot_score) for post in posts]})
+
+
+@app.route('/api/popular_nearby')
+@use_replica
+def api_popular_nearby():
+    """
+    (lat, lon) から radius_km 以内の人気のお店を、人気の順 (同じなら近い順) に返す
+    ?lat=..&lon=..&radius_km=3&limit=20
+    """
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if not valid_point(lat, lon):
+        return jsonify({"error": "lat and lon are required"}), 400
+    radius_km = max(0.1, min(request.args.get('radius_km', app.config['POPULAR_NEARBY_RADIUS_KM'], type=float), 50))
+    limit = max(1, min(request.args.get('limit', app.config['TRENDING_LIMIT'], type=int), 50))
+    return jsonify(shop_features(trending.popular_nearby_shops(lat, lon, radius_km, limit), origin=(lat, lon)))
 
 
 # @app.route('/timeline')
@@ -312,88 +505,76 @@ def get_posts_for_shop(shop_id):
 #     return render_template('timeline.html', title='Timeline', posts=posts)
 
 
-# ▼▼▼ 2点間の距離を計算するヘルパー関数（ハーベサイン公式）を追加 ▼▼▼
-def haversine(lon1, lat1, lon2, lat2):
-    """
-    Calculate the great circle distance in kilometers between two points 
-    on the earth (specified in decimal degrees)
-    """
-    # 緯度経度をラジアンに変換
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-
-    # ハーベサインの公式
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
-    r = 6371 # 地球の半径 (km)
-    return c * r
-
-
 @app.route('/api/timeline')
+@use_replica
 @login_required
 def api_timeline():
     page = request.args.get('page', 1, type=int)
     lat = request.args.get('lat', type=float)
     lon = request.args.get('lon', type=float)
+    if (lat is not None or lon is not None) and not valid_point(lat, lon):
+        return jsonify({"error": "Invalid lat/lon"}), 400
     filter_mode = request.args.get('filter', 'all')
     POSTS_PER_PAGE = 9
 
-    # 1. まずはDBで30日以内の投稿に絞り込む（パフォーマンスのため）
-    recent_date_naive = (datetime.utcnow() - timedelta(days=30))
-    base_query = Post.query.filter(Post.timestamp >= recent_date_naive)
+    cursor = request.args.get('cursor')
 
-    # 2. ページネーションを適用
     if filter_mode == 'following':
         # フォローしているユーザーの投稿だけを取得するクエリ
-        base_query = current_user.followed_posts().order_by(Post.timestamp.desc())
+        base_query = current_user.followed_posts()
     else:
         # これまで通り、全ての投稿を取得するクエリ
-        base_query = Post.query.order_by(Post.timestamp.desc())
+        base_query = Post.query
 
-    pagination = base_query.paginate(
-        page=page, per_page=POSTS_PER_PAGE, error_out=False
-    )
-    posts_on_page = pagination.items
-    
-    # 3. 緯度経度がある場合、取得した投稿を並び替える
+    # 1. 緯度経度がある場合は、近くの直近の投稿を 新しさ・近さ・いいね数 のスコア順に並べる
     if lat is not None and lon is not None:
-        sortable_posts = []
-        for post in posts_on_page:
-            distance = float('inf') # デフォルトは無限遠
-            if post.shop and post.shop.latitude is not None and post.shop.longitude is not None:
-                distance = haversine(lon, lat, post.shop.longitude, post.shop.latitude)
-
-            sortable_posts.append({
-                'post': post,
-                'timestamp': post.timestamp,
-                'distance': distance,
-                'likes': post.likers.count()
-            })
-        
-        # 4. 優先順位に従ってソート (1.時間(降順), 2.距離(昇順), 3.いいね(降順))
-        # 降順にしたいキーにはマイナスを付ける
-        sorted_list = sorted(sortable_posts, key=lambda x: (x['timestamp'], -x['distance'], -x['likes']), reverse=True)
-        posts = [item['post'] for item in sorted_list]
+        if cursor is None:
+            # page= のときは、その時点の順位からページを切り出す
+            ranked_ids = rank_nearby_posts(base_query, lat, lon)
+            offset = (page - 1) * POSTS_PER_PAGE
+            posts = load_posts(ranked_ids[offset:offset + POSTS_PER_PAGE])
+            has_next_page = offset + POSTS_PER_PAGE < len(ranked_ids)
+        else:
+            # cursor= のときは、最初のページの時刻と最後の (score, id) から続ける
+            try:
+                page_ids, next_cursor = nearby_page(base_query, lat, lon, cursor, POSTS_PER_PAGE)
+            except ValueError:
+                return jsonify({"error": "Invalid cursor"}), 400
+            posts = load_posts(page_ids)
+
+    # 2. cursor パラメータがあればキーセット方式 (COUNTもOFFSETも使わない)
+    elif cursor is not None:
+        try:
+            if filter_mode == 'following' and feed.fanout_enabled():
+                # 配信済みの feed_item から読む
+                posts, next_cursor = feed.feed_page(current_user, cursor, POSTS_PER_PAGE)
+            else:
+                posts, next_cursor = keyset_page(with_post_relations(base_query), cursor, POSTS_PER_PAGE)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    # 3. それ以外はページ番号で取得する
     else:
-        # 緯度経度がなければ、そのまま表示
-        posts = posts_on_page
+        pagination = with_post_relations(base_query).order_by(Post.timestamp.desc()).paginate(
+            page=page, per_page=POSTS_PER_PAGE, error_out=False
+        )
+        posts = pagination.items
+        has_next_page = pagination.has_next
+
+    # いいね済みかどうかはページ分まとめて取得する
+    hydrate_posts(posts, current_user)
 
     # JSONレスポンスを生成
-    posts_data = [{
-        'id': post.id,
-        'body': post.body,
-        'image_filename': post.image_filename,
-        'author_username': post.author.username,
-        'shop_name': post.shop.name,
-        'likes_count': post.likers.count(),
-        'is_liked_by_user': current_user.has_liked_post(post),
-        'comments_count' : post.comments.count()
-    } for post in posts]
-    
+    posts_data = [serialize_post(post) for post in posts]
+
+    if cursor is not None:
+        return jsonify({
+            'posts': posts_data,
+            'next_cursor': next_cursor
+        })
     return jsonify({
         'posts': posts_data,
-        'has_next_page': pagination.has_next
+        'has_next_page': has_next_page
     })
 
 
@@ -411,65 +592,62 @@ def timeline():
 @login_required
 def like(post_id):
     post = Post.query.get_or_404(post_id)
+    if write_behind_enabled():
+        return jsonify({'status': 'ok', 'likes_count': submit_toggle('like', current_user, post, True)})
     current_user.like_post(post)
     db.session.commit()
-    return jsonify({'status': 'ok', 'likes_count': post.likers.count()})
+    invalidate_post_card(post.id)
+    return jsonify({'status': 'ok', 'likes_count': post.likes_count})
 
 @app.route('/unlike/<int:post_id>', methods=['POST'])
 @login_required
 def unlike(post_id):
     post = Post.query.get_or_404(post_id)
+    if write_behind_enabled():
+        return jsonify({'status': 'ok', 'likes_count': submit_toggle('like', current_user, post, False)})
     current_user.unlike_post(post)
     db.session.commit()
-    return jsonify({'status': 'ok', 'likes_count': post.likers.count()})
+    invalidate_post_card(post.id)
+    return jsonify({'status': 'ok', 'likes_count': post.likes_count})
 
 @app.route('/shop/<int:shop_id>')
+@use_replica
 @login_required
 def shop_page(shop_id):
     shop = Shop.query.get_or_404(shop_id)
-    posts = shop.posts.order_by(Post.timestamp.desc()).all()
-    return render_template('shop_page.html', title=shop.name, shop=shop, posts=posts)
+    return render_post_grid(shop.posts, 'shop_page.html', title=shop.name, shop=shop)
 
 
 @app.route('/user/<username>')
+@use_replica
 @login_required
 def user_profile(username):
     # URLで指定されたusernameを持つユーザーをデータベースから探す
     # 見つからなかった場合は404エラーを返す
     user = User.query.filter_by(username=username).first_or_404()
     
-    # そのユーザーの投稿を新しい順に取得
-    posts = user.posts.order_by(Post.timestamp.desc()).all()
-    
-    return render_template('user_profile.html', title=f"{user.username}'s Profile", user=user, posts=posts)
+    # そのユーザーの投稿を新しい順に、1ページ分だけ取得
+    return render_post_grid(user.posts, 'user_profile.html', title=f"{user.username}'s Profile", user=user)
 
 
 @app.route('/api/user/<username>/shops')
+@use_replica
 @login_required
 def get_user_shops(username):
     user = User.query.filter_by(username=username).first_or_404()
     
-    # ユーザーの投稿から、ユニークなお店のリストを取得
-    shops = set(post.shop for post in user.posts)
-    
-    features = []
-    for shop in shops:
-        features.append({
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [shop.longitude, shop.latitude]
-            },
-            "properties": {
-                "id": shop.id,
-                "name": shop.name
-            }
-        })
-    
-    return jsonify({
-        "type": "FeatureCollection",
-        "features": features
-    })
+    # ユーザーの投稿から、ユニークなお店のリストを取得 (投稿を1件ずつ読み込まない)
+    query = select(Shop.id, Shop.name, Shop.latitude, Shop.longitude) \
+        .where(Shop.id.in_(select(Post.shop_id).where(Post.user_id == user.id)))
+
+    def features():
+        for shop_id, name, latitude, longitude in db.session.execute(query.execution_options(yield_per=YIELD_PER)):
+            yield point_feature(longitude, latitude, {
+                "id": shop_id,
+                "name": name
+            })
+
+    return geojson_response(features())
 
 
 @app.route('/follow/<username>', methods=['POST'])
@@ -480,12 +658,13 @@ def follow(username):
         return jsonify({'status': 'error', 'message': 'User not found.'}), 404
     if user == current_user:
         return jsonify({'status': 'error', 'message': 'You cannot follow yourself!'}), 400
-    current_user.follow(user)
+    if current_user.follow(user) and feed.fanout_enabled():
+        feed.backfill_follow(current_user, user)
     db.session.commit()
     return jsonify({
         'status': 'ok',
         'message': f'You are now following {username}.',
-        'followers_count': user.followers.count()
+        'followers_count': user.followers_count
     })
 
 @app.route('/unfollow/<username>', methods=['POST'])
@@ -496,30 +675,38 @@ def unfollow(username):
         return jsonify({'status': 'error', 'message': 'User not found.'}), 404
     if user == current_user:
         return jsonify({'status': 'error', 'message': 'You cannot unfollow yourself!'}), 400
-    current_user.unfollow(user)
+    if current_user.unfollow(user) and feed.fanout_enabled():
+        feed.trim_unfollow(current_user, user)
     db.session.commit()
     return jsonify({
         'status': 'ok',
         'message': f'You have unfollowed {username}.',
-        'followers_count': user.followers.count()
+        'followers_count': user.followers_count
     })
 
 @app.route('/user/<username>/followers')
+@use_replica
 @login_required
 def followers(username):
     user = User.query.filter_by(username=username).first_or_404()
     users = user.followers.all()
-    return render_template('follow_list.html', title=f'Followers of {user.username}', users=users, user=user)
+    following_ids = current_user.followed_user_ids([u.id for u in users])
+    return render_template('follow_list.html', title=f'Followers of {user.username}', users=users, user=user,
+                           following_ids=following_ids)
 
 @app.route('/user/<username>/following')
+@use_replica
 @login_required
 def following(username):
     user = User.query.filter_by(username=username).first_or_404()
     users = user.followed.all()
-    return render_template('follow_list.html', title=f'Following by {user.username}', users=users, user=user)
+    following_ids = current_user.followed_user_ids([u.id for u in users])
+    return render_template('follow_list.html', title=f'Following by {user.username}', users=users, user=user,
+                           following_ids=following_ids)
 
 
 @app.route('/post/<int:post_id>', methods=['GET', 'POST'])
+@use_replica
 @login_required
 def post_detail(post_id):
     post = Post.query.get_or_404(post_id)
@@ -533,13 +720,19 @@ def post_detail(post_id):
             author=current_user
         )
         db.session.add(comment)
+        increment_counter(post, 'comments_count')
+        post.hot_score = hot_score_after(Post, 'comment')
+        add_hot_score(Shop, post.shop_id, 'comment')
         db.session.commit()
+        invalidate_post_card(post.id)
         flash('Your comment has been published.')
         # 投稿後は同じページにリダイレクトして、フォームの再送信を防ぐ
         return redirect(url_for('post_detail', post_id=post.id))
     
+    hydrate_posts([post], current_user)
     # この投稿に紐づく全てのコメントを新しい順に取得
-    comments = post.comments.order_by(Comment.timestamp.desc()).all()
+    # 書いた人はまとめて読み込む (コメントの数だけ user を SELECT しない)
+    comments = post.comments.options(joinedload(Comment.author)).order_by(Comment.timestamp.desc()).all()
     
     return render_template(
         'post_detail.html', 
@@ -562,17 +755,15 @@ def delete_post(post_id):
 
     # データベースから投稿を削除
     # (Commentモデルのcascade設定により、関連するコメントも自動で削除されます)
+    feed.remove_post(post_to_delete)
     db.session.delete(post_to_delete)
-    
-    # アップロードされた画像ファイルもサーバーから削除 (任意ですが推奨)
-    try:
-        image_path = os.path.join(app.root_path, 'static/uploads', post_to_delete.image_filename)
-        if os.path.exists(image_path):
-            os.remove(image_path)
-    except Exception as e:
-        print(f"Error deleting image file: {e}") # エラーログを残す
-
+    increment_counter(post_to_delete.author, 'posts_count', -1)
+    increment_counter(post_to_delete.shop, 'posts_count', -1)
+    # 画像ファイルと縮小版は、他の投稿が使っていなければ `flask uploads-gc` で消す
+    # (ここで消すと、同じ画像を同時にアップロードした投稿のファイルまで消えることがある)
     db.session.commit()
+    invalidate_post_card(post_id)
+
     flash('Your post has been deleted.')
     # 削除後は、そのユーザーのプロフィールページにリダイレクト
     return redirect(url_for('user_profile', username=current_user.username))
@@ -581,21 +772,25 @@ def delete_post(post_id):
 @login_required
 def bookmark(shop_id):
     shop = Shop.query.get_or_404(shop_id)
-    if not current_user.has_bookmarked_shop(shop):
-        # ▼▼▼ current_userのブックマークリストに直接追加 ▼▼▼
-        current_user.bookmarked_shops.append(shop)
+    if write_behind_enabled():
+        submit_toggle('bookmark', current_user, shop, True)
+        return jsonify({'status': 'ok'})
+    # ▼▼▼ まだブックマークしていなければ追加 (件数カラムも同時に更新) ▼▼▼
+    if current_user.bookmark_shop(shop):
         db.session.commit()
-        print(f"--- DB WRITE: {current_user.username} BOOKMARKED {shop.name} ---") # ターミナルで確認
+        app.logger.debug('%s bookmarked shop %s', current_user.username, shop.id)
     return jsonify({'status': 'ok'})
 
 @app.route('/unbookmark/<int:shop_id>', methods=['POST'])
 @login_required
 def unbookmark(shop_id):
     shop = Shop.query.get_or_404(shop_id)
-    if current_user.has_bookmarked_shop(shop):
-        # ▼▼▼ current_userのブックマークリストから直接削除 ▼▼▼
-        current_user.bookmarked_shops.remove(shop)
+    if write_behind_enabled():
+        submit_toggle('bookmark', current_user, shop, False)
+        return jsonify({'status': 'ok'})
+    # ▼▼▼ ブックマーク済みなら削除 (件数カラムも同時に更新) ▼▼▼
+    if current_user.unbookmark_shop(shop):
         db.session.commit()
-        print(f"--- DB WRITE: {current_user.username} UNBOOKMARKED {shop.name} ---") # ターミナルで確認
+        app.logger.debug('%s unbookmarked shop %s', current_user.username, shop.id)
     return jsonify({'status': 'ok'})
 
@@ -0,0 +1,161 @@
+"""
+投稿・コメント・お店の名前の全文検索
+
+日本語は単語の区切りが無いので、かな・漢字の連続はPython側で2文字ずつ
+(bigram) に区切り、英数字は単語ごとに区切って空白でつないだものを索引に入れる。
+検索語も同じように区切り、連続する bigram をフレーズとして検索する。
+
+  SQLite    : FTS5 の仮想テーブル search_index (bm25 で並べる)
+  PostgreSQL: tsvector ('simple') と GIN 索引の search_index (ts_rank で並べる)
+
+索引は Post / Comment / Shop の保存・削除時に同じトランザクションで更新する。
+一括の UPDATE / DELETE ではフックが動かないので、`flask search-reindex` で作り直す。
+rowid = 元のID * 4 + 種類 にして、1件の更新・削除が rowid で引けるようにしている。
+"""
+import re
+import unicodedata
+from flask import current_app
+from sqlalchemy import event, inspect, select, text
+from app import db
+from app.models import Post, Comment, Shop
+
+DOC_TYPES = {'post': 1, 'comment': 2, 'shop': 3}
+_TYPE_NAMES = {code: name for name, code in DOC_TYPES.items()}
+
+# 々・ひらがな・カタカナ (ー を含む)・漢字
+_CJK = '\u3005\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_TOKEN_RE = re.compile(f'([{_CJK}]+)|([^\\W{_CJK}]+)')
+
+
+def tokenize(value):
+    """
+    Split text into phrases of index tokens: each run of kana/kanji
+    becomes its overlapping bigrams, every other word a single token.
+
+        tokenize('京都のラーメン Cafe') -> [['京都', '都の', 'のラ', 'ラー', 'ーメ', 'メン'], ['cafe']]
+    """
+    phrases = []
+    for cjk, word in _TOKEN_RE.findall(unicodedata.normalize('NFKC', value or '').lower()):
+        if cjk:
+            phrases.append([cjk] if len(cjk) == 1 else [cjk[i:i + 2] for i in range(len(cjk) - 1)])
+        else:
+            phrases.append([word])
+    return phrases
+
+
+def index_text(value):
+    return ' '.join(token for phrase in tokenize(value) for token in phrase)
+
+
+def _is_sqlite(connection):
+    return connection.dialect.name == 'sqlite'
+
+
+def _match_expression(phrases, sqlite):
+    if sqlite:
+        # 1文字のかな・漢字は、その文字で始まる bigram を前方一致で探す
+        return ' '.join(f'"{phrase[0]}"*' if len(phrase) == 1 and re.match(f'[{_CJK}]', phrase[0])
+                        else '"' + ' '.join(phrase) + '"' for phrase in phrases)
+    return ' & '.join('(' + ' <-> '.join(phrase) + ')' for phrase in phrases)
+
+
+def _rowid(doc_type, doc_id):
+    return doc_id * 4 + DOC_TYPES[doc_type]
+
+
+def _write(connection, doc_type, doc_id, value):
+    rowid = _rowid(doc_type, doc_id)
+    tokens = index_text(value)
+    if _is_sqlite(connection):
+        connection.execute(text('DELETE FROM search_index WHERE rowid = :rowid'), {'rowid': rowid})
+        if tokens:
+            connection.execute(text('INSERT INTO search_index (rowid, tokens) VALUES (:rowid, :tokens)'),
+                               {'rowid': rowid, 'tokens': tokens})
+    elif tokens:
+        connection.execute(text("INSERT INTO search_index (id, tokens) VALUES (:rowid, to_tsvector('simple', :tokens)) "
+                                "ON CONFLICT (id) DO UPDATE SET tokens = excluded.tokens"),
+                           {'rowid': rowid, 'tokens': tokens})
+    else:
+        connection.execute(text('DELETE FROM search_index WHERE id = :rowid'), {'rowid': rowid})
+
+
+def _delete(connection, doc_type, doc_id):
+    column = 'rowid' if _is_sqlite(connection) else 'id'
+    connection.execute(text(f'DELETE FROM search_index WHERE {column} = :rowid'),
+                       {'rowid': _rowid(doc_type, doc_id)})
+
+
+def _register(model, doc_type, attribute):
+    @event.listens_for(model, 'after_insert')
+    def after_insert(mapper, connection, target):
+        _write(connection, doc_type, target.id, getattr(target, attribute))
+
+    @event.listens_for(model, 'after_update')
+    def after_update(mapper, connection, target):
+        # いいね数などの更新では索引を書き換えない
+        if inspect(target).attrs[attribute].history.has_changes():
+            _write(connection, doc_type, target.id, getattr(target, attribute))
+
+    @event.listens_for(model, 'after_delete')
+    def after_delete(mapper, connection, target):
+        _delete(connection, doc_type, target.id)
+
+
+_register(Post, 'post', 'body')
+_register(Comment, 'comment', 'body')
+_register(Shop, 'shop', 'name')
+
+
+def search(query, doc_type=None, limit=20):
+    """
+    Return [(doc_type, doc_id, score)] for `query`, best match first.
+
+    All phrases of the query must match. Only the newest
+    SEARCH_MAX_CANDIDATES matches (by rowid, i.e. by id) are ranked, so a
+    common word costs the same as a rare one instead of scoring every
+    matching row. Scores are only comparable within one query.
+    """
+    phrases = tokenize(query)
+    if not phrases:
+        return []
+    connection = db.session.connection()
+    sqlite = _is_sqlite(connection)
+    params = {'match': _match_expression(phrases, sqlite), 'limit': limit,
+              'candidates': current_app.config['SEARCH_MAX_CANDIDATES']}
+    type_filter = ''
+    if doc_type is not None:
+        params['type'] = DOC_TYPES[doc_type]
+        type_filter = f"AND {'rowid' if sqlite else 'id'} % 4 = :type"
+    if sqlite:
+        # bm25 は小さいほど良いので、符号を反転してスコアにする
+        sql = ('SELECT rowid, score FROM (SELECT rowid, -rank AS score FROM search_index '
+               f'WHERE search_index MATCH :match {type_filter} ORDER BY rowid DESC LIMIT :candidates) '
+               'ORDER BY score DESC LIMIT :limit')
+    else:
+        sql = ('SELECT id, score FROM (SELECT id, ts_rank(tokens, query) AS score '
+               "FROM search_index, to_tsquery('simple', :match) query "
+               f'WHERE tokens @@ query {type_filter} ORDER BY id DESC LIMIT :candidates) candidates '
+               'ORDER BY score DESC LIMIT :limit')
+    return [(_TYPE_NAMES[rowid % 4], rowid // 4, score)
+            for rowid, score in connection.execute(text(sql), params)]
+
+
+def rebuild_index():
+    """索引を作り直して、登録した件数を返す"""
+    connection = db.session.connection()
+    connection.execute(text('DELETE FROM search_index'))
+    # 空にした後なので、1件ずつの DELETE はせずに1000件ずつまとめて INSERT する
+    if _is_sqlite(connection):
+        sql = text('INSERT INTO search_index (rowid, tokens) VALUES (:rowid, :tokens)')
+    else:
+        sql = text("INSERT INTO search_index (id, tokens) VALUES (:rowid, to_tsvector('simple', :tokens))")
+    total = 0
+    for doc_type, column in (('post', Post.body), ('comment', Comment.body), ('shop', Shop.name)):
+        model = column.class_
+        for rows in db.session.execute(select(model.id, column).execution_options(yield_per=1000)).partitions():
+            batch = [{'rowid': _rowid(doc_type, doc_id), 'tokens': tokens}
+                     for doc_id, tokens in ((doc_id, index_text(value)) for doc_id, value in rows) if tokens]
+            if batch:
+                connection.execute(sql, batch)
+                total += len(batch)
+    return total
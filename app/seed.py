@@ -0,0 +1,155 @@
+"""
+ベンチマーク用の合成データ (`flask seed`)
+
+人気はべき乗則 (Zipf) に従わせる: 順位 r の重みは 1 / r^skew。
+少数のユーザー・お店・投稿に、投稿・いいね・フォロー・ブックマークが集中する。
+お店の8割は大都市の周辺に置く。行はCoreの一括INSERTで BATCH_SIZE 件ずつ入れ、
+件数カラムはPython側で数えた値を入れる (ORMのフックは動かないので、
+検索索引・人気のスコアと、FEED_FANOUT_ENABLED ならタイムラインの配信は最後にまとめて作り直す)。
+"""
+import bisect
+import itertools
+import random
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import insert
+from werkzeug.security import generate_password_hash
+from app import db, feed, search, trending
+from app.geo import grid_cell
+from app.models import User, Shop, Post, Comment, likes, followers, bookmarks
+
+BATCH_SIZE = 10000
+
+# 全ユーザー共通のパスワード (ハッシュの計算は1回だけ)
+PASSWORD = 'password'
+
+CITIES = [(35.68, 139.76), (34.69, 135.50), (35.01, 135.77), (35.18, 136.91), (43.06, 141.35), (33.59, 130.40)]
+
+WORDS = ['ラーメン', '寿司', 'カフェ', 'カレー', 'パン', '美味しい', 'また来たい', '行列', '限定',
+         'ランチ', 'ディナー', 'コーヒー', 'noodle', 'great', 'tasty', 'cozy']
+
+
+class Zipf:
+    """1..n の順位を、重み 1 / r^skew で選ぶ (累積の重みを二分探索)"""
+
+    def __init__(self, n, skew, rng):
+        self.rng = rng
+        self.cumulative = list(itertools.accumulate(1 / (rank ** skew) for rank in range(1, n + 1)))
+
+    def sample(self):
+        """0始まりの順位を返す (0 が一番人気)"""
+        return bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+def _location(rng):
+    if rng.random() < 0.8:
+        latitude, longitude = rng.choice(CITIES)
+        return rng.gauss(latitude, 0.15), rng.gauss(longitude, 0.15)
+    return rng.uniform(31.0, 45.0), rng.uniform(129.0, 145.0)
+
+
+def _text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def _insert(table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(insert(table), rows[start:start + BATCH_SIZE])
+    db.session.commit()
+
+
+def _pairs(count, pick, attempts):
+    """pick() で重複しない組を count 個まで作る (None は捨てる。attempts 回で足りなければ諦める)"""
+    pairs = set()
+    for _ in range(attempts):
+        if len(pairs) >= count:
+            break
+        pair = pick()
+        if pair is not None:
+            pairs.add(pair)
+    return pairs
+
+
+def seed(users, shops, posts, comments, like_count, follow_count, bookmark_count, skew=1.1, days=365,
+         random_seed=42, log=print):
+    """
+    Fill an empty database with synthetic data and return the row counts.
+
+    Authors, shops and posts are ranked by popularity: post authorship,
+    shop choice, likes, comments, follows and bookmarks are all drawn
+    with Zipf weights, so a few rows are very hot and most are cold.
+    """
+    rng = random.Random(random_seed)
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    user_rank = Zipf(users, skew, rng)
+    shop_rank = Zipf(shops, skew, rng)
+    post_rank = Zipf(posts, skew, rng)
+
+    # IDは 1 から連番 (空のデータベースを前提にする)
+    password_hash = generate_password_hash(PASSWORD)
+    user_rows = [{'id': user_id, 'username': f'user{user_id}', 'email': f'user{user_id}@example.com',
+                  'password_hash': password_hash, 'followers_count': 0, 'following_count': 0, 'posts_count': 0}
+                 for user_id in range(1, users + 1)]
+
+    shop_rows = []
+    for shop_id in range(1, shops + 1):
+        latitude, longitude = _location(rng)
+        shop_rows.append({'id': shop_id, 'osm_id': shop_id, 'name': f'{rng.choice(WORDS)}の店 {shop_id}',
+                          'latitude': latitude, 'longitude': longitude, 'geocell': grid_cell(latitude, longitude),
+                          'posts_count': 0, 'bookmarks_count': 0})
+
+    # 古い投稿ほどIDが小さくなるように、時刻を並べてから割り当てる
+    timestamps = sorted(now - timedelta(seconds=rng.uniform(0, days * 86400)) for _ in range(posts))
+    post_rows = []
+    for post_id, timestamp in enumerate(timestamps, start=1):
+        user_id, shop_id = user_rank.sample() + 1, shop_rank.sample() + 1
+        user_rows[user_id - 1]['posts_count'] += 1
+        shop_rows[shop_id - 1]['posts_count'] += 1
+        post_rows.append({'id': post_id, 'body': _text(rng, rng.randint(2, 12)), 'timestamp': timestamp,
+                          'image_filename': 'seed.jpg', 'user_id': user_id, 'shop_id': shop_id,
+                          'likes_count': 0, 'comments_count': 0})
+    del timestamps
+
+    like_rows = _pairs(like_count, lambda: (rng.randrange(users) + 1, post_rank.sample() + 1), like_count * 3)
+    for _, post_id in like_rows:
+        post_rows[post_id - 1]['likes_count'] += 1
+
+    comment_rows = []
+    for _ in range(comments):
+        post = post_rows[post_rank.sample()]
+        post['comments_count'] += 1
+        comment_rows.append({'body': _text(rng, rng.randint(1, 6)), 'user_id': rng.randrange(users) + 1,
+                             'post_id': post['id'],
+                             'timestamp': min(post['timestamp'] + timedelta(seconds=rng.expovariate(1 / 86400)), now)})
+
+    def pick_follow():
+        follower_id, followed_id = rng.randrange(users) + 1, user_rank.sample() + 1
+        return None if follower_id == followed_id else (follower_id, followed_id)
+
+    follow_rows = _pairs(follow_count, pick_follow, follow_count * 3)
+    for follower_id, followed_id in follow_rows:
+        user_rows[follower_id - 1]['following_count'] += 1
+        user_rows[followed_id - 1]['followers_count'] += 1
+
+    bookmark_rows = _pairs(bookmark_count, lambda: (rng.randrange(users) + 1, shop_rank.sample() + 1),
+                           bookmark_count * 3)
+    for _, shop_id in bookmark_rows:
+        shop_rows[shop_id - 1]['bookmarks_count'] += 1
+
+    for table, rows in ((User.__table__, user_rows), (Shop.__table__, shop_rows), (Post.__table__, post_rows),
+                        (likes, [{'user_id': a, 'post_id': b} for a, b in like_rows]),
+                        (Comment.__table__, comment_rows),
+                        (followers, [{'follower_id': a, 'followed_id': b} for a, b in follow_rows]),
+                        (bookmarks, [{'user_id': a, 'shop_id': b} for a, b in bookmark_rows])):
+        log(f'{table.name}: {len(rows)}')
+        _insert(table, rows)
+
+    log('search index / trending')
+    search.rebuild_index()
+    trending.rebuild_scores(now)
+    if feed.fanout_enabled():
+        # 人気ユーザーのフォロワー全員に配信するので、件数によっては数千万行になる
+        log('feeds')
+        feed.rebuild_feeds()
+    db.session.commit()
+    return {'users': users, 'shops': shops, 'posts': posts, 'comments': comments,
+            'likes': len(like_rows), 'follows': len(follow_rows), 'bookmarks': len(bookmark_rows)}
@@ -0,0 +1,83 @@
+"""
+投稿時のお店の確認
+
+地図で選んだお店 (osm_id と座標) は、まずローカルの Shop テーブルと
+Overpassキャッシュで確認する。どちらにも無い場合だけ、Nominatimへの
+問い合わせをバックグラウンドで行い、結果をキャッシュに残す。
+"""
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from flask import current_app
+from app.models import Shop
+from app.overpass_cache import get_cache, normalize_keyword
+from app.poi import lookup_poi
+from app.upstream import UpstreamError, get_client
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='geocode')
+
+NOMINATIM_HEADERS = {'Accept-Language': 'ja',
+                     'User-Agent': 'FoodiesFanApp/1.0 (kuanshangang@gmail.com)'}
+
+
+def parse_shop_selection(osm_id, latitude, longitude):
+    """フォームの隠しフィールドを数値に変換する (不正な値は ValueError)"""
+    osm_id, latitude, longitude = int(osm_id), float(latitude), float(longitude)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise ValueError('coordinates out of range')
+    return osm_id, latitude, longitude
+
+
+def find_known_shop(osm_id):
+    """
+    Look the selected shop up locally.
+
+    Returns ('shop', Shop) if it is already registered, ('feature', dict)
+    if it came back in a recent Overpass search or is an imported POI,
+    or (None, None).
+    """
+    shop = Shop.query.filter_by(osm_id=osm_id).first()
+    if shop is not None:
+        return 'shop', shop
+    feature = get_cache().lookup_feature(osm_id) or lookup_poi(osm_id)
+    if feature is not None:
+        return 'feature', feature
+    return None, None
+
+
+def geocode(query):
+    """Nominatimでお店の名前を検索する (結果はキャッシュする)"""
+    cache = get_cache()
+    key = normalize_keyword(query)
+    result = cache.get_geocode(key)
+    if result is not None:
+        return result
+    try:
+        result = get_client('nominatim').get_json(params={
+            'q': query,
+            'format': 'json',
+            'limit': 1,  # 最も関連性の高い結果を1つだけ取得
+            'countrycodes': 'jp'  # 日本国内に限定
+        }, headers=NOMINATIM_HEADERS)
+    except UpstreamError:
+        # Nominatimが使えない間は、期限切れでも残っている結果を返す
+        result = cache.get_geocode(key, stale=True)
+        if result is None:
+            raise
+        return result
+    cache.put_geocode(key, result)
+    return result
+
+
+def _geocode_in_background(app, query, osm_id):
+    with app.app_context():
+        try:
+            if not geocode(query):
+                app.logger.warning('Shop %r (osm_id=%s) was not found by Nominatim', query, osm_id)
+        except (requests.RequestException, ValueError) as e:
+            app.logger.warning('Geocoding %r failed: %s', query, e)
+
+
+def geocode_async(query, osm_id):
+    """リクエストを待たせずに、バックグラウンドでNominatimに確認する"""
+    app = current_app._get_current_object()
+    return _executor.submit(_geocode_in_background, app, query, osm_id)
@@ -81,4 +81,54 @@ document.addEventListener('DOMContentLoaded', function() {
             link.classList.add('active');
         }
     });
-});
\ No newline at end of file
+});
+// --- 投稿グリッドの続きを読み込む (「もっと見る」が見えたら次のページを追加する) ---
+function loadMorePosts(link) {
+    if (link.dataset.loading) return;
+    link.dataset.loading = '1';
+    const url = new URL(link.href);
+    url.searchParams.set('partial', '1');
+
+    fetch(url)
+        .then(response => response.text())
+        .then(html => {
+            const template = document.createElement('template');
+            template.innerHTML = html;
+            const nextLink = template.content.querySelector('.load-more');
+            if (nextLink) nextLink.remove();
+            link.parentNode.insertBefore(template.content, link);
+            if (nextLink) {
+                link.replaceWith(nextLink);
+                observeLoadMore(nextLink);
+            } else {
+                link.remove();
+            }
+        })
+        .catch(error => {
+            console.error('Error loading more posts:', error);
+            delete link.dataset.loading;
+        });
+}
+
+const loadMoreObserver = 'IntersectionObserver' in window
+    ? new IntersectionObserver(entries => {
+        entries.forEach(entry => {
+            if (entry.isIntersecting) {
+                loadMoreObserver.unobserve(entry.target);
+                loadMorePosts(entry.target);
+            }
+        });
+    }, { rootMargin: '400px' })
+    : null;
+
+function observeLoadMore(link) {
+    link.addEventListener('click', event => {
+        event.preventDefault();
+        loadMorePosts(link);
+    });
+    if (loadMoreObserver) loadMoreObserver.observe(link);
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('.post-grid .load-more').forEach(observeLoadMore);
+});
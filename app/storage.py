@@ -0,0 +1,151 @@
+"""
+アップロード画像の保存先
+
+アップロードはチャンクごとにSHA-256を計算しながら一時ファイルへ書き出し、
+内容のハッシュをファイル名にして保存する (同じ画像は1つのファイルを共有する)。
+ハッシュの名前のファイルは書き換えない (縮小版などは別の名前で保存する)。
+
+投稿を削除してもファイルはすぐには消さず、どの投稿からも参照されなくなったファイルを
+`flask uploads-gc` でまとめて消す (同じ画像のアップロードと削除が同時に起きても、
+まだ使うファイルを消さないように)。同じ画像がもう一度アップロードされると
+ファイルの更新時刻を新しくするので、UPLOAD_GC_GRACE_SECONDS の間は消されない。
+
+STORAGE_BACKEND で保存先を切り替える:
+  'local'       : app/static/uploads に置き、static から配信する (従来どおり)
+  'objectstore' : STORAGE_ROOT 以下にキーを分散して置き、/media/ から配信する
+                  (S3などのオブジェクトストレージの代わりのローカル実装)
+"""
+import hashlib
+import os
+import re
+import tempfile
+from flask import current_app, url_for
+from werkzeug.exceptions import RequestEntityTooLarge
+
+CHUNK_SIZE = 64 * 1024
+
+# ハッシュで名前を付けたファイル (縮小版は <hash>_<size>.<形式>)
+HASHED_NAME = re.compile(r'^[0-9a-f]{64}(_\w+)?(\.\w+)?$')
+# アップロードされた内容そのもの (名前が内容のハッシュなので、書き換えてはいけない)
+CONTENT_NAME = re.compile(r'^[0-9a-f]{64}(\.\w+)?$')
+
+TEMP_PREFIX = '.upload-'
+
+
+class LocalStorage:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.root, name)
+
+    def save_upload(self, stream, extension, max_size=None):
+        """
+        Copy `stream` into storage chunk by chunk and return its name,
+        '<sha256 of the content><extension>'. If the same content is
+        already stored, the new copy is discarded. Raises
+        RequestEntityTooLarge once more than `max_size` bytes were read.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                while chunk := stream.read(CHUNK_SIZE):
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise RequestEntityTooLarge()
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            name = digest.hexdigest() + extension
+            self._move(tmp_path, name)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return name
+
+    def put(self, name, data):
+        """名前を指定して保存する (縮小版など)。書き込み途中のファイルは見えない"""
+        if CONTENT_NAME.match(name):
+            raise ValueError(f'{name} is named by its content and cannot be overwritten')
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.makedirs(os.path.dirname(self._path(name)), exist_ok=True)
+            os.replace(tmp_path, self._path(name))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _move(self, tmp_path, name):
+        path = self._path(name)
+        try:
+            # 既にあれば使い回し、更新時刻を新しくして uploads-gc に消されないようにする
+            # (確認と更新を1回で行うので、gc が同時に退避しても FileNotFoundError になる)
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+
+    def open(self, name):
+        return open(self._path(name), 'rb')
+
+    def exists(self, name):
+        return not name.startswith('.') and os.path.isfile(self._path(name))
+
+    def delete(self, name):
+        if self.exists(name):
+            os.remove(self._path(name))
+
+    def names(self):
+        """保存されている全てのファイルの名前 (書き込み途中の一時ファイルは除く)"""
+        for _, _, filenames in os.walk(self.root):
+            yield from (name for name in filenames if not name.startswith('.'))
+
+    def delete_stale(self, name, cutoff):
+        """
+        Delete `name` unless it was stored or uploaded again after `cutoff`
+        (a time.time() value) and return whether it was deleted.
+
+        The file is first renamed out of the way, so an upload of the same
+        content that starts meanwhile writes a new copy instead of reusing
+        it; if it was touched after all, it is put back.
+        """
+        path = self._path(name)
+        trash = os.path.join(os.path.dirname(path), f'{TEMP_PREFIX}gc-{name}')
+        try:
+            os.rename(path, trash)
+        except FileNotFoundError:
+            return False
+        if os.stat(trash).st_mtime >= cutoff:
+            os.replace(trash, path)
+            return False
+        os.remove(trash)
+        return True
+
+    def url(self, name):
+        return url_for('static', filename='uploads/' + name)
+
+
+class ObjectStoreStorage(LocalStorage):
+    """キーの先頭4文字で2段のディレクトリに分けて保存し、/media/<name> から配信する"""
+
+    def _path(self, name):
+        return os.path.join(self.root, name[:2], name[2:4], name)
+
+    def url(self, name):
+        return url_for('media', name=name)
+
+
+def get_storage():
+    storage = current_app.extensions.get('storage')
+    if storage is None:
+        config = current_app.config
+        if config['STORAGE_BACKEND'] == 'objectstore':
+            storage = ObjectStoreStorage(config['STORAGE_ROOT'])
+        else:
+            storage = LocalStorage(os.path.join(current_app.root_path, 'static', 'uploads'))
+        current_app.extensions['storage'] = storage
+    return storage
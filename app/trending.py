@@ -0,0 +1,135 @@
+"""
+投稿とお店の人気のスコア (時間で減衰する)
+
+いいね・コメント・ブックマーク・投稿のたびに、対象の hot_score に重み (TRENDING_WEIGHTS) を
+足す (投稿へのいいね・コメントは、そのお店にも足す)。`flask trending-decay` を cron などで
+定期的に動かし、前回からの経過時間に応じて全ての行を 2^(-経過時間 / 半減期) 倍する。
+全ての行を同じ割合で減らすので、保存されたスコアの順番は「今の時点で減衰させたスコア」の
+順番と同じになり、人気順の一覧は hot_score の索引を上から読むだけで返せる。
+
+前回の減衰より後の操作は、減衰の時刻に行われたものとして数える
+(減衰の間隔を半減期より十分短くしておけば、ずれは数%以内)。
+TRENDING_MIN_SCORE を下回ったスコアは 0 にして、次からは減衰のUPDATEの対象から外す。
+"""
+from collections import defaultdict
+from datetime import datetime, timezone
+from flask import current_app
+from sqlalchemy import bindparam, case, select, update
+from app import db
+from app.geo import bbox_filter, radius_bbox, squared_distance_km
+from app.models import Post, Shop, Comment, TrendingDecay
+
+SHOP_COLUMNS = (Shop.id, Shop.name, Shop.osm_id, Shop.latitude, Shop.longitude, Shop.hot_score)
+
+BATCH_SIZE = 1000
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _decay_factor(since, now):
+    hours = max((now - since).total_seconds() / 3600, 0.0)
+    return 2 ** (-hours / current_app.config['TRENDING_HALF_LIFE_HOURS'])
+
+
+def decay_scores(now=None):
+    """
+    Decay every non-zero hot_score by the time elapsed since the last run
+    and return (factor, rows updated). The first run only starts the clock.
+    """
+    now = now or _utcnow()
+    minimum = current_app.config['TRENDING_MIN_SCORE']
+    state = db.session.execute(select(TrendingDecay).with_for_update()).scalar()
+    if state is None:
+        db.session.add(TrendingDecay(id=1, decayed_at=now))
+        db.session.commit()
+        return 1.0, 0
+    factor = _decay_factor(state.decayed_at, now)
+    updated = 0
+    for model in (Post, Shop):
+        decayed = model.hot_score * factor
+        result = db.session.execute(update(model).where(model.hot_score > 0)
+                                    .values(hot_score=case((decayed < minimum, 0.0), else_=decayed))
+                                    .execution_options(synchronize_session=False))
+        updated += result.rowcount
+    state.decayed_at = now
+    db.session.commit()
+    return factor, updated
+
+
+def _write_scores(model, scores):
+    table = model.__table__
+    db.session.execute(update(model).values(hot_score=0.0).execution_options(synchronize_session=False))
+    statement = update(table).where(table.c.id == bindparam('target_id')).values(hot_score=bindparam('score'))
+    rows = [{'target_id': target_id, 'score': score} for target_id, score in scores.items()]
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.session.execute(statement, rows[start:start + BATCH_SIZE])
+
+
+def rebuild_scores(now=None):
+    """
+    Recompute every hot_score from the stored posts, likes and comments,
+    restart the decay clock and return (posts, shops) with a score.
+
+    Likes have no timestamp, so they count as if given when the post was
+    published; bookmarks have none either and are left out.
+    """
+    now = now or _utcnow()
+    config = current_app.config
+    weights = config['TRENDING_WEIGHTS']
+    minimum = config['TRENDING_MIN_SCORE']
+    post_scores = defaultdict(float)
+    shop_scores = defaultdict(float)
+    post_shops = {}
+    rows = db.session.execute(select(Post.id, Post.shop_id, Post.timestamp, Post.likes_count)
+                              .execution_options(yield_per=BATCH_SIZE))
+    for post_id, shop_id, timestamp, like_count in rows:
+        factor = _decay_factor(timestamp, now)
+        post_shops[post_id] = shop_id
+        post_scores[post_id] += weights['like'] * like_count * factor
+        shop_scores[shop_id] += (weights['like'] * like_count + weights['post']) * factor
+    rows = db.session.execute(select(Comment.post_id, Comment.timestamp).execution_options(yield_per=BATCH_SIZE))
+    for post_id, timestamp in rows:
+        score = weights['comment'] * _decay_factor(timestamp, now)
+        post_scores[post_id] += score
+        shop_scores[post_shops[post_id]] += score
+
+    post_scores = {key: value for key, value in post_scores.items() if value >= minimum}
+    shop_scores = {key: value for key, value in shop_scores.items() if value >= minimum}
+    _write_scores(Post, post_scores)
+    _write_scores(Shop, shop_scores)
+    state = db.session.get(TrendingDecay, 1)
+    if state is None:
+        db.session.add(TrendingDecay(id=1, decayed_at=now))
+    else:
+        state.decayed_at = now
+    db.session.commit()
+    return len(post_scores), len(shop_scores)
+
+
+def trending_post_ids(limit):
+    """人気の投稿のID (ix_post_hot_score を上から読む)"""
+    return db.session.scalars(select(Post.id).where(Post.hot_score > 0)
+                              .order_by(Post.hot_score.desc(), Post.id.desc()).limit(limit)).all()
+
+
+def trending_shops(limit):
+    return db.session.execute(select(*SHOP_COLUMNS).where(Shop.hot_score > 0)
+                              .order_by(Shop.hot_score.desc(), Shop.id.desc()).limit(limit)).all()
+
+
+def popular_nearby_shops(lat, lon, radius_km, limit):
+    """
+    Shops within radius_km of (lat, lon), most popular first and nearest
+    first among equally popular ones. Only the grid cells around the
+    point are read from ix_shop_geocell_hot_score; the corners of that
+    box outside the circle are then cut off by distance.
+    """
+    south, west, north, east = radius_bbox(lat, lon, radius_km)
+    distance = squared_distance_km(Shop.latitude, Shop.longitude, lat, lon)
+    return db.session.execute(
+        select(*SHOP_COLUMNS)
+        .where(bbox_filter(Shop.latitude, Shop.longitude, Shop.geocell, south, west, north, east),
+               Shop.hot_score > 0, distance <= radius_km ** 2)
+        .order_by(Shop.hot_score.desc(), distance, Shop.id.desc()).limit(limit)).all()
@@ -0,0 +1,265 @@
+"""
+外部API (Overpass / Nominatim) 用の共有HTTPクライアント
+
+サービスごとに1つの requests.Session を使い回し (keep-alive の接続プール)、
+タイムアウト・トークンバケットによる流量制限・同時実行数の上限・
+同一リクエストの相乗り (single-flight)・一時的な失敗の再試行・サーキットブレーカーを
+まとめて扱う。
+設定は config.py の UPSTREAM_SERVICES と各APIのURL。
+"""
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
+from app.metrics import observe_upstream
+
+
+class UpstreamError(requests.RequestException):
+    """外部APIの呼び出しに失敗した (既存の except requests.RequestException でも捕まえられる)"""
+
+
+class TransientError(UpstreamError):
+    """接続できない・502/503/504・429 など、少し待てば成功しうる失敗 (再試行の対象)"""
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class RateLimitedError(UpstreamError):
+    pass
+
+
+class TokenBucket:
+    """rate 個/秒 で補充され、最大 burst 個まで貯まるトークンバケット"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, max_wait):
+        """トークンを1つ取る。max_wait 秒以内に取れなければ False"""
+        deadline = time.monotonic() + max_wait
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Open after `failure_threshold` consecutive failures and reject calls
+    for `reset_timeout` seconds. After that a single trial call is let
+    through (half-open); its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # 試しに1件だけ通し、他の呼び出しは引き続き止める
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """同じキーの呼び出しが実行中なら、新しく実行せずにその結果を待って共有する"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class UpstreamClient:
+    def __init__(self, name, url, timeout=(3.05, 10), rate=1.0, burst=1, max_concurrent=4,
+                 max_wait=5.0, failure_threshold=5, reset_timeout=30.0, retries=0, backoff=0.5):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        self.max_wait = max_wait
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._single_flight = SingleFlight()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # 計測用 (呼び出し回数・失敗回数・合計時間)
+        self.requests = 0
+        self.failures = 0
+        self.seconds = 0.0
+        self._stats_lock = threading.Lock()
+
+    def get_json(self, params=None, headers=None, parse=None):
+        """
+        GET the service URL and return the decoded JSON body.
+
+        If `parse` is given, the body is streamed instead and the result
+        of `parse(response)` is returned, so large bodies can be decoded
+        incrementally; `parse` should close the response when done.
+
+        Identical concurrent calls share one upstream request. Transient
+        failures (TransientError) are retried up to `retries` times with
+        exponential backoff; each attempt takes its own rate-limit token and
+        counts towards the circuit breaker. Raises UpstreamError (a
+        requests.RequestException) on timeouts, connection errors, non-200
+        responses, an open circuit, or when no rate-limit token or
+        connection slot frees up within max_wait.
+        """
+        key = (self.url, tuple(sorted((params or {}).items())))
+        return self._single_flight.do(key, lambda: self._request_with_retries(params, headers, parse))
+
+    def _retry_delay(self, attempt, error):
+        delay = self.backoff * 2 ** attempt
+        # 429/503 の Retry-After (秒) が max_wait 以内なら、それに従う
+        retry_after = error.response.headers.get('Retry-After') if error.response is not None else None
+        if retry_after and retry_after.isdigit() and int(retry_after) <= self.max_wait:
+            delay = max(delay, int(retry_after))
+        return delay
+
+    def _request_with_retries(self, params, headers, parse):
+        for attempt in range(self.retries + 1):
+            try:
+                return self._request(params, headers, parse)
+            except TransientError as e:
+                if attempt == self.retries:
+                    raise
+                time.sleep(self._retry_delay(attempt, e))
+
+    def _record(self, started, failed):
+        seconds = time.perf_counter() - started
+        with self._stats_lock:
+            self.requests += 1
+            self.failures += failed
+            self.seconds += seconds
+        observe_upstream(self.name, seconds, failed)
+
+    def _request(self, params, headers, parse=None):
+        if not self.breaker.allow():
+            raise CircuitOpenError(f'{self.name}: circuit open')
+        if not self.bucket.acquire(self.max_wait):
+            raise RateLimitedError(f'{self.name}: rate limit exceeded')
+        if not self._slots.acquire(timeout=self.max_wait):
+            raise RateLimitedError(f'{self.name}: too many concurrent requests')
+        # 本文を読み終わるまで接続を使うので、枠もそれまで返さない
+        started = time.perf_counter()
+        try:
+            return self._send(params, headers, parse, started)
+        finally:
+            self._slots.release()
+
+    def _send(self, params, headers, parse, started):
+        try:
+            response = self.session.get(self.url, params=params, headers=headers, timeout=self.timeout,
+                                        stream=parse is not None)
+        except requests.RequestException as e:
+            self._record(started, True)
+            self.breaker.record_failure()
+            # 読み込みのタイムアウトは再試行しない (待ち時間がさらに延びるだけなので)
+            error = UpstreamError if isinstance(e, requests.ReadTimeout) else TransientError
+            raise error(f'{self.name}: {e}') from e
+
+        if response.status_code >= 500 or response.status_code == 429:
+            response.close()
+            self._record(started, True)
+            self.breaker.record_failure()
+            error = TransientError if response.status_code in (429, 502, 503, 504) else UpstreamError
+            raise error(f'{self.name}: HTTP {response.status_code}', response=response)
+        if response.status_code != 200:
+            # 4xx はリクエスト側の問題なので、ブレーカーの失敗には数えない
+            response.close()
+            self.breaker.record_success()
+            self._record(started, True)
+            raise UpstreamError(f'{self.name}: HTTP {response.status_code}', response=response)
+        try:
+            data = response.json() if parse is None else parse(response)
+        except requests.RequestException as e:
+            # 本文の途中で切断・タイムアウトした
+            self._record(started, True)
+            self.breaker.record_failure()
+            raise UpstreamError(f'{self.name}: {e}') from e
+        except ValueError as e:
+            self._record(started, True)
+            self.breaker.record_success()
+            raise UpstreamError(f'{self.name}: invalid JSON') from e
+        self.breaker.record_success()
+        self._record(started, False)
+        return data
+
+
+def get_client(name):
+    clients = current_app.extensions.setdefault('upstream', {})
+    client = clients.get(name)
+    if client is None:
+        config = current_app.config
+        url = {'overpass': config['OVERPASS_API_URL'], 'nominatim': config['NOMINATIM_API_URL']}[name]
+        client = clients[name] = UpstreamClient(name, url, **config['UPSTREAM_SERVICES'][name])
+    return client
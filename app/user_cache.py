@@ -0,0 +1,65 @@
+"""
+ログイン中のユーザーのキャッシュ (Flask-Login の load_user 用)
+
+リクエストのたびに user テーブルを SELECT しないように、User の列の値を
+プロセス内のLRUに USER_CACHE_TTL 秒だけ保存する。インスタンスではなく値を
+保存し、読むたびにそのリクエストのセッションに SELECT なしで組み立て直す。
+User が更新・削除されたときは、その commit の後でこのプロセスのキャッシュから消す
+(他のプロセスでは最大 TTL 秒だけ古い値が見える)。
+"""
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+
+
+class UserCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, user_id, values):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def get_user_cache():
+    cache = current_app.extensions.get('user_cache')
+    if cache is None:
+        cache = UserCache(current_app.config['USER_CACHE_TTL'], current_app.config['USER_CACHE_MAX_ENTRIES'])
+        current_app.extensions['user_cache'] = cache
+    return cache
@@ -0,0 +1,369 @@
+"""
+いいね・ブックマークの書き込みの後回し (write-behind)
+
+WRITE_BEHIND_ENABLED のとき、/like などのクリックはDBに書き込まずに
+  1. このプロセスの追記ログ (WRITE_BEHIND_LOG_DIR/write-behind-<pid>.log) に1行書いて
+     fsync し (同時に来たクリックは1回の fsync にまとめる)、
+  2. メモリ上の未反映の状態に入れて、すぐに返す。
+バックグラウンドのスレッドが WRITE_BEHIND_FLUSH_INTERVAL 秒ごとに、たまった操作を
+WRITE_BEHIND_BATCH_SIZE 件ずつ1トランザクションでDBに反映する。同じ (ユーザー, 対象) の
+操作は最後の状態だけを書くので、連打しても1回分の書き込みで済む。
+
+未反映の状態は、押した本人のいいね済み・ブックマーク済みの表示と、いいね数に
+重ねて返す (read-your-writes)。ログはDBに反映するたびに反映済みの位置を書き、
+未反映の操作が無くなったら空にする。プロセスが落ちた場合は
+`flask write-behind-replay` でログに残った操作を反映する。
+
+未反映の状態はプロセスのメモリにあるので、書き込みを後回しにできるのは1つのプロセス
+(スレッドは複数でよい) だけ。アプリを作るときに WRITE_BEHIND_LOG_DIR のロックファイルを取り、
+他のプロセスが使っていればエラーをログに出して、そのプロセスでは同期でDBに書き込む
+(gunicorn などは --workers 1 で動かす)。
+"""
+import atexit
+import fcntl
+import glob
+import itertools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Post, Shop, likes, bookmarks, insert_ignore, delete_row, hot_score_after, add_hot_score
+
+# 種類 -> (関連テーブル, ユーザーの列, 対象の列, 対象のモデル, 件数カラム)
+KINDS = {
+    'like': (likes, 'user_id', 'post_id', Post, 'likes_count'),
+    'bookmark': (bookmarks, 'user_id', 'shop_id', Shop, 'bookmarks_count'),
+}
+
+
+def _apply_one(kind, user_id, target_id, state):
+    table, user_column, target_column, _, _ = KINDS[kind]
+    values = {user_column: user_id, target_column: target_id}
+    return insert_ignore(table, **values) if state else delete_row(table, **values)
+
+
+def apply_toggles(toggles):
+    """
+    Write {(kind, user_id, target_id): state} to the database in one
+    transaction. Rows are inserted or deleted idempotently and the
+    counters move only for rows that actually changed. If a row is
+    rejected (e.g. its post was deleted meanwhile), the batch is retried
+    row by row and the rejected rows are skipped.
+    """
+    deltas = defaultdict(int)
+    try:
+        for (kind, user_id, target_id), state in toggles.items():
+            if _apply_one(kind, user_id, target_id, state):
+                deltas[kind, target_id] += 1 if state else -1
+    except IntegrityError:
+        db.session.rollback()
+        deltas.clear()
+        for (kind, user_id, target_id), state in toggles.items():
+            try:
+                with db.session.begin_nested():
+                    changed = _apply_one(kind, user_id, target_id, state)
+            except IntegrityError:
+                current_app.logger.warning('write-behind: skipped %s %s -> %s', kind, user_id, target_id)
+                continue
+            if changed:
+                deltas[kind, target_id] += 1 if state else -1
+    for (kind, target_id), delta in deltas.items():
+        if delta:
+            model, counter = KINDS[kind][3], KINDS[kind][4]
+            db.session.execute(update(model).where(model.id == target_id)
+                               .values({counter: getattr(model, counter) + delta,
+                                        'hot_score': hot_score_after(model, kind, delta)})
+                               .execution_options(synchronize_session=False))
+            if model is Post:
+                # 投稿へのいいねは、そのお店の人気にも足す
+                add_hot_score(Shop, select(Post.shop_id).where(Post.id == target_id).scalar_subquery(), kind, delta)
+    db.session.commit()
+
+
+class WriteBehindUnavailable(RuntimeError):
+    """他のプロセスが write-behind を使っている (未反映の状態を共有できないので、2つ目は動かさない)"""
+
+
+def read_log(path):
+    """ログのうち、最後の反映済みの位置より後の操作を (最後の状態だけにまとめて) 返す"""
+    toggles = {}
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # 書き込み途中で落ちた最後の行
+            if 'flushed' in record:
+                # ここまでの操作は、DBに反映済みか、後の行の操作で上書きされている
+                toggles = {key: value for key, value in toggles.items() if value[0] > record['flushed']}
+            else:
+                key = (record['kind'], record['user_id'], record['target_id'])
+                toggles.pop(key, None)
+                toggles[key] = (record['seq'], record['state'])
+    return {key: state for key, (seq, state) in toggles.items()}
+
+
+class WriteBehind:
+    def __init__(self, app, log_dir, interval, batch_size):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        os.makedirs(log_dir, exist_ok=True)
+        self._owner = _lock_owner(os.path.join(log_dir, 'write-behind.lock'))
+        self.log_path = os.path.join(log_dir, f'write-behind-{os.getpid()}.log')
+        self._log = open(self.log_path, 'a', encoding='utf-8')
+        # (kind, user_id, target_id) -> (seq, state, base)。base はDBの状態 (と思われるもの)
+        # 辞書の順番は seq の順 (押し直したら末尾に入れ直す)
+        self._pending = {}
+        # (kind, target_id) -> 未反映の件数の増減
+        self._deltas = defaultdict(int)
+        self._seq = 0
+        self._synced = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.flushed = 0
+        self.batches = 0
+        self.syncs = 0
+        self._closed = False
+        atexit.register(self.close)
+
+    def pending_state(self, kind, user_id, target_id):
+        """未反映の状態 (無ければ None)"""
+        with self._lock:
+            entry = self._pending.get((kind, user_id, target_id))
+            return None if entry is None else entry[1]
+
+    def submit(self, kind, user_id, target_id, state, current):
+        """
+        Record that the user set (kind, target) to `state`. `current` is
+        the state in the database, used only when nothing is pending for
+        this pair. Returns once the log line is on disk.
+        """
+        key = (kind, user_id, target_id)
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+            self._log.write(json.dumps({'seq': seq, 'kind': kind, 'user_id': user_id,
+                                        'target_id': target_id, 'state': state}) + '\n')
+            self._log.flush()
+            entry = self._pending.pop(key, None)
+            base = current if entry is None else entry[2]
+            if entry is not None:
+                self._deltas[kind, target_id] -= entry[1] - entry[2]
+            self._pending[key] = (seq, state, base)
+            self._deltas[kind, target_id] += state - base
+        self._sync(seq)
+        self._start()
+
+    def _sync(self, seq):
+        """
+        fsync the log up to `seq` (group commit: one thread syncs while
+        the others wait, and their lines are usually covered by that same
+        fsync).
+        """
+        with self._sync_lock:
+            if self._synced >= seq:
+                return
+            with self._lock:
+                # ここまでの行はOSに渡し済み (write と flush は _lock の中で行う)
+                upto = self._seq
+            os.fsync(self._log.fileno())
+            self._synced = upto
+            self.syncs += 1
+
+    def count_delta(self, kind, target_id):
+        with self._lock:
+            return self._deltas.get((kind, target_id), 0)
+
+    def overlay_ids(self, kind, user_id, ids, candidate_ids=None):
+        """DBから読んだ対象IDの集合に、ユーザーの未反映の操作を重ねる"""
+        ids = set(ids)
+        candidates = None if candidate_ids is None else set(candidate_ids)
+        with self._lock:
+            for (pending_kind, pending_user, target_id), (_, state, _) in self._pending.items():
+                if pending_kind != kind or pending_user != user_id:
+                    continue
+                if candidates is not None and target_id not in candidates:
+                    continue
+                if state:
+                    ids.add(target_id)
+                else:
+                    ids.discard(target_id)
+        return ids
+
+    def flush(self):
+        """未反映の操作をDBに反映して、反映した件数を返す (アプリのコンテキストで呼ぶ)"""
+        total = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = list(itertools.islice(self._pending.items(), self.batch_size))
+                if not batch:
+                    break
+                apply_toggles({key: state for key, (_, state, _) in batch})
+                with self._lock:
+                    for key, (seq, state, base) in batch:
+                        kind, _, target_id = key
+                        entry = self._pending.get(key)
+                        if entry[0] == seq:
+                            del self._pending[key]
+                            self._deltas[kind, target_id] -= state - base
+                        else:
+                            # 反映中に押し直された。DBは state になったので、それを基準にする
+                            self._pending[key] = (entry[0], entry[1], state)
+                            self._deltas[kind, target_id] += base - state
+                        if not self._deltas[kind, target_id]:
+                            del self._deltas[kind, target_id]
+                    if self._pending:
+                        self._log.write(json.dumps({'flushed': batch[-1][1][0]}) + '\n')
+                        self._log.flush()
+                    else:
+                        self._log.truncate(0)
+                total += len(batch)
+                self.batches += 1
+        self.flushed += total
+        return total
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    # 反映できなかった操作は残して、次の周期でやり直す
+                    db.session.rollback()
+                    self.app.logger.exception('write-behind flush failed')
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('write-behind flush failed, run `flask write-behind-replay`')
+        self._log.close()
+        if os.path.exists(self.log_path) and os.path.getsize(self.log_path) == 0:
+            os.remove(self.log_path)
+        self._owner.close()
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {'pending': pending, 'flushed': self.flushed, 'batches': self.batches, 'syncs': self.syncs}
+
+
+def _lock_owner(path):
+    """ロックファイルを開いて排他ロックを取る (プロセスが終われば自動で外れる)"""
+    file = open(path, 'a+', encoding='utf-8')
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        file.seek(0)
+        owner = file.read().strip() or 'another process'
+        file.close()
+        raise WriteBehindUnavailable(
+            f'write-behind is already enabled in process {owner}; its pending writes live in that '
+            'process, so run a single worker process or turn WRITE_BEHIND_ENABLED off') from None
+    file.truncate(0)
+    file.write(str(os.getpid()))
+    file.flush()
+    return file
+
+
+def _create(app):
+    config = app.config
+    try:
+        return WriteBehind(app, config['WRITE_BEHIND_LOG_DIR'],
+                           config['WRITE_BEHIND_FLUSH_INTERVAL'], config['WRITE_BEHIND_BATCH_SIZE'])
+    except WriteBehindUnavailable as error:
+        app.logger.error('%s (writing likes and bookmarks synchronously in process %s)', error, os.getpid())
+        return None
+
+
+def _cli_command():
+    """flask の CLI コマンド (リクエストを受けない) で読み込まれたか"""
+    return os.environ.get('FLASK_RUN_FROM_CLI') == 'true' and os.environ.get('WERKZEUG_RUN_MAIN') != 'true'
+
+
+def init_app(app):
+    """
+    Take the write-behind lock while the app is created, so a second
+    worker process reports it at startup and writes synchronously instead
+    of failing requests. CLI commands leave the lock to the server and
+    take it only if they use write-behind.
+    """
+    if app.config['WRITE_BEHIND_ENABLED'] and not _cli_command():
+        app.extensions['write_behind'] = _create(app)
+
+
+def write_behind_enabled():
+    return current_app.config['WRITE_BEHIND_ENABLED'] and get_write_behind() is not None
+
+
+def get_write_behind():
+    """このプロセスの WriteBehind (ロックが取れず、同期で書き込むプロセスでは None)"""
+    extensions = current_app.extensions
+    if 'write_behind' not in extensions:
+        extensions['write_behind'] = _create(current_app._get_current_object())
+    return extensions['write_behind']
+
+
+def submit_toggle(kind, user, target, state):
+    """
+    Queue a like/bookmark toggle and return the target's count as the
+    user will see it, including the changes not yet written.
+    """
+    write_behind = get_write_behind()
+    current = write_behind.pending_state(kind, user.id, target.id)
+    if current is None:
+        table, user_column, target_column, _, _ = KINDS[kind]
+        current = db.session.query(table).filter(table.c[user_column] == user.id,
+                                                 table.c[target_column] == target.id).first() is not None
+    write_behind.submit(kind, user.id, target.id, state, current)
+    return getattr(target, KINDS[kind][4]) + write_behind.count_delta(kind, target.id)
+
+
+def replay_logs(log_dir):
+    """
+    Apply the operations left in the logs of processes that are no
+    longer running, then delete those logs. Returns (files, operations).
+    """
+    files = operations = 0
+    for path in sorted(glob.glob(os.path.join(log_dir, 'write-behind-*.log'))):
+        pid = int(os.path.basename(path)[len('write-behind-'):-len('.log')])
+        if pid != os.getpid() and _pid_alive(pid):
+            continue
+        toggles = read_log(path)
+        if toggles:
+            apply_toggles(toggles)
+        os.remove(path)
+        files += 1
+        operations += len(toggles)
+    return files, operations
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
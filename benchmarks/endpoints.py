@@ -0,0 +1,166 @@
+"""
+主なエンドポイントのベンチマーク (p50 / p99 とリクエストあたりのSQLの回数)
+
+合成データ (app/seed.py) を入れたSQLiteデータベースに対して、Flaskのテストクライアントから
+タイムライン・地図・お店・プロフィール・いいね・フォローを呼び出す。ログインするのは
+一番人気のユーザー (user1)。結果は benchmarks/results/<日時>-<コミット>.json に保存し、
+--compare で前の結果と比べられる。
+
+    python benchmarks/endpoints.py --db /tmp/bench.db            # 無ければ作って seed する
+    python benchmarks/endpoints.py --db /tmp/bench.db --compare benchmarks/results/<前の結果>.json
+
+設定は環境変数のまま読むので、WRITE_BEHIND_ENABLED=1 などを付けて同じデータで比べられる。
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+# 地図の初期表示 (zoom 13) と同程度の範囲
+TOKYO = '35.65,139.70,35.71,139.80'
+
+
+def scenarios(viewer, other_user):
+    """(名前, メソッド, i 回目のURLを返す関数)。いいね・フォローは押す・外すを交互に繰り返す"""
+    return [
+        ('timeline', 'get', lambda i: '/api/timeline'),
+        ('timeline cursor', 'get', lambda i: '/api/timeline?cursor='),
+        ('timeline following', 'get', lambda i: '/api/timeline?filter=following'),
+        ('timeline nearby', 'get', lambda i: '/api/timeline?lat=35.68&lon=139.76'),
+        ('shops bbox', 'get', lambda i: '/api/shops?bbox=' + TOKYO),
+        ('shop posts', 'get', lambda i: '/api/shops/1/posts'),
+        ('shop page', 'get', lambda i: '/shop/1'),
+        ('profile', 'get', lambda i: f'/user/{viewer}'),
+        ('post detail', 'get', lambda i: '/post/1'),
+        ('index', 'get', lambda i: '/index'),
+        ('search', 'get', lambda i: '/api/search?q=ラーメン'),
+        ('trending posts', 'get', lambda i: '/api/trending'),
+        ('trending shops', 'get', lambda i: '/api/trending?type=shop'),
+        ('popular nearby', 'get', lambda i: '/api/popular_nearby?lat=35.68&lon=139.76&radius_km=10'),
+        ('like toggle', 'post', lambda i: ('/like/1', '/unlike/1')[i % 2]),
+        ('follow toggle', 'post', lambda i: (f'/follow/{other_user}', f'/unfollow/{other_user}')[i % 2]),
+    ]
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(app, client, name, method, url, repeat, warmup):
+    for i in range(warmup):
+        getattr(client, method)(url(i)).close()
+    # 計測値 (app/metrics.py) をシナリオごとに作り直して、SQLの回数を数える
+    app.extensions.pop('metrics', None)
+    timings = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        response = getattr(client, method)(url(warmup + i))
+        # ストリーミングのレスポンスは最後まで読んでから閉じる
+        response.get_data()
+        response.close()
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, (name, response.status_code)
+    snapshot = app.extensions['metrics'].snapshot()
+    queries = sum(count for count, _ in snapshot['queries'].values())
+    cuts = statistics.quantiles(timings, n=100, method='inclusive')
+    return {'requests': repeat, 'p50_ms': cuts[49] * 1000, 'p99_ms': cuts[98] * 1000,
+            'mean_ms': statistics.fmean(timings) * 1000, 'queries': queries / repeat}
+
+
+def print_results(results, previous=None):
+    print(f'{"scenario":<20} {"p50 ms":>9} {"p99 ms":>9} {"queries":>8}' + ('   vs previous' if previous else ''))
+    for name, result in results.items():
+        line = f'{name:<20} {result["p50_ms"]:>9.2f} {result["p99_ms"]:>9.2f} {result["queries"]:>8.1f}'
+        before = (previous or {}).get(name)
+        if before:
+            line += (f'   p50 {(result["p50_ms"] / before["p50_ms"] - 1) * 100:+.0f}%'
+                     f'  p99 {(result["p99_ms"] / before["p99_ms"] - 1) * 100:+.0f}%'
+                     f'  queries {result["queries"] - before["queries"]:+.1f}')
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='SQLite file to reuse (seeded if it does not exist)')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--shops', type=int, default=5000)
+    parser.add_argument('--posts', type=int, default=50000)
+    parser.add_argument('--comments', type=int, default=100000)
+    parser.add_argument('--likes', type=int, default=300000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--bookmarks', type=int, default=20000)
+    parser.add_argument('--skew', type=float, default=1.1)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--only', nargs='+', metavar='SCENARIO', help='run only these scenarios')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<time>-<commit>.json)')
+    parser.add_argument('--compare', help='earlier result file to compare against')
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.db) if args.db else os.path.join(tempfile.mkdtemp(prefix='bench_endpoints_'),
+                                                                  'bench.db')
+    fresh = not os.path.exists(path)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+
+    from flask_migrate import upgrade
+    from app import app, db
+    from app.models import User
+    from app.seed import seed
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        if fresh:
+            upgrade(directory=os.path.join(ROOT, 'migrations'))
+            started = time.perf_counter()
+            seed(args.users, args.shops, args.posts, args.comments, args.likes, args.follows, args.bookmarks,
+                 skew=args.skew)
+            print(f'seeded {path} in {time.perf_counter() - started:.1f}s')
+        viewer = db.session.get(User, 1)
+        # まだフォローしていない人気ユーザーを、フォローの押す・外すに使う
+        other = next(user for user in User.query.order_by(User.id)
+                     if user.id != viewer.id and not viewer.is_following(user))
+        sizes = {'users': User.query.count(), 'database_bytes': os.path.getsize(path)}
+        viewer_name, other_name = viewer.username, other.username
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+        session['_fresh'] = True
+
+    results = {}
+    for name, method, url in scenarios(viewer_name, other_name):
+        if args.only and name not in args.only:
+            continue
+        results[name] = run(app, client, name, method, url, args.repeat, args.warmup)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            previous = json.load(file)['results']
+    print_results(results, previous)
+
+    revision = git_revision()
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results',
+                                         f'{datetime.now():%Y%m%d-%H%M%S}-{revision}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump({'revision': revision, 'created': datetime.now().isoformat(timespec='seconds'),
+                   'database': path, 'sizes': sizes, 'repeat': args.repeat, 'results': results},
+                  file, ensure_ascii=False, indent=2)
+    print(f'saved {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+/api/shops の全件返却と、bbox (表示範囲) 検索を比較するベンチマーク
+
+一時的なSQLiteデータベースにお店を作り、Flaskのテストクライアントから
+エンドポイントを呼び出して時間とレスポンスサイズを計測する。
+
+    python benchmarks/shops_bbox.py --shops 100000 1000000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# 地図の初期表示 (zoom 13) と同程度の範囲
+VIEWPORTS = {
+    'kyoto': (34.98, 135.72, 35.04, 135.82),
+    'tokyo': (35.65, 139.70, 35.71, 139.80),
+}
+CITIES = [(35.68, 139.76), (34.69, 135.50), (35.01, 135.77), (35.18, 136.91), (43.06, 141.35), (33.59, 130.40)]
+
+
+def random_location(rng):
+    # 8割は都市の周辺に集中させ、残りは日本全体に散らす
+    if rng.random() < 0.8:
+        latitude, longitude = rng.choice(CITIES)
+        return rng.gauss(latitude, 0.15), rng.gauss(longitude, 0.15)
+    return rng.uniform(31.0, 45.0), rng.uniform(129.0, 145.0)
+
+
+def time_request(client, url, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(url)
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.status_code
+    return statistics.median(timings), len(response.data), len(response.get_json()['features'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shops', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--full-repeat', type=int, default=1, help='repeats for the full-table dump')
+    parser.add_argument('--skip-full', action='store_true', help='only measure bbox queries')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_shops_')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+
+    from sqlalchemy import insert
+    from app import app, db
+    from app.geo import grid_cell
+    from app.models import User, Shop
+
+    rng = random.Random(42)
+    with app.app_context():
+        db.create_all()
+        user = User(username='bench', email='bench@example.com')
+        user.set_password('bench')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+
+    print(f'{"shops":>9} {"request":<24} {"median ms":>10} {"bytes":>12} {"features":>9}')
+    created = 0
+    for total in sorted(args.shops):
+        with app.app_context():
+            while created < total:
+                batch = []
+                for _ in range(min(50000, total - created)):
+                    latitude, longitude = random_location(rng)
+                    created += 1
+                    batch.append({'osm_id': created, 'name': f'shop {created}', 'latitude': latitude,
+                                  'longitude': longitude, 'geocell': grid_cell(latitude, longitude)})
+                db.session.execute(insert(Shop), batch)
+                db.session.commit()
+
+        requests = [(f'bbox {name}', '/api/shops?bbox=' + ','.join(map(str, box)), args.repeat)
+                    for name, box in VIEWPORTS.items()]
+        if not args.skip_full:
+            requests.append(('full table', '/api/shops', args.full_repeat))
+        for label, url, repeat in requests:
+            seconds, size, features = time_request(client, url, repeat)
+            print(f'{total:>9} {label:<24} {seconds * 1000:>10.1f} {size:>12} {features:>9}')
+
+
+if __name__ == '__main__':
+    main()
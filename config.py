@@ -5,8 +5,128 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir,'app.db')
-    
+
+    # データベースの接続設定 (app/database.py)
+    # SQLite: 接続のたびに設定する PRAGMA
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))  # ミリ秒
+    SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 32 * 1024))  # 接続ごと
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))  # バイト
+    # PostgreSQLなど: ワーカープロセスごとの接続プール
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+    DATABASE_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 20))
+    DATABASE_POOL_TIMEOUT = int(os.environ.get('DATABASE_POOL_TIMEOUT', 10))  # 空き接続を待つ秒数
+    DATABASE_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', 1800))  # この秒数より古い接続は作り直す
+    # 読み込み専用の画面 (@use_replica) を読むレプリカ。書き込んだブラウザはこの秒数だけプライマリから読む
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+    REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
     # データAPI
     OVERPASS_API_URL = 'https://overpass-api.de/api/interpreter'
+    # Overpass APIの検索結果キャッシュ (全ワーカーで共有するSQLiteファイル)
+    OVERPASS_CACHE_PATH = os.environ.get('OVERPASS_CACHE_PATH') or \
+        os.path.join(basedir, 'overpass_cache.db')
+    OVERPASS_CACHE_TTL = int(os.environ.get('OVERPASS_CACHE_TTL', 24 * 60 * 60))  # 秒
+    # Overpassに繋がらない間は、この期間内のタイルなら期限切れでも返す
+    OVERPASS_CACHE_STALE_TTL = int(os.environ.get('OVERPASS_CACHE_STALE_TTL', 7 * 24 * 60 * 60))  # 秒
+    OVERPASS_CACHE_MAX_ENTRIES = int(os.environ.get('OVERPASS_CACHE_MAX_ENTRIES', 50000))  # タイル数
+    OVERPASS_TILE_DEGREES = 0.02  # タイルの大きさ (度)
+    # これより多くのタイルにまたがる広い範囲は、キャッシュを使わずに問い合わせる
+    OVERPASS_CACHE_MAX_TILES_PER_QUERY = 100
+    # 1回の問い合わせで読み込むお店の最大件数 (これを超えた分は読まずに捨てる)
+    OVERPASS_MAX_FEATURES = int(os.environ.get('OVERPASS_MAX_FEATURES', 2000))
     #　自然言語検索用のAPI
-    NOMINATIM_API_URL = 'https://nominatim.openstreetmap.org/search'
\ No newline at end of file
+    NOMINATIM_API_URL = 'https://nominatim.openstreetmap.org/search'
+
+    # 外部APIの呼び出し設定 (app/upstream.py)
+    #   timeout           : (接続, 読み込み) のタイムアウト秒数
+    #   rate / burst      : トークンバケット (1秒あたりの回数 / まとめて送れる回数)
+    #   max_concurrent    : 同時に送るリクエスト数 (接続プールの大きさ)
+    #   max_wait          : トークンや空き接続を待つ最大秒数
+    #   failure_threshold : 連続でこの回数失敗したら reset_timeout 秒間は呼び出さない
+    #   retries / backoff : 一時的な失敗 (接続エラー・429・502〜504) の再試行の回数 / 最初の待ち秒数 (毎回2倍)
+    UPSTREAM_SERVICES = {
+        'overpass': {'timeout': (3.05, 25), 'rate': 2.0, 'burst': 4, 'max_concurrent': 4,
+                     'max_wait': 5.0, 'failure_threshold': 5, 'reset_timeout': 30.0,
+                     'retries': 1, 'backoff': 1.0},
+        # Nominatimの利用規約は1秒に1回まで
+        'nominatim': {'timeout': (3.05, 5), 'rate': 1.0, 'burst': 1, 'max_concurrent': 2,
+                      'max_wait': 5.0, 'failure_threshold': 5, 'reset_timeout': 60.0,
+                      'retries': 1, 'backoff': 1.0},
+    }
+
+    # 投稿時のお店の確認方法
+    #   'local'     : ローカルのDBとOverpassキャッシュで確認し、無ければ裏でNominatimに確認する
+    #   'nominatim' : 投稿のたびにNominatimで検索し、見つからなければ投稿させない (従来の動作)
+    SHOP_VALIDATION = os.environ.get('SHOP_VALIDATION', 'local')
+
+    # ホーム・プロフィール・お店のページで1回に表示する投稿数 (続きは「もっと見る」で読み込む)
+    POSTS_PER_PAGE = int(os.environ.get('POSTS_PER_PAGE', 24))
+
+    # 全文検索 (/api/search) で bm25 の点数を計算する候補の数 (新しいものから)
+    SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', 500))
+
+    # 取り込んだPOI (flask poi-import) で地図の検索に答えるときの最大件数
+    POI_MAX_FEATURES = int(os.environ.get('POI_MAX_FEATURES', 2000))
+    # これより古い取り込みの範囲は、Overpass に問い合わせる (Overpass に失敗したときだけ古いPOIで答える)
+    POI_MAX_AGE_DAYS = float(os.environ.get('POI_MAX_AGE_DAYS', 30))
+    # POIの取り込みで1トランザクションに入れる件数
+    POI_IMPORT_BATCH_SIZE = int(os.environ.get('POI_IMPORT_BATCH_SIZE', 10000))
+
+    # ログイン中のユーザーをキャッシュする秒数と件数 (プロセスごと、app/user_cache.py)
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 60))
+    USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 10000))
+
+    # いいね・ブックマークをDBに後でまとめて書き込む (app/write_behind.py)
+    # 未反映の状態はプロセスのメモリにあるので、ワーカーが1プロセスのときだけ使える
+    # (2つ目のプロセスは起動時にエラーをログに出して、同期で書き込む)
+    WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND_ENABLED', '').lower() in ('1', 'true', 'yes')
+    WRITE_BEHIND_LOG_DIR = os.environ.get('WRITE_BEHIND_LOG_DIR') or os.path.join(basedir, 'write_behind')
+    WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', 0.5))  # 秒
+    WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('WRITE_BEHIND_BATCH_SIZE', 1000))
+
+    # これより遅いリクエストは、SQLの内訳と一緒にログに出す (秒、app/metrics.py)
+    SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 0.5))
+
+    # 投稿カードのHTMLキャッシュに保存する件数 (プロセスごと)
+    FRAGMENT_CACHE_MAX_ENTRIES = int(os.environ.get('FRAGMENT_CACHE_MAX_ENTRIES', 5000))
+
+    # アップロードの最大サイズ (これを超えるリクエストは本文を読む前に 413 で断る)
+    MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 16 * 1024 * 1024))
+    # 画像の保存先: 'local' (app/static/uploads) または 'objectstore' (STORAGE_ROOT, /media/ から配信)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+    STORAGE_ROOT = os.environ.get('STORAGE_ROOT') or os.path.join(basedir, 'media')
+    # `flask uploads-gc` は、この秒数より前から保存されていて、どの投稿も使っていない画像だけを消す
+    UPLOAD_GC_GRACE_SECONDS = int(os.environ.get('UPLOAD_GC_GRACE_SECONDS', 60 * 60))
+
+    # 投稿画像の縮小版 (名前: 長辺のピクセル数)。表示する場所に合わせて一番小さいものを使う
+    IMAGE_VARIANTS = {'thumb': 480, 'detail': 1280}
+    IMAGE_FORMATS = ['avif', 'webp']  # AVIFはPillowが対応している場合だけ作る
+    IMAGE_QUALITY = int(os.environ.get('IMAGE_QUALITY', 75))
+
+    # /api/shops?bbox=... で返すお店の最大件数 (投稿の多いお店から)
+    SHOPS_BBOX_LIMIT = int(os.environ.get('SHOPS_BBOX_LIMIT', 500))
+
+    # /api/timeline?lat=..&lon=.. の近くの投稿のランキング
+    GEO_FEED_DAYS = int(os.environ.get('GEO_FEED_DAYS', 30))  # 対象にする投稿の期間
+    GEO_FEED_RADIUS_KM = float(os.environ.get('GEO_FEED_RADIUS_KM', 20))  # 候補を探す範囲
+    GEO_FEED_MAX_CANDIDATES = int(os.environ.get('GEO_FEED_MAX_CANDIDATES', 5000))
+    GEO_FEED_HALF_LIFE_HOURS = float(os.environ.get('GEO_FEED_HALF_LIFE_HOURS', 72))  # 新しさの半減期
+    GEO_FEED_DISTANCE_SCALE_KM = float(os.environ.get('GEO_FEED_DISTANCE_SCALE_KM', 2))  # この距離で近さの点数が半分
+
+    # 人気のスコア (app/trending.py): 操作ごとの重みと、減衰の半減期
+    TRENDING_WEIGHTS = {'like': 1.0, 'comment': 2.0, 'bookmark': 3.0, 'post': 2.0}
+    TRENDING_HALF_LIFE_HOURS = float(os.environ.get('TRENDING_HALF_LIFE_HOURS', 24))
+    # `flask trending-decay` でこれより小さくなったスコアは 0 にする (次からはUPDATEしない)
+    TRENDING_MIN_SCORE = float(os.environ.get('TRENDING_MIN_SCORE', 0.01))
+    TRENDING_LIMIT = int(os.environ.get('TRENDING_LIMIT', 20))  # /api/trending の既定の件数
+    POPULAR_NEARBY_RADIUS_KM = float(os.environ.get('POPULAR_NEARBY_RADIUS_KM', 3))
+
+    # フォロー中タイムラインの配信テーブル (feed_item) を使うかどうか
+    # 途中で有効にした場合は `flask feed-rebuild` で既存の投稿を配信しておく
+    FEED_FANOUT_ENABLED = os.environ.get('FEED_FANOUT_ENABLED', '0') == '1'
+    # フォロワーがこの人数以上のユーザーの投稿は配信せず、読み込み時に取得する
+    FEED_FANOUT_MAX_FOLLOWERS = int(os.environ.get('FEED_FANOUT_MAX_FOLLOWERS', 5000))
+    # フォローした時にタイムラインへ追加する過去の投稿数
+    FEED_BACKFILL_POSTS = int(os.environ.get('FEED_BACKFILL_POSTS', 100))
\ No newline at end of file
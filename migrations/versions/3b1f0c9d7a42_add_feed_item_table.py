@@ -0,0 +1,36 @@
+"""add feed_item table
+
+Revision ID: 3b1f0c9d7a42
+Revises: e6ac4fe76b0a
+Create Date: 2026-10-18 11:03:27.904112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b1f0c9d7a42'
+down_revision = 'e6ac4fe76b0a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('feed_item',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], name='fk_feed_item_post_id'),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], name='fk_feed_item_user_id'),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    with op.batch_alter_table('feed_item', schema=None) as batch_op:
+        batch_op.create_index('ix_feed_item_user_id_timestamp', ['user_id', 'timestamp', 'post_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('feed_item', schema=None) as batch_op:
+        batch_op.drop_index('ix_feed_item_user_id_timestamp')
+
+    op.drop_table('feed_item')
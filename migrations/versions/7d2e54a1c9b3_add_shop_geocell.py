@@ -0,0 +1,52 @@
+"""add shop geocell
+
+Revision ID: 7d2e54a1c9b3
+Revises: 3b1f0c9d7a42
+Create Date: 2026-10-18 12:20:05.117382
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2e54a1c9b3'
+down_revision = '3b1f0c9d7a42'
+branch_labels = None
+depends_on = None
+
+
+# app/geo.py の grid_cell と同じ計算 (マイグレーション作成時点の値で固定)
+CELL_DEGREES = 0.05
+CELL_COLUMNS = 7200
+CELL_ROWS = 3600
+
+
+def grid_cell(latitude, longitude):
+    row = min(int((latitude + 90) // CELL_DEGREES), CELL_ROWS - 1)
+    column = int((longitude + 180) // CELL_DEGREES) % CELL_COLUMNS
+    return row * CELL_COLUMNS + column
+
+
+def upgrade():
+    with op.batch_alter_table('shop', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('geocell', sa.Integer(), nullable=True))
+
+    shop = sa.table('shop', sa.column('id', sa.Integer), sa.column('latitude', sa.Float),
+                    sa.column('longitude', sa.Float), sa.column('geocell', sa.Integer))
+    connection = op.get_bind()
+    rows = connection.execute(sa.select(shop.c.id, shop.c.latitude, shop.c.longitude)).fetchall()
+    if rows:
+        connection.execute(
+            shop.update().where(shop.c.id == sa.bindparam('shop_id')),
+            [{'shop_id': id, 'geocell': grid_cell(latitude, longitude)} for id, latitude, longitude in rows])
+
+    with op.batch_alter_table('shop', schema=None) as batch_op:
+        batch_op.alter_column('geocell', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_index(batch_op.f('ix_shop_geocell'), ['geocell'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('shop', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_shop_geocell'))
+        batch_op.drop_column('geocell')
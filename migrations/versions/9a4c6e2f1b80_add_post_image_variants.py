@@ -0,0 +1,27 @@
+"""add post image variants
+
+Revision ID: 9a4c6e2f1b80
+Revises: 7d2e54a1c9b3
+Create Date: 2026-10-18 18:30:12.401853
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4c6e2f1b80'
+down_revision = '7d2e54a1c9b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 既存の投稿の縮小版は `flask images-process` で作る
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('variants', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('variants')
@@ -0,0 +1,76 @@
+"""association primary keys and sort indexes
+
+Revision ID: a1d3f5b7c902
+Revises: f2a7c9e1d354
+Create Date: 2026-10-18 21:40:12.804513
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1d3f5b7c902'
+down_revision = 'f2a7c9e1d354'
+branch_labels = None
+depends_on = None
+
+
+# (テーブル, 主キーの列, 逆向きの索引名)
+ASSOCIATIONS = [
+    ('likes', ('user_id', 'post_id'), 'ix_likes_post_id_user_id'),
+    ('followers', ('follower_id', 'followed_id'), 'ix_followers_followed_id_follower_id'),
+    ('bookmarks', ('user_id', 'shop_id'), 'ix_bookmarks_shop_id_user_id'),
+]
+
+# 重複を消した後に数え直すカウンタ (app/cli.py の reconcile-counters と同じ計算)
+COUNTERS = [
+    ('post', 'likes_count', 'likes', 'post_id'),
+    ('user', 'followers_count', 'followers', 'followed_id'),
+    ('user', 'following_count', 'followers', 'follower_id'),
+    ('shop', 'bookmarks_count', 'bookmarks', 'shop_id'),
+]
+
+
+def upgrade():
+    for table, columns, index in ASSOCIATIONS:
+        # 主キーを付ける前に、重複した行と NULL を含む行を取り除く
+        first, second = columns
+        op.execute(f'CREATE TABLE {table}_dedupe AS SELECT DISTINCT {first}, {second} FROM {table} '
+                   f'WHERE {first} IS NOT NULL AND {second} IS NOT NULL')
+        op.execute(f'DELETE FROM {table}')
+        op.execute(f'INSERT INTO {table} ({first}, {second}) SELECT {first}, {second} FROM {table}_dedupe')
+        op.execute(f'DROP TABLE {table}_dedupe')
+
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for column in columns:
+                batch_op.alter_column(column, existing_type=sa.Integer(), nullable=False)
+            batch_op.create_primary_key(f'pk_{table}', list(columns))
+            batch_op.create_index(index, [second, first], unique=False)
+
+    for table, counter, source, column in COUNTERS:
+        op.execute(f'UPDATE "{table}" SET {counter} = '
+                   f'(SELECT COUNT(*) FROM {source} WHERE {source}.{column} = "{table}".id)')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id_timestamp', ['user_id', 'timestamp', 'id'], unique=False)
+        batch_op.create_index('ix_post_shop_id_timestamp', ['shop_id', 'timestamp', 'id'], unique=False)
+
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.create_index('ix_comment_post_id_timestamp', ['post_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.drop_index('ix_comment_post_id_timestamp')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_shop_id_timestamp')
+        batch_op.drop_index('ix_post_user_id_timestamp')
+
+    for table, columns, index in reversed(ASSOCIATIONS):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_index(index)
+            batch_op.drop_constraint(f'pk_{table}', type_='primary')
+            for column in columns:
+                batch_op.alter_column(column, existing_type=sa.Integer(), nullable=True)
@@ -0,0 +1,27 @@
+"""index post image_filename
+
+Revision ID: b5d1f7a3c2e9
+Revises: 9a4c6e2f1b80
+Create Date: 2026-10-18 19:05:41.228370
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5d1f7a3c2e9'
+down_revision = '9a4c6e2f1b80'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 同じ画像ファイルを参照している投稿を数えるための索引
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_post_image_filename'), ['image_filename'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_post_image_filename'))
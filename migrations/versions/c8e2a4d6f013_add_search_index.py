@@ -0,0 +1,38 @@
+"""add search index
+
+Revision ID: c8e2a4d6f013
+Revises: b5d1f7a3c2e9
+Create Date: 2026-10-18 20:10:27.551904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8e2a4d6f013'
+down_revision = 'b5d1f7a3c2e9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 索引の中身は `flask search-reindex` で作る (トークン化は app/search.py)
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE search_index USING fts5(tokens, tokenize='unicode61 remove_diacritics 0')")
+    else:
+        op.create_table('search_index',
+                        sa.Column('id', sa.BigInteger(), autoincrement=False, nullable=False),
+                        sa.Column('tokens', postgresql.TSVECTOR(), nullable=False),
+                        sa.PrimaryKeyConstraint('id'))
+        op.create_index('ix_search_index_tokens', 'search_index', ['tokens'], unique=False,
+                        postgresql_using='gin')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('DROP TABLE search_index')
+    else:
+        op.drop_index('ix_search_index_tokens', table_name='search_index')
+        op.drop_table('search_index')
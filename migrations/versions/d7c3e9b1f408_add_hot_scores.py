@@ -0,0 +1,49 @@
+"""add hot scores
+
+Revision ID: d7c3e9b1f408
+Revises: a1d3f5b7c902
+Create Date: 2026-10-18 23:14:52.604118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7c3e9b1f408'
+down_revision = 'a1d3f5b7c902'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # 既存の行のスコアは 0 から始まる (`flask trending-rebuild` で履歴から計算できる)
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('hot_score', sa.Float(), server_default='0', nullable=False))
+        batch_op.create_index('ix_post_hot_score', ['hot_score', 'id'], unique=False)
+
+    with op.batch_alter_table('shop', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('hot_score', sa.Float(), server_default='0', nullable=False))
+        batch_op.create_index('ix_shop_hot_score', ['hot_score', 'id'], unique=False)
+        # geocell だけの索引は、先頭が同じ (geocell, hot_score) の索引で置き換える
+        batch_op.drop_index('ix_shop_geocell')
+        batch_op.create_index('ix_shop_geocell_hot_score', ['geocell', 'hot_score'], unique=False)
+
+    op.create_table('trending_decay',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('decayed_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('trending_decay')
+
+    with op.batch_alter_table('shop', schema=None) as batch_op:
+        batch_op.drop_index('ix_shop_geocell_hot_score')
+        batch_op.create_index('ix_shop_geocell', ['geocell'], unique=False)
+        batch_op.drop_index('ix_shop_hot_score')
+        batch_op.drop_column('hot_score')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_hot_score')
+        batch_op.drop_column('hot_score')
@@ -0,0 +1,58 @@
+"""add denormalized counters
+
+Revision ID: e6ac4fe76b0a
+Revises: ca9d35377a47
+Create Date: 2026-10-18 10:12:41.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6ac4fe76b0a'
+down_revision = 'ca9d35377a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('likes_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('comments_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('followers_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('following_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('posts_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('shop', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('posts_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('bookmarks_count', sa.Integer(), server_default='0', nullable=False))
+
+    # 既存データから件数を埋める
+    op.execute('UPDATE post SET '
+               'likes_count = (SELECT COUNT(*) FROM likes WHERE likes.post_id = post.id), '
+               'comments_count = (SELECT COUNT(*) FROM comment WHERE comment.post_id = post.id)')
+    op.execute('UPDATE "user" SET '
+               'followers_count = (SELECT COUNT(*) FROM followers WHERE followers.followed_id = "user".id), '
+               'following_count = (SELECT COUNT(*) FROM followers WHERE followers.follower_id = "user".id), '
+               'posts_count = (SELECT COUNT(*) FROM post WHERE post.user_id = "user".id)')
+    op.execute('UPDATE shop SET '
+               'posts_count = (SELECT COUNT(*) FROM post WHERE post.shop_id = shop.id), '
+               'bookmarks_count = (SELECT COUNT(*) FROM bookmarks WHERE bookmarks.shop_id = shop.id)')
+
+
+def downgrade():
+    with op.batch_alter_table('shop', schema=None) as batch_op:
+        batch_op.drop_column('bookmarks_count')
+        batch_op.drop_column('posts_count')
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('posts_count')
+        batch_op.drop_column('following_count')
+        batch_op.drop_column('followers_count')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('comments_count')
+        batch_op.drop_column('likes_count')
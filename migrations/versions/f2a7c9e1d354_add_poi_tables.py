@@ -0,0 +1,62 @@
+"""add poi tables
+
+Revision ID: f2a7c9e1d354
+Revises: c8e2a4d6f013
+Create Date: 2026-10-18 21:02:41.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a7c9e1d354'
+down_revision = 'c8e2a4d6f013'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('poi',
+                    sa.Column('id', sa.BigInteger(), autoincrement=False, nullable=False),
+                    sa.Column('osm_id', sa.BigInteger(), nullable=False),
+                    sa.Column('name', sa.String(length=256), nullable=True),
+                    sa.Column('name_normalized', sa.String(length=256), nullable=True),
+                    sa.Column('latitude', sa.Float(), nullable=False),
+                    sa.Column('longitude', sa.Float(), nullable=False),
+                    sa.Column('geocell', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+    with op.batch_alter_table('poi', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_poi_osm_id'), ['osm_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_poi_geocell'), ['geocell'], unique=False)
+
+    op.create_table('poi_category',
+                    sa.Column('category', sa.String(length=64), nullable=False),
+                    sa.Column('geocell', sa.Integer(), nullable=False),
+                    sa.Column('poi_id', sa.BigInteger(), nullable=False),
+                    sa.ForeignKeyConstraint(['poi_id'], ['poi.id'], name='fk_poi_category_poi_id'),
+                    sa.PrimaryKeyConstraint('category', 'geocell', 'poi_id'))
+    with op.batch_alter_table('poi_category', schema=None) as batch_op:
+        batch_op.create_index('ix_poi_category_poi_id', ['poi_id'], unique=False)
+
+    op.create_table('poi_import',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('source', sa.String(length=256), nullable=False),
+                    sa.Column('south', sa.Float(), nullable=False),
+                    sa.Column('west', sa.Float(), nullable=False),
+                    sa.Column('north', sa.Float(), nullable=False),
+                    sa.Column('east', sa.Float(), nullable=False),
+                    sa.Column('poi_count', sa.Integer(), nullable=False),
+                    sa.Column('imported_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'))
+
+
+def downgrade():
+    op.drop_table('poi_import')
+    with op.batch_alter_table('poi_category', schema=None) as batch_op:
+        batch_op.drop_index('ix_poi_category_poi_id')
+    op.drop_table('poi_category')
+    with op.batch_alter_table('poi', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_poi_geocell'))
+        batch_op.drop_index(batch_op.f('ix_poi_osm_id'))
+    op.drop_table('poi')
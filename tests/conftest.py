@@ -0,0 +1,93 @@
+"""
+テスト用の設定
+
+app を import する前に、データベース・キャッシュ・画像・write-behind のログを
+一時ディレクトリに向ける (config.py は import 時に環境変数を読む)。
+データベースはマイグレーションで1回だけ作り、テストごとに全ての行を消す。
+"""
+import os
+import shutil
+import sys
+import tempfile
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+WORKDIR = tempfile.mkdtemp(prefix='book_app_tests_')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORKDIR, 'test.db')
+os.environ['OVERPASS_CACHE_PATH'] = os.path.join(WORKDIR, 'overpass_cache.db')
+os.environ['STORAGE_BACKEND'] = 'objectstore'
+os.environ['STORAGE_ROOT'] = os.path.join(WORKDIR, 'media')
+os.environ['WRITE_BEHIND_LOG_DIR'] = os.path.join(WORKDIR, 'write_behind')
+sys.path.insert(0, ROOT)
+
+from flask_migrate import upgrade  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from app import app as flask_app, db  # noqa: E402
+from app.models import User, Shop, Post  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app():
+    flask_app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    with flask_app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+    return flask_app
+
+
+@pytest.fixture(autouse=True)
+def _clean(app):
+    yield
+    # write-behind は残った操作を反映して、ログのロックを外す
+    write_behind = app.extensions.pop('write_behind', None)
+    if write_behind is not None:
+        write_behind.close()
+    with app.app_context():
+        db.session.rollback()
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.execute(text('DELETE FROM search_index'))
+        db.session.commit()
+    # プロセス内のキャッシュ (ユーザー・投稿カードなど) や画像も次のテストに持ち越さない
+    for name in ('user_cache', 'fragment_cache', 'metrics', 'storage'):
+        app.extensions.pop(name, None)
+    shutil.rmtree(os.environ['STORAGE_ROOT'], ignore_errors=True)
+
+
+@pytest.fixture
+def ctx(app):
+    with app.app_context():
+        yield
+
+
+@pytest.fixture
+def user(ctx):
+    user = User(username='alice', email='alice@example.com')
+    user.set_password('password')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+@pytest.fixture
+def shop(ctx):
+    shop = Shop(osm_id=1001, name='ラーメン屋', latitude=35.0, longitude=135.75)
+    db.session.add(shop)
+    db.session.commit()
+    return shop
+
+
+@pytest.fixture
+def post(user, shop):
+    post = Post(body='美味しい', image_filename='a.jpg', author=user, shop=shop)
+    db.session.add(post)
+    db.session.commit()
+    return post
+
+
+@pytest.fixture
+def client(app, user):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
@@ -0,0 +1,70 @@
+import pytest
+from app import db, feed
+from app.models import User, Post, FeedItem
+
+
+@pytest.fixture
+def fanout(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'FEED_FANOUT_ENABLED', True)
+    # フォロワーが2人以上になったら配信をやめて、読み込み時に取得する
+    monkeypatch.setitem(app.config, 'FEED_FANOUT_MAX_FOLLOWERS', 2)
+
+
+def _user(name):
+    user = User(username=name, email=f'{name}@example.com')
+    user.set_password('password')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def _publish(author, shop, body):
+    post = Post(body=body, image_filename=f'{body}.jpg', author=author, shop=shop)
+    db.session.add(post)
+    db.session.flush()
+    feed.fanout_post(post)
+    db.session.commit()
+    return post
+
+
+def _follow(follower, followed):
+    follower.follow(followed)
+    feed.backfill_follow(follower, followed)
+    db.session.commit()
+
+
+def _unfollow(follower, followed):
+    follower.unfollow(followed)
+    feed.trim_unfollow(follower, followed)
+    db.session.commit()
+
+
+def _feed(user):
+    posts, _ = feed.feed_page(user, None, 20)
+    return {post.body for post in posts}
+
+
+def test_posts_stay_in_feeds_across_the_fanout_threshold(fanout, user, shop):
+    bob, carol = _user('bob'), _user('carol')
+    _follow(carol, bob)
+    _publish(bob, shop, 'pushed')
+    assert FeedItem.query.filter_by(user_id=carol.id).count() == 1
+
+    # 2人目のフォロワーで上限を超え、以降の投稿は読み込み時に取得される
+    _follow(user, bob)
+    _publish(bob, shop, 'pulled')
+    assert FeedItem.query.filter_by(user_id=carol.id).count() == 1
+    assert _feed(carol) == _feed(user) == {'pushed', 'pulled'}
+
+    # 上限を下回ったら、取得していた投稿も残りのフォロワーに配信する
+    _unfollow(carol, bob)
+    assert _feed(user) == {'pushed', 'pulled'}
+    assert _feed(carol) == set()
+    _publish(bob, shop, 'pushed again')
+    assert _feed(user) == {'pushed', 'pulled', 'pushed again'}
+
+    # もう一度上限を超えても、配信済みの投稿と重ならない
+    _follow(carol, bob)
+    _publish(bob, shop, 'pulled again')
+    assert sorted(post.body for post in feed.feed_page(user, None, 20)[0]) == \
+        sorted(['pushed', 'pulled', 'pushed again', 'pulled again'])
@@ -0,0 +1,38 @@
+import pytest
+from app.geo import parse_bbox
+
+
+def test_parse_bbox_keeps_normal_boxes():
+    assert parse_bbox('35,139.5,36,140') == (35.0, 139.5, 36.0, 140.0)
+
+
+@pytest.mark.parametrize('bbox, expected', [
+    # 東へ日付変更線を越えてパンした地図
+    ('35,170,36,190', (35.0, 170.0, 36.0, -170.0)),
+    # 西へ越えた地図
+    ('35,-190,36,-170', (35.0, 170.0, 36.0, -170.0)),
+    # 地球を1周して戻ってきた地図
+    ('34.9,495.6,35.1,495.8', (34.9, 135.6, 35.1, 135.8)),
+    ('35,179,36,180', (35.0, 179.0, 36.0, 180.0)),
+])
+def test_parse_bbox_wraps_longitudes(bbox, expected):
+    assert parse_bbox(bbox) == pytest.approx(expected)
+
+
+def test_parse_bbox_whole_world_and_clamped_latitudes():
+    assert parse_bbox('-95,-400,95,400') == (-90.0, -180.0, 90.0, 180.0)
+
+
+@pytest.mark.parametrize('bbox', ['36,1,35,2', 'nan,1,2,3', '1,2,3', 'a,b,c,d'])
+def test_parse_bbox_rejects_malformed(bbox):
+    with pytest.raises(ValueError):
+        parse_bbox(bbox)
+
+
+def test_shops_bbox_after_panning_across_antimeridian(client, shop):
+    # 135.75 + 360 の位置を表示している地図からも、同じお店が見える
+    response = client.get('/api/shops?bbox=34.9,495.6,35.1,495.9')
+    assert response.status_code == 200
+    assert [feature['properties']['id'] for feature in response.get_json()['features']] == [shop.id]
+    response = client.get('/api/shops?bbox=34.9,170,35.1,190')
+    assert response.get_json()['features'] == []
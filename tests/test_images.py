@@ -0,0 +1,61 @@
+import hashlib
+import io
+import pytest
+from PIL import Image
+from app.images import generate_variants
+from app.storage import get_storage
+
+ORIENTATION = 0x0112
+GPS_INFO = 0x8825
+
+
+def _store_photo(width=64, height=32, orientation=6):
+    """横長に撮って EXIF で「90度回す」と指定した、撮影場所つきの写真を保存する"""
+    image = Image.new('RGB', (width, height), 'red')
+    exif = Image.Exif()
+    exif[ORIENTATION] = orientation
+    exif[GPS_INFO] = {1: 'N', 2: (35.0, 0.0, 0.0)}
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', exif=exif)
+    buffer.seek(0)
+    return get_storage().save_upload(buffer, '.jpg')
+
+
+def _read(name):
+    with get_storage().open(name) as file:
+        return file.read()
+
+
+@pytest.fixture
+def photo(ctx):
+    return _store_photo()
+
+
+def test_variants_are_rotated_and_have_no_metadata(photo):
+    variants = generate_variants(photo)
+    for variant in variants.values():
+        assert (variant['width'], variant['height']) == (32, 64)
+        for name in variant['files'].values():
+            with Image.open(io.BytesIO(_read(name))) as image:
+                assert image.size == (32, 64)
+                assert not image.getexif() and 'exif' not in image.info and 'xmp' not in image.info
+
+
+def test_original_is_left_untouched(photo):
+    before = _read(photo)
+    generate_variants(photo)
+    after = _read(photo)
+    assert after == before
+    # 名前は内容のハッシュのまま
+    assert photo == hashlib.sha256(after).hexdigest() + '.jpg'
+    with Image.open(io.BytesIO(after)) as image:
+        assert image.getexif()[ORIENTATION] == 6
+
+
+def test_processing_again_gives_the_same_orientation(photo):
+    # `flask images-process --all` で作り直しても横倒しにならない
+    first = generate_variants(photo)
+    again = generate_variants(photo)
+    assert again == first
+    with Image.open(io.BytesIO(_read(again['thumb']['files']['webp']))) as image:
+        assert image.size == (32, 64)
@@ -0,0 +1,9 @@
+import os
+from flask_migrate import check
+from conftest import ROOT
+
+
+def test_models_match_the_migrations(ctx):
+    # 差分があれば flask_migrate.check は SystemExit(1) になる
+    # (全文検索の search_index* は migrations/env.py の include_object で除く)
+    check(directory=os.path.join(ROOT, 'migrations'))
@@ -0,0 +1,69 @@
+import json
+import pytest
+from app import routes
+from app.overpass_cache import cached_search
+from app.overpass_stream import read_features
+from app.routes import OverpassError
+
+BBOX = '34.99,135.74,35.01,135.76'
+TIMED_OUT = 'runtime error: Query timed out in "query" at line 3 after 26 seconds.'
+
+
+class Response:
+    """requests の stream=True の応答の代わり (本文を小さなチャンクで返す)"""
+
+    def __init__(self, body, chunk_size=7):
+        self.body = json.dumps(body, ensure_ascii=False).encode()
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), self.chunk_size):
+            yield self.body[start:start + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+def _node(osm_id, name, lat=35.0, lon=135.75):
+    return {'type': 'node', 'id': osm_id, 'lat': lat, 'lon': lon, 'tags': {'name': name}}
+
+
+def _body(elements, **members):
+    return {'version': 0.6, 'elements': elements, **members}
+
+
+def test_read_features_returns_the_remark():
+    response = Response(_body([_node(1, '麺屋')], remark=TIMED_OUT))
+    features = read_features(response, 10)
+    assert [feature['properties']['name'] for feature in features] == ['麺屋']
+    assert features.remark == TIMED_OUT and features.incomplete and response.closed
+
+    features = read_features(Response(_body([_node(1, '麺屋')])), 10)
+    assert features.remark is None and not features.incomplete
+    # 上限で打ち切ったときは remark まで読まない
+    assert read_features(Response(_body([_node(1, 'a'), _node(2, 'b')], remark=TIMED_OUT)), 1).remark is None
+
+
+def test_incomplete_results_are_not_cached(ctx):
+    calls = []
+
+    def fetch(keyword, bbox, remark=None):
+        calls.append(keyword)
+        return read_features(Response(_body([_node(1, '麺屋')], **({'remark': remark} if remark else {}))), 10)
+
+    assert len(cached_search('途中', BBOX, lambda keyword, bbox: fetch(keyword, bbox, TIMED_OUT))) == 1
+    # 保存されていないので、次の検索でも問い合わせる
+    assert len(cached_search('途中', BBOX, fetch)) == 1
+    assert len(cached_search('途中', BBOX, fetch)) == 1
+    assert len(calls) == 2
+
+
+def test_empty_runtime_error_is_an_overpass_error(ctx, monkeypatch):
+    class Client:
+        def get_json(self, params=None, parse=None):
+            return parse(Response(_body([], remark=TIMED_OUT)))
+
+    monkeypatch.setattr(routes, 'get_client', lambda name: Client())
+    with pytest.raises(OverpassError):
+        routes.fetch_overpass_features('ラーメン', BBOX)
@@ -0,0 +1,95 @@
+import json
+from datetime import datetime, timedelta
+import pytest
+from app import db, routes
+from app.models import PoiImport
+from app.poi import extract_bounds, import_pois, read_geojson, search_pois
+from app.routes import OverpassError
+
+KYOTO = '34.9,135.6,35.1,135.9'
+
+
+def _feature(osm_id, name, lon, lat, **tags):
+    return {'type': 'Feature', 'id': f'node/{osm_id}', 'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+            'properties': {'name': name, 'amenity': 'restaurant', **tags}}
+
+
+@pytest.fixture
+def extract(tmp_path):
+    # 抽出範囲 (bbox) は京都の周り、お店はその中ほどの2軒だけ
+    path = tmp_path / 'kyoto.geojson'
+    path.write_text(json.dumps({
+        'type': 'FeatureCollection', 'bbox': [135.5, 34.8, 136.0, 35.2],
+        'features': [_feature(1, '麺屋', 135.75, 35.0, cuisine='ramen'), _feature(2, '喫茶店', 135.76, 35.01)],
+    }, ensure_ascii=False), encoding='utf-8')
+    return str(path)
+
+
+def _import(path, coverage=None):
+    return import_pois(read_geojson(path), 'kyoto.geojson', coverage=coverage or extract_bounds(path))
+
+
+def test_extract_bounds_reads_the_declared_bbox(extract, tmp_path):
+    assert extract_bounds(extract) == (34.8, 135.5, 35.2, 136.0)
+    lines = tmp_path / 'lines.geojsonl'
+    lines.write_text(json.dumps(_feature(3, 'バー', 135.7, 35.0)) + '\n', encoding='utf-8')
+    assert extract_bounds(str(lines)) is None
+
+
+def test_import_records_the_extract_boundary(ctx, extract):
+    assert _import(extract) == 2
+    coverage = PoiImport.query.one()
+    assert (coverage.south, coverage.west, coverage.north, coverage.east) == (34.8, 135.5, 35.2, 136.0)
+    # 境界が分からないときは、お店の広がりを範囲として記録しない
+    import_pois(read_geojson(extract), 'again', coverage=None)
+    assert PoiImport.query.count() == 1
+
+
+def test_search_inside_the_extract(ctx, extract):
+    _import(extract)
+    names = [feature['properties']['name'] for feature in search_pois('ラーメン', KYOTO, 100)]
+    assert names == ['麺屋']
+    # 抽出範囲の外にはみ出した検索は Overpass へ
+    assert search_pois('ラーメン', '34.9,135.6,35.3,135.9', 100) is None
+
+
+def test_empty_or_stale_results_fall_back_to_overpass(ctx, extract):
+    _import(extract)
+    assert search_pois('寿司', KYOTO, 100) is None
+    assert search_pois('寿司', KYOTO, 100, fresh_only=False) == []
+
+    PoiImport.query.update({'imported_at': datetime.utcnow() - timedelta(days=365)})
+    db.session.commit()
+    assert search_pois('ラーメン', KYOTO, 100) is None
+    assert len(search_pois('ラーメン', KYOTO, 100, fresh_only=False)) == 1
+
+
+def test_osm_search_uses_overpass_when_nothing_was_imported_there(client, extract, monkeypatch):
+    _import(extract)
+    calls = []
+
+    def cached_search(keyword, bbox, fetch):
+        calls.append(keyword)
+        return [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [135.7, 35.0]},
+                 'properties': {'name': '新しい寿司屋', 'osm_id': 99}}]
+
+    monkeypatch.setattr(routes, 'cached_search', cached_search)
+    body = client.get(f'/api/osm_search?keyword=寿司&bbox={KYOTO}').get_json()
+    assert calls == ['寿司'] and body['features'][0]['properties']['name'] == '新しい寿司屋'
+    body = client.get(f'/api/osm_search?keyword=ラーメン&bbox={KYOTO}').get_json()
+    assert calls == ['寿司'] and body['features'][0]['properties']['name'] == '麺屋'
+
+
+def test_osm_search_serves_a_stale_import_when_overpass_fails(client, extract, monkeypatch):
+    _import(extract)
+    PoiImport.query.update({'imported_at': datetime.utcnow() - timedelta(days=365)})
+    db.session.commit()
+
+    def cached_search(keyword, bbox, fetch):
+        raise OverpassError('down')
+
+    monkeypatch.setattr(routes, 'cached_search', cached_search)
+    response = client.get(f'/api/osm_search?keyword=ラーメン&bbox={KYOTO}')
+    assert response.status_code == 200 and response.get_json()['features'][0]['properties']['name'] == '麺屋'
+    # 取り込んだ範囲の外は、これまでどおりエラー
+    assert client.get('/api/osm_search?keyword=ラーメン&bbox=35.6,139.6,35.7,139.8').status_code == 500
@@ -0,0 +1,94 @@
+import io
+import os
+import time
+import pytest
+from app import db
+from app.images import collect_garbage
+from app.models import Post
+from app.storage import get_storage
+
+HOUR = 60 * 60
+
+
+def _upload(content):
+    return get_storage().save_upload(io.BytesIO(content), '.jpg')
+
+
+def _age(name, seconds=2 * HOUR):
+    storage = get_storage()
+    past = time.time() - seconds
+    os.utime(storage._path(name), (past, past))
+
+
+@pytest.fixture
+def storage(ctx):
+    return get_storage()
+
+
+def test_same_content_is_stored_once(storage):
+    assert _upload(b'ramen') == _upload(b'ramen')
+    assert _upload(b'ramen') != _upload(b'udon')
+
+
+def test_content_addressed_files_cannot_be_overwritten(storage):
+    name = _upload(b'ramen')
+    with pytest.raises(ValueError):
+        storage.put(name, b'something else')
+    # 縮小版 (<hash>_<size>.<形式>) は作り直せる
+    storage.put(name[:64] + '_thumb.webp', b'variant')
+
+
+def test_upload_of_existing_content_refreshes_its_age(storage):
+    name = _upload(b'ramen')
+    _age(name)
+    _upload(b'ramen')
+    assert not storage.delete_stale(name, time.time() - HOUR)
+    assert storage.exists(name)
+
+
+def test_upload_while_gc_moved_the_file_away_writes_a_new_copy(storage):
+    name = _upload(b'ramen')
+    path = storage._path(name)
+    # gc が退避した直後に、同じ画像がアップロードされた
+    os.rename(path, path + '.moved')
+    assert _upload(b'ramen') == name
+    with storage.open(name) as file:
+        assert file.read() == b'ramen'
+
+
+def test_delete_stale_puts_back_a_file_touched_meanwhile(storage):
+    name = _upload(b'ramen')
+    assert not storage.delete_stale(name, time.time() - HOUR)
+    assert storage.exists(name)
+    _age(name)
+    assert storage.delete_stale(name, time.time() - HOUR)
+    assert not storage.exists(name)
+
+
+def test_delete_post_leaves_the_files_to_gc(client, user, shop, storage):
+    name = _upload(b'shared')
+    variant = name[:64] + '_thumb.webp'
+    storage.put(variant, b'variant')
+    first, second = (Post(body='', image_filename=name, author=user, shop=shop) for _ in range(2))
+    db.session.add_all([first, second])
+    db.session.commit()
+    for path in (name, variant):
+        _age(path)
+
+    client.post(f'/delete_post/{first.id}')
+    assert collect_garbage(HOUR) == []
+    assert storage.exists(name) and storage.exists(variant)
+
+    client.post(f'/delete_post/{second.id}')
+    assert storage.exists(name)
+    assert sorted(collect_garbage(HOUR, dry_run=True)) == sorted([name, variant])
+    assert storage.exists(name)
+    assert sorted(collect_garbage(HOUR)) == sorted([name, variant])
+    assert not storage.exists(name) and not storage.exists(variant)
+
+
+def test_gc_keeps_recent_uploads_without_a_post(storage):
+    # 投稿の保存 (commit) より先にファイルが保存される
+    name = _upload(b'uploading')
+    assert collect_garbage(HOUR) == []
+    assert storage.exists(name)
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+from app import db
+from app.models import Post, Shop
+from app.nearby import nearby_page
+from app.pagination import encode_score_cursor, decode_score_cursor
+
+NEARBY = '/api/timeline?lat=35.0&lon=135.75'
+
+
+def _add_posts(user, count):
+    shops = [Shop(osm_id=2000 + i, name=f'店{i}', latitude=35.0 + i * 0.001, longitude=135.75) for i in range(count)]
+    db.session.add_all(shops)
+    now = datetime.utcnow()
+    posts = [Post(body=f'投稿{i}', image_filename=f'{i}.jpg', author=user, shop=shop,
+                  timestamp=now - timedelta(hours=i), likes_count=i % 3)
+             for i, shop in enumerate(shops)]
+    db.session.add_all(posts)
+    db.session.commit()
+    return posts
+
+
+def _pages(client, cursor=''):
+    seen = []
+    while cursor is not None:
+        body = client.get(f'{NEARBY}&cursor={cursor}').get_json()
+        seen += [post['id'] for post in body['posts']]
+        cursor = body['next_cursor']
+    return seen
+
+
+def test_score_cursor_round_trip():
+    reference = datetime(2026, 10, 18, 12, 30, 15, 123456)
+    assert decode_score_cursor(encode_score_cursor(reference, 0.1 + 0.2, 42)) == (reference, 0.1 + 0.2, 42)
+
+
+def test_nearby_cursor_pages_cover_every_post_once(client, user):
+    posts = _add_posts(user, 25)
+    assert sorted(_pages(client)) == sorted(post.id for post in posts)
+
+
+def test_nearby_cursor_is_stable_while_the_ranking_changes(client, user):
+    posts = _add_posts(user, 25)
+    first_page = client.get(f'{NEARBY}&cursor=').get_json()
+    shown = [post['id'] for post in first_page['posts']]
+    # 1ページ目を見ている間に、新しい投稿が増え (offset では次のページに同じ投稿が出ていた)、
+    # 表示済みの投稿にもいいねが付く
+    for i in range(3):
+        db.session.add(Post(body=f'新しい投稿{i}', image_filename=f'new{i}.jpg', author=user, shop=posts[0].shop))
+    db.session.get(Post, shown[-1]).likes_count += 100
+    db.session.commit()
+
+    rest = _pages(client, first_page['next_cursor'])
+    # 同じ投稿を2回出さず、飛ばさない (新しい投稿は次に最初から読み込むまで出ない)
+    assert sorted(shown + rest) == sorted(post.id for post in posts)
+
+
+def test_nearby_page_continues_after_ties(ctx, user):
+    shop = Shop(osm_id=3000, name='同点', latitude=35.0, longitude=135.75)
+    timestamp = datetime.utcnow() - timedelta(minutes=5)
+    db.session.add_all([Post(body='同点', image_filename=f'{i}.jpg', author=user, shop=shop, timestamp=timestamp)
+                        for i in range(5)])
+    db.session.commit()
+    ids, cursor = nearby_page(Post.query, 35.0, 135.75, '', 2)
+    while cursor is not None:
+        page, cursor = nearby_page(Post.query, 35.0, 135.75, cursor, 2)
+        ids += page
+    assert ids == sorted(ids, reverse=True) and len(ids) == 5
+
+
+def test_nearby_rejects_invalid_cursor(client, user):
+    assert client.get(f'{NEARBY}&cursor=bm9wZQ').status_code == 400
+
+
+def test_nearby_rejects_invalid_coordinates(client, user):
+    for query in ('lat=nan&lon=135.75', 'lat=35.0&lon=inf', 'lat=999&lon=135.75', 'lat=35.0'):
+        assert client.get(f'/api/timeline?{query}').status_code == 400
+        assert client.get(f'/api/timeline?{query}&cursor=').status_code == 400
+    assert client.get('/api/popular_nearby?lat=nan&lon=135.75').status_code == 400
@@ -0,0 +1,59 @@
+from math import cos, radians
+import pytest
+from app import db
+from app.geo import KM_PER_DEGREE, haversine
+from app.models import Shop
+from app.trending import popular_nearby_shops
+
+CENTER = (35.0, 135.75)
+
+
+def _shop(osm_id, north_km, east_km, hot_score, latitude=CENTER[0], longitude=CENTER[1]):
+    shop = Shop(osm_id=osm_id, name=f'店{osm_id}', hot_score=hot_score,
+                latitude=latitude + north_km / KM_PER_DEGREE,
+                longitude=longitude + east_km / (KM_PER_DEGREE * cos(radians(latitude))))
+    db.session.add(shop)
+    return shop
+
+
+def test_corners_of_the_box_are_cut_off(ctx):
+    inside = _shop(1, 2.0, 0.0, 5.0)
+    # 3km 四方の箱の角 (中心から約 3.9km) は、どれだけ人気でも返さない
+    corner = _shop(2, 2.8, 2.8, 100.0)
+    db.session.commit()
+    assert haversine(CENTER[1], CENTER[0], corner.longitude, corner.latitude) > 3.5
+    assert [row.id for row in popular_nearby_shops(*CENTER, 3, 10)] == [inside.id]
+
+
+def test_equally_popular_shops_are_ordered_by_distance(ctx):
+    far = _shop(1, 0.0, 2.5, 7.0)
+    near = _shop(2, -0.5, 0.0, 7.0)
+    middle = _shop(3, 1.2, 0.0, 7.0)
+    popular = _shop(4, 0.0, -2.9, 9.0)
+    db.session.commit()
+    assert [row.id for row in popular_nearby_shops(*CENTER, 3, 10)] == [popular.id, near.id, middle.id, far.id]
+
+
+def test_limit_counts_only_shops_within_the_radius(ctx):
+    for i in range(5):
+        _shop(10 + i, 2.8, 2.8 + i * 0.01, 100.0 + i)  # 箱の角
+    inside = [_shop(20 + i, 0.1 * i, 0.0, 1.0 + i) for i in range(3)]
+    db.session.commit()
+    assert [row.id for row in popular_nearby_shops(*CENTER, 3, 3)] == [shop.id for shop in reversed(inside)]
+
+
+def test_radius_across_the_antimeridian(ctx):
+    # 中心 (経度 179.999) から東へ約1.2km の店は -179.99、西へ約1km の店は 179.99
+    west_side = _shop(1, 0.0, 0.0, 3.0, latitude=-16.5, longitude=179.99)
+    east_side = _shop(2, 0.0, 0.0, 3.0, latitude=-16.5, longitude=-179.99)
+    db.session.commit()
+    assert [row.id for row in popular_nearby_shops(-16.5, 179.999, 5, 10)] == [west_side.id, east_side.id]
+    assert popular_nearby_shops(-16.5, 179.999, 1.1, 10)[0].id == west_side.id
+    assert len(popular_nearby_shops(-16.5, 179.999, 1.1, 10)) == 1
+
+
+def test_api_reports_the_distance(client):
+    _shop(1, 1.0, 0.0, 5.0)
+    db.session.commit()
+    feature = client.get('/api/popular_nearby?lat=35.0&lon=135.75').get_json()['features'][0]
+    assert feature['properties']['distance_km'] == pytest.approx(1.0, abs=0.02)
@@ -0,0 +1,202 @@
+"""app/upstream.py をスレッドで動かすローカルのHTTPサーバー相手に試す"""
+import json
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from app.upstream import (CircuitBreaker, CircuitOpenError, RateLimitedError, TokenBucket, TransientError,
+                          UpstreamClient, UpstreamError)
+
+
+class Stub:
+    """
+    Answer GET requests with the queued (status, body) pairs in order,
+    repeating the last one, after `delay` seconds; count the requests.
+    """
+
+    def __init__(self):
+        self.responses = [(200, {'ok': True})]
+        self.delay = 0.0
+        self.requests = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                    status, body = stub.responses[0] if len(stub.responses) == 1 else stub.responses.pop(0)
+                time.sleep(stub.delay)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/api'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub(ctx):
+    stub = Stub()
+    yield stub
+    stub.close()
+
+
+def _in_context(app, fn):
+    """スレッドから呼ぶとき用 (計測値を app.extensions に記録するので)"""
+    def call(*args):
+        with app.app_context():
+            return fn(*args)
+    return call
+
+
+def _client(url, **options):
+    settings = {'timeout': (1, 2), 'rate': 100.0, 'burst': 100, 'max_wait': 1.0, 'backoff': 0.01}
+    settings.update(options)
+    return UpstreamClient('stub', url, **settings)
+
+
+def test_get_json(stub):
+    assert _client(stub.url).get_json(params={'q': 'ramen'}) == {'ok': True}
+    assert stub.requests == 1
+
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(rate=20, burst=2)
+    assert bucket.acquire(0) and bucket.acquire(0)
+    assert not bucket.acquire(0)
+    started = time.monotonic()
+    assert bucket.acquire(1.0)
+    assert 0.03 <= time.monotonic() - started < 0.5
+
+
+def test_rate_limit_rejects_without_calling_upstream(stub):
+    client = _client(stub.url, rate=0.1, burst=1, max_wait=0.05)
+    client.get_json(params={'q': 1})
+    with pytest.raises(RateLimitedError):
+        client.get_json(params={'q': 2})
+    assert stub.requests == 1
+
+
+def test_breaker_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.allow()
+    time.sleep(0.12)
+    # 試しの1件だけ通し、その結果が出るまで他は止める
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.allow()
+    time.sleep(0.12)
+    assert breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open and breaker.allow() and breaker.allow()
+
+
+def test_breaker_opens_and_recovers_against_upstream(stub):
+    stub.responses = [(500, {})]
+    client = _client(stub.url, failure_threshold=2, reset_timeout=0.2)
+    for _ in range(2):
+        with pytest.raises(UpstreamError):
+            client.get_json()
+    with pytest.raises(CircuitOpenError):
+        client.get_json()
+    assert stub.requests == 2
+
+    stub.responses = [(200, {'ok': True})]
+    time.sleep(0.25)
+    assert client.get_json() == {'ok': True}
+    assert not client.breaker.is_open and stub.requests == 3
+
+
+def test_client_errors_do_not_open_the_breaker(stub):
+    stub.responses = [(404, {})]
+    client = _client(stub.url, failure_threshold=1, retries=2)
+    for _ in range(3):
+        with pytest.raises(UpstreamError) as error:
+            client.get_json()
+        assert not isinstance(error.value, TransientError)
+    assert not client.breaker.is_open and stub.requests == 3
+
+
+def test_single_flight_shares_one_request(app, stub):
+    stub.delay = 0.3
+    client = _client(stub.url)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(_in_context(app, lambda _: client.get_json(params={'q': 'same'})), range(8)))
+    assert results == [{'ok': True}] * 8
+    assert stub.requests == 1
+    # 違うクエリは相乗りしない
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        list(pool.map(_in_context(app, lambda i: client.get_json(params={'q': i})), range(3)))
+    assert stub.requests == 4
+
+
+def test_single_flight_shares_the_error(app, stub):
+    stub.delay = 0.2
+    stub.responses = [(500, {})]
+    client = _client(stub.url)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(_in_context(app, lambda: client.get_json(params={'q': 'same'}))) for _ in range(4)]
+    for future in futures:
+        with pytest.raises(UpstreamError):
+            future.result()
+    assert stub.requests == 1
+
+
+def test_retries_transient_failures(stub):
+    stub.responses = [(503, {}), (429, {}), (200, {'ok': True})]
+    client = _client(stub.url, retries=2)
+    assert client.get_json() == {'ok': True}
+    assert stub.requests == 3
+
+
+def test_gives_up_after_retries(stub):
+    stub.responses = [(502, {})]
+    client = _client(stub.url, retries=1)
+    with pytest.raises(TransientError):
+        client.get_json()
+    assert stub.requests == 2
+
+
+def test_does_not_retry_other_server_errors(stub):
+    stub.responses = [(500, {}), (200, {'ok': True})]
+    client = _client(stub.url, retries=2)
+    with pytest.raises(UpstreamError):
+        client.get_json()
+    assert stub.requests == 1
+
+
+def test_retries_connection_errors(ctx):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    client = _client(f'http://127.0.0.1:{port}/api', retries=2, failure_threshold=10)
+    with pytest.raises(TransientError):
+        client.get_json()
+    assert client.requests == 3 and client.failures == 3
+
+
+def test_read_timeout_is_not_retried(stub):
+    stub.delay = 0.5
+    client = _client(stub.url, timeout=(1, 0.1), retries=2)
+    with pytest.raises(UpstreamError) as error:
+        client.get_json()
+    assert not isinstance(error.value, TransientError)
+    assert stub.requests == 1
@@ -0,0 +1,38 @@
+import threading
+from app import db
+from app.models import User, load_user
+from app.user_cache import get_user_cache
+
+
+def _load_in_another_request(app, user_id):
+    """別のリクエスト (別のセッション) から load_user する"""
+    def load():
+        with app.app_context():
+            load_user(user_id)
+    thread = threading.Thread(target=load)
+    thread.start()
+    thread.join()
+
+
+def test_a_load_between_flush_and_commit_does_not_keep_the_old_row(app, user):
+    cache = get_user_cache()
+    user.email = 'new@example.com'
+    db.session.flush()
+    # まだ commit 前なので、他のリクエストは古い行を読んでキャッシュする
+    _load_in_another_request(app, user.id)
+    assert cache.get(user.id)['email'] == 'alice@example.com'
+
+    db.session.commit()
+    assert cache.get(user.id) is None
+    _load_in_another_request(app, user.id)
+    assert cache.get(user.id)['email'] == 'new@example.com'
+
+
+def test_a_rolled_back_change_keeps_the_cached_row(app, user):
+    cache = get_user_cache()
+    _load_in_another_request(app, user.id)
+    user.email = 'rolled-back@example.com'
+    db.session.flush()
+    db.session.rollback()
+    assert cache.get(user.id)['email'] == 'alice@example.com'
+    assert db.session.get(User, user.id).email == 'alice@example.com'
@@ -0,0 +1,113 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from app import db, write_behind as module
+from app.models import Post
+from app.write_behind import WriteBehind, WriteBehindUnavailable, get_write_behind
+from conftest import ROOT
+
+
+@pytest.fixture
+def enabled(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'WRITE_BEHIND_ENABLED', True)
+    # 裏のスレッドには反映させず、テストから flush する
+    monkeypatch.setitem(app.config, 'WRITE_BEHIND_FLUSH_INTERVAL', 3600)
+
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+    calls = []
+    real_fsync = os.fsync
+
+    def fsync(fd):
+        calls.append(fd)
+        time.sleep(0.02)  # 遅いディスク
+        real_fsync(fd)
+
+    monkeypatch.setattr(module.os, 'fsync', fsync)
+    return calls
+
+
+def _log_lines(path):
+    with open(path, encoding='utf-8') as file:
+        return [json.loads(line) for line in file]
+
+
+def test_like_is_visible_to_the_user_before_it_is_written(enabled, client, post):
+    response = client.post(f'/like/{post.id}')
+    assert response.get_json()['likes_count'] == 1
+    assert db.session.get(Post, post.id).likes_count == 0
+    timeline = client.get('/api/timeline').get_json()['posts']
+    assert timeline[0]['likes_count'] == 1 and timeline[0]['is_liked_by_user']
+
+    assert get_write_behind().flush() == 1
+    db.session.expire_all()
+    assert db.session.get(Post, post.id).likes_count == 1
+
+
+def test_submit_returns_after_the_log_is_fsynced(enabled, ctx, fsyncs):
+    write_behind = get_write_behind()
+    write_behind.submit('like', 1, 2, True, False)
+    assert fsyncs == [write_behind._log.fileno()]
+    assert _log_lines(write_behind.log_path)[-1]['target_id'] == 2
+
+
+def test_concurrent_submits_share_fsyncs(enabled, ctx, fsyncs):
+    write_behind = get_write_behind()
+    acknowledged = {}
+
+    def click(target_id):
+        write_behind.submit('like', 1, target_id, True, False)
+        # 返った時点で、自分の行は fsync 済み
+        seq = next(line['seq'] for line in _log_lines(write_behind.log_path) if line.get('target_id') == target_id)
+        acknowledged[target_id] = (seq, write_behind._synced)
+
+    threads = [threading.Thread(target=click, args=(target_id,)) for target_id in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(synced >= seq for seq, synced in acknowledged.values())
+    assert len(acknowledged) == 20 and len(fsyncs) < 20
+
+
+def test_a_second_owner_is_refused(enabled, app, ctx):
+    get_write_behind()
+    with pytest.raises(WriteBehindUnavailable):
+        WriteBehind(app, app.config['WRITE_BEHIND_LOG_DIR'], 3600, 1000)
+
+
+def test_another_worker_process_writes_synchronously(enabled, ctx):
+    get_write_behind()
+    # 2つ目のワーカーは起動時にロックが取れず、エラーをログに出して同期で書き込む
+    script = ('from app import app\n'
+              'from app.write_behind import write_behind_enabled\n'
+              'with app.app_context():\n'
+              '    assert not write_behind_enabled()\n')
+    result = subprocess.run([sys.executable, '-c', script], cwd=ROOT, capture_output=True, text=True,
+                            env=dict(os.environ, WRITE_BEHIND_ENABLED='1'))
+    assert result.returncode == 0, result.stderr
+    assert f'already enabled in process {os.getpid()}' in result.stderr
+
+
+def test_like_is_written_synchronously_without_the_lock(enabled, app, client, post):
+    owner = WriteBehind(app, app.config['WRITE_BEHIND_LOG_DIR'], 3600, 1000)
+    try:
+        assert client.post(f'/like/{post.id}').get_json()['likes_count'] == 1
+        db.session.expire_all()
+        assert db.session.get(Post, post.id).likes_count == 1
+        assert client.get('/metrics').status_code == 200
+        assert client.get('/api/timeline').get_json()['posts'][0]['is_liked_by_user']
+    finally:
+        owner.close()
+
+
+def test_the_lock_is_released_on_close(enabled, app, ctx):
+    get_write_behind()
+    app.extensions.pop('write_behind').close()
+    write_behind = WriteBehind(app, app.config['WRITE_BEHIND_LOG_DIR'], 3600, 1000)
+    write_behind.close()